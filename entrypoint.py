@@ -117,6 +117,8 @@ def rebind_parameters(**kwargs):
         "redpanda_write_caching": "greenflow.factors.exp_params.redpanda_write_caching",
         "replicationFactor": "greenflow.factors.exp_params.replicationFactor",
         "topic_name": "greenflow.factors.exp_params.topic_name",
+        "reuse_topic": "greenflow.factors.exp_params.reuse_topic",
+        "watermark_baseline": "greenflow.factors.exp_params.watermark_baseline",
     }
 
     succeeded_rebindings = {}
@@ -170,7 +170,6 @@ def experiment(state: State) -> Result:
     exp(
         experiment_description=params["exp_description"],
     )
-    time.sleep(15)
     throughput = get_observed_throughput_of_last_experiment(
         minimum_current_ts=start_time
     )
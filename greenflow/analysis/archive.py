@@ -0,0 +1,265 @@
+"""
+Evaluate the analysis queries against the local archive of raw series
+(see greenflow.archive) instead of the TSDB.
+
+Every function takes an experiment row and returns the same matrix result as
+the PromQL query of the matching calculate_* helper, so their reducers can be
+used as is, or None when the experiment was not archived. The PromQL functions
+are reimplemented on a fixed step without extrapolation, which matches the
+TSDB closely but not bit for bit.
+"""
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pendulum
+
+from ..archive import read_series
+
+STEP = 5
+LOOKBACK = 300
+
+
+def archived(row: pd.Series, metric: str) -> Optional[pd.DataFrame]:
+    table = read_series(row["started_ts"], metric)
+    if table is None:
+        return None
+    return table.to_pandas()
+
+
+def namespace(row: pd.Series) -> str:
+    return "redpanda" if "redpanda" in row["exp_name"] else "default"
+
+
+def topic_name(row: pd.Series) -> str:
+    """Topic the load went to, experiments run before it was recorded used input"""
+    topic = row.get("topic_name")
+    return "input" if pd.isna(topic) else topic
+
+
+def watermark_baseline(row: pd.Series) -> float:
+    """High water mark a reused topic was truncated at, 0 for fresh topics"""
+    baseline = row.get("watermark_baseline")
+    return 0 if pd.isna(baseline) else float(baseline)
+
+
+def labels(frame: pd.DataFrame) -> list[str]:
+    return [c for c in frame.columns if c not in ("timestamp", "value")]
+
+
+def grid(start: pendulum.DateTime, end: pendulum.DateTime) -> np.ndarray:
+    return np.arange(round(start.timestamp()), round(end.timestamp()) + 1, STEP)
+
+
+def as_result(steps: np.ndarray, values: np.ndarray, metric: dict = {}) -> list:
+    present = ~np.isnan(values)
+    if not present.any():
+        return []
+    return [
+        {
+            "metric": metric,
+            "values": [[t, v] for t, v in zip(steps[present], values[present])],
+        }
+    ]
+
+
+def series(frame: pd.DataFrame):
+    """(labels, timestamps, values) of every series, sorted by time"""
+    by = labels(frame)
+    if not by:
+        yield {}, frame["timestamp"].to_numpy(), frame["value"].to_numpy()
+        return
+    for key, group in frame.groupby(by, observed=True, dropna=False, sort=False):
+        group = group.sort_values("timestamp")
+        key = key if isinstance(key, tuple) else (key,)
+        yield dict(zip(by, key)), group["timestamp"].to_numpy(), group[
+            "value"
+        ].to_numpy()
+
+
+def instant(ts, values, steps, lookback=LOOKBACK) -> np.ndarray:
+    """Value of the series at each step: last sample within the lookback"""
+    last = np.searchsorted(ts, steps, side="right") - 1
+    valid = (last >= 0) & (steps - ts[np.maximum(last, 0)] <= lookback)
+    return np.where(valid, values[np.maximum(last, 0)], np.nan)
+
+
+def reset_corrected(values: np.ndarray) -> np.ndarray:
+    """Undo counter resets so that differences are always increases"""
+    drops = np.concatenate([[0.0], np.where(np.diff(values) < 0, values[:-1], 0.0)])
+    return values + np.cumsum(drops)
+
+
+def rate(ts, values, steps, window) -> np.ndarray:
+    """Per second increase between the first and last samples of each window"""
+    values = reset_corrected(values)
+    last = np.searchsorted(ts, steps, side="right") - 1
+    first = np.searchsorted(ts, steps - window, side="right")
+    valid = last > first
+    last, first = np.maximum(last, 0), np.minimum(first, len(ts) - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = (values[last] - values[first]) / (ts[last] - ts[first])
+    return np.where(valid, result, np.nan)
+
+
+def irate(ts, values, steps, window) -> np.ndarray:
+    """Per second increase between the last two samples of each window"""
+    values = reset_corrected(values)
+    last = np.searchsorted(ts, steps, side="right") - 1
+    previous = last - 1
+    valid = (previous >= 0) & (steps - ts[np.maximum(previous, 0)] < window)
+    last, previous = np.maximum(last, 0), np.maximum(previous, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = (values[last] - values[previous]) / (ts[last] - ts[previous])
+    return np.where(valid, result, np.nan)
+
+
+def histogram_quantile(q: float, le: np.ndarray, buckets: np.ndarray) -> np.ndarray:
+    """
+    Quantile of cumulative buckets (one row per upper bound `le`, sorted, with
+    +Inf last) at each step, interpolated linearly inside the bucket
+    """
+    total = buckets[-1]
+    rank = q * total
+    index = np.argmax(buckets >= rank, axis=0)
+    upper = le[index]
+    lower = np.where(index > 0, le[np.maximum(index - 1, 0)], 0.0)
+    below = np.where(
+        index > 0, buckets[np.maximum(index - 1, 0), np.arange(buckets.shape[1])], 0.0
+    )
+    inside = buckets[index, np.arange(buckets.shape[1])] - below
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = lower + (upper - lower) * (rank - below) / inside
+    # Falling into the +Inf bucket returns the largest finite bound
+    result = np.where(np.isinf(upper), lower, result)
+    return np.where((total > 0) & ~np.isnan(total), result, np.nan)
+
+
+def observed_throughput(row: pd.Series) -> Optional[list]:
+    frame = archived(row, "kminion_kafka_topic_high_water_mark_sum")
+    if frame is None:
+        return None
+    if frame.empty:
+        return []
+    started_ts = pendulum.parse(row["started_ts"]).timestamp()
+    stopped_ts = pendulum.parse(row["stopped_ts"]).timestamp()
+    frame = frame[
+        (frame["namespace"] == namespace(row))
+        & (frame["topic_name"] == topic_name(row))
+        & frame["timestamp"].between(started_ts, stopped_ts)
+    ]
+    return [
+        {"metric": metric, "values": list(zip(ts, values))}
+        for metric, ts, values in series(frame)
+        if len(ts)
+    ]
+
+
+def latency(row: pd.Series) -> Optional[list]:
+    frame = archived(row, "kminion_end_to_end_roundtrip_latency_seconds_bucket")
+    if frame is None:
+        return None
+    if frame.empty:
+        return []
+    frame = frame[frame["namespace"] == namespace(row)]
+    steps = grid(
+        pendulum.parse(row["started_ts"]).subtract(minutes=6),
+        pendulum.parse(row["stopped_ts"]).add(minutes=6),
+    )
+
+    # sum(rate(...)) by (le)
+    by_le = {}
+    for metric, ts, values in series(frame):
+        le = float(metric["le"])
+        rates = np.nan_to_num(rate(ts, values, steps, window=60))
+        by_le[le] = by_le.get(le, 0) + rates
+    if not by_le:
+        return []
+    le = np.array(sorted(by_le))
+    buckets = np.vstack([by_le[bound] for bound in le])
+    return as_result(steps, histogram_quantile(0.99, le, buckets))
+
+
+def average_power(row: pd.Series) -> Optional[list]:
+    frame = archived(row, "scaph_host_power_microwatts")
+    if frame is None:
+        return None
+    steps = grid(
+        pendulum.parse(row["started_ts"]).subtract(minutes=1),
+        pendulum.parse(row["stopped_ts"]).add(minutes=1),
+    )
+    values = [instant(ts, v, steps) for _, ts, v in series(frame) if len(ts)]
+    if not values:
+        return []
+    # sum(...) ignores the series that are absent at a step
+    total = np.nansum(values, axis=0)
+    total[np.isnan(values).all(axis=0)] = np.nan
+    return as_result(steps, total / 10**6)
+
+
+def network_saturation(row: pd.Series) -> Optional[list]:
+    received = archived(row, "node_network_receive_bytes_total")
+    speed = archived(row, "node_network_speed_bytes")
+    if received is None or speed is None:
+        return None
+    if received.empty or speed.empty:
+        return []
+    steps = grid(pendulum.parse(row["started_ts"]), pendulum.parse(row["stopped_ts"]))
+    speeds = {
+        (metric["device"], metric["node"]): (ts, v)
+        for metric, ts, v in series(speed[speed["device"].str.match("e")])
+    }
+
+    saturation = []
+    for metric, ts, values in series(received[received["device"].str.match("e")]):
+        key = (metric["device"], metric["node"])
+        if key not in speeds or len(ts) < 2:
+            continue
+        speed_ts, speed_values = speeds[key]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            saturation.append(
+                irate(ts, values, steps, window=15)
+                / instant(speed_ts, speed_values, steps)
+            )
+    if not saturation:
+        return []
+    # max_over_time(max(...)[1m]) over the run is the overall max at each step
+    return as_result(
+        steps, np.nanmax(np.where(np.isinf(saturation), np.nan, saturation), axis=0)
+    )
+
+
+def disk_throughput(row: pd.Series) -> Optional[list]:
+    read = archived(row, "node_disk_read_bytes_total")
+    written = archived(row, "node_disk_written_bytes_total")
+    if read is None or written is None:
+        return None
+    steps = grid(pendulum.parse(row["started_ts"]), pendulum.parse(row["stopped_ts"]))
+    rates = [
+        irate(ts, values, steps, window=15)
+        for frame in (read, written)
+        if not frame.empty
+        for _, ts, values in series(frame[frame["device"].str.match("nvme|sd")])
+        if len(ts) >= 2
+    ]
+    if not rates:
+        return []
+    return as_result(steps, np.nansum(rates, axis=0))
+
+
+def disk_utilization(row: pd.Series) -> Optional[list]:
+    written = archived(row, "node_disk_written_bytes_total")
+    if written is None:
+        return None
+    if written.empty:
+        return []
+    steps = grid(pendulum.parse(row["started_ts"]), pendulum.parse(row["stopped_ts"]))
+    rates = [
+        rate(ts, values, steps, window=60)
+        for _, ts, values in series(written[written["device"].str.match("nvme|sd")])
+        if len(ts) >= 2
+    ]
+    if not rates:
+        return []
+    return as_result(steps, np.nanmax(rates, axis=0))
@@ -0,0 +1,407 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Optional
+
+import pyarrow as pa
+import redis
+
+
+class CacheBackend(ABC):
+    """
+    Where RandasCache and the query cache keep their entries: a serialized
+    value and the name of the method that serialized it, by key
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[tuple]:
+        """
+        (value, method, expires) or None if the key is missing, expires is a
+        unix timestamp or None for entries without a ttl
+        """
+
+    @abstractmethod
+    def set(self, key: str, value, method: str, ttl: Optional[float] = None) -> None:
+        pass
+
+    def get_many(self, keys: Iterable[str]) -> list[Optional[tuple]]:
+        """get of each key"""
+        return [self.get(key) for key in keys]
+
+    def set_many(self, entries: Iterable[tuple]) -> None:
+        """set of each (key, value, method, ttl)"""
+        for entry in entries:
+            self.set(*entry)
+
+    @abstractmethod
+    def acquire(self, key: str, lease: float) -> Optional[str]:
+        """
+        Token of a lock on key, held for at most lease seconds, or None if
+        someone else holds it
+        """
+
+    @abstractmethod
+    def release(self, key: str, token: str) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, *keys: str) -> int:
+        pass
+
+    @abstractmethod
+    def keys(self, pattern: str) -> list[str]:
+        pass
+
+    @abstractmethod
+    def sizes(self, keys: Iterable[str]) -> list[tuple]:
+        """(bytes, method) of each key, (0, None) for missing ones"""
+
+
+class RedisBackend(CacheBackend):
+    def __init__(self, redis_instance: redis.Redis):
+        self.redis = redis_instance
+
+    @staticmethod
+    def _lock(key: str) -> str:
+        # Outside of the cache's own prefix, never listed or invalidated
+        return f"lock:{key}"
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        # A single round trip for all of them
+        keys = list(keys)
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+            pipe.pttl(key)
+        replies = pipe.execute()
+        entries = []
+        for cached_data, pttl in zip(replies[::2], replies[1::2]):
+            if not cached_data:
+                entries.append(None)
+                continue
+            expires = time.time() + pttl / 1000 if pttl > 0 else None
+            entries.append(
+                (
+                    cached_data[b"value"],
+                    cached_data[b"method"].decode("utf-8"),
+                    expires,
+                )
+            )
+        return entries
+
+    def set(self, key, value, method, ttl=None):
+        self.set_many([(key, value, method, ttl)])
+
+    def set_many(self, entries):
+        pipe = self.redis.pipeline(transaction=False)
+        for key, value, method, ttl in entries:
+            pipe.hset(key, mapping={"value": value, "method": method})
+            if ttl is not None:
+                pipe.expire(key, int(ttl))
+            else:
+                pipe.persist(key)
+        pipe.execute()
+
+    def acquire(self, key, lease):
+        token = uuid.uuid4().hex
+        if self.redis.set(self._lock(key), token, nx=True, px=int(lease * 1000)):
+            return token
+        return None
+
+    def release(self, key, token):
+        # Only our own lock, it may have expired and been taken by someone else
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self._lock(key))
+                if pipe.get(self._lock(key)) == token.encode("utf-8"):
+                    pipe.multi()
+                    pipe.delete(self._lock(key))
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+            except redis.WatchError:
+                pass
+
+    def delete(self, *keys):
+        # UNLINK frees the memory in the background, in batches like SCAN
+        deleted = 0
+        for i in range(0, len(keys), 1000):
+            deleted += self.redis.unlink(*keys[i : i + 1000])
+        return deleted
+
+    def keys(self, pattern):
+        # SCAN does not block the server like KEYS does
+        return [
+            key.decode("utf-8")
+            for key in self.redis.scan_iter(match=pattern, count=1000)
+        ]
+
+    def sizes(self, keys):
+        keys = list(keys)
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hstrlen(key, "value")
+            pipe.hget(key, "method")
+        replies = pipe.execute()
+        return [
+            (size, method.decode("utf-8") if method else None)
+            for size, method in zip(replies[::2], replies[1::2])
+        ]
+
+
+class DiskBackend(CacheBackend):
+    """
+    One file per entry in a local directory, read through a memory map so that
+    Arrow buffers point into the page cache instead of being copied. The least
+    recently used files are removed once the directory grows over max_bytes.
+
+    Each file holds a length prefixed json header with the key, the method and
+    the expiry, followed by the serialized value. Locks are files created
+    exclusively next to the entries. The directory is created on the first
+    write.
+    """
+
+    HEADER = struct.Struct("<I")
+
+    def __init__(self, path: str, max_bytes: int = 4 * 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.nbytes = sum(size for _, size, _ in self._files())
+
+    def _filename(self, key: str, suffix: str = "arrow") -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{digest}.{suffix}")
+
+    def _files(self) -> list[tuple]:
+        """(filename, bytes, last use) of every entry"""
+        files = []
+        if not os.path.isdir(self.path):
+            return files
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".arrow"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _read_header(self, source) -> dict:
+        (length,) = self.HEADER.unpack(source.read(self.HEADER.size))
+        return json.loads(source.read(length))
+
+    def get(self, key):
+        """
+        The value is a buffer over the memory map of the file, which it keeps
+        mapped until it is released, even if the entry is removed meanwhile
+        """
+        filename = self._filename(key)
+        try:
+            source = pa.memory_map(filename)
+        except FileNotFoundError:
+            return None
+        with source:
+            header = self._read_header(source)
+            if header["key"] != key:
+                return None
+            expires = header.get("expires")
+            expired = expires is not None and expires <= time.time()
+            if not expired:
+                value = source.read_buffer()
+        if expired:
+            # Unmapped first
+            self.delete(key)
+            return None
+        # Mark as recently used for eviction
+        os.utime(filename)
+        return value, header["method"], expires
+
+    def set(self, key, value, method, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        header = {"key": key, "method": method, "expires": expires}
+        header = json.dumps(header).encode("utf-8")
+        # Written aside and renamed, readers never see a partial entry
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.HEADER.pack(len(header)))
+            f.write(header)
+            f.write(value)
+        filename = self._filename(key)
+        self.nbytes -= self._size(filename)
+        os.replace(tmp, filename)
+        self.nbytes += self._size(filename)
+        if self.nbytes > self.max_bytes:
+            self.evict()
+
+    def acquire(self, key, lease):
+        lock = self._filename(key, "lock")
+        token = uuid.uuid4().hex
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(lock) as f:
+                    expires = float(f.read().split()[1])
+            except (FileNotFoundError, IndexError, ValueError):
+                # Released meanwhile, or still being written
+                return None
+            if expires < time.time():
+                # The holder died without releasing it
+                self._remove_lock(lock, expected=None)
+            return None
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{token} {time.time() + lease}")
+        return token
+
+    @staticmethod
+    def _remove_lock(lock: str, expected: Optional[str]):
+        try:
+            if expected is not None:
+                with open(lock) as f:
+                    if f.read().split()[0] != expected:
+                        return
+            os.remove(lock)
+        except (FileNotFoundError, IndexError):
+            pass
+
+    def release(self, key, token):
+        self._remove_lock(self._filename(key, "lock"), expected=token)
+
+    @staticmethod
+    def _size(filename: str) -> int:
+        try:
+            return os.path.getsize(filename)
+        except FileNotFoundError:
+            return 0
+
+    def evict(self) -> int:
+        """Remove least recently used entries until under max_bytes"""
+        # Other processes may share the directory, so look at it again
+        files = sorted(self._files(), key=lambda file: file[2])
+        self.nbytes = sum(size for _, size, _ in files)
+        evicted = 0
+        for filename, size, _ in files:
+            if self.nbytes <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            self.nbytes -= size
+            evicted += 1
+        return evicted
+
+    def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            filename = self._filename(key)
+            size = self._size(filename)
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                continue
+            self.nbytes -= size
+            deleted += 1
+        return deleted
+
+    def keys(self, pattern):
+        keys = []
+        for filename, _, _ in self._files():
+            try:
+                with open(filename, "rb") as f:
+                    key = self._read_header(f)["key"]
+            except FileNotFoundError:
+                continue
+            if fnmatch.fnmatchcase(key, pattern):
+                keys.append(key)
+        return keys
+
+    def sizes(self, keys):
+        sizes = []
+        for key in keys:
+            try:
+                with open(self._filename(key), "rb") as f:
+                    header = self._read_header(f)
+                    value_size = os.fstat(f.fileno()).st_size - f.tell()
+            except FileNotFoundError:
+                sizes.append((0, None))
+                continue
+            sizes.append((value_size, header["method"]))
+        return sizes
+
+
+class LazyBackend(CacheBackend):
+    """
+    Backend made by factory on first use, so that creating a cache, e.g. when
+    importing its module, does not look for Redis yet
+    """
+
+    def __init__(self, factory: Callable[[], CacheBackend]):
+        self.factory = factory
+        self._backend = None
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self) -> CacheBackend:
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = self.factory()
+        return self._backend
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def get_many(self, keys):
+        return self.backend.get_many(keys)
+
+    def set(self, key, value, method, ttl=None):
+        self.backend.set(key, value, method, ttl)
+
+    def set_many(self, entries):
+        self.backend.set_many(entries)
+
+    def acquire(self, key, lease):
+        return self.backend.acquire(key, lease)
+
+    def release(self, key, token):
+        self.backend.release(key, token)
+
+    def delete(self, *keys):
+        return self.backend.delete(*keys)
+
+    def keys(self, pattern):
+        return self.backend.keys(pattern)
+
+    def sizes(self, keys):
+        return self.backend.sizes(keys)
+
+
+def default_backend(redis_instance: redis.Redis, path: str) -> CacheBackend:
+    """Redis if it answers, a local directory otherwise"""
+    kwargs = redis_instance.connection_pool.connection_kwargs
+    address = kwargs.get("host", "localhost"), kwargs.get("port", 6379)
+    try:
+        # Fails at once when nothing listens, redis-py would retry with backoff
+        socket.create_connection(address, timeout=1).close()
+        redis_instance.ping()
+        return RedisBackend(redis_instance)
+    except (OSError, redis.RedisError) as e:
+        logging.warning(
+            {"msg": "Redis unavailable, caching to disk", "path": path, "error": str(e)}
+        )
+        return DiskBackend(path)
@@ -6,23 +6,92 @@ import functools
 import pickle
 import json
 import hashlib
+import time
+from collections import OrderedDict
 from os import getenv
+from typing import Optional, Union
+
+from .backends import (
+    CacheBackend,
+    DiskBackend,
+    LazyBackend,
+    RedisBackend,
+    default_backend,
+)
+from .metrics import BYTES, registry
+
+
+class LRUTier:
+    """
+    In-process tier of RandasCache: the most recently used entries, decoded but
+    not materialized, bounded by their total size in bytes
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # key -> (payload, method, nbytes, expires)
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[3] is not None and entry[3] <= time.time():
+            self.evict(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[:2]
+
+    def put(self, key, payload, method: str, nbytes: int, expires=None):
+        self.evict(key)
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (payload, method, nbytes, expires)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, _, evicted, _) = self.entries.popitem(last=False)
+            self.nbytes -= evicted
+
+    def evict(self, key=None) -> int:
+        """Drop one entry, or all of them if key is None"""
+        if key is None:
+            count = len(self.entries)
+            self.entries.clear()
+            self.nbytes = 0
+            return count
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return 0
+        self.nbytes -= entry[2]
+        return 1
 
 
 class RandasCache(object):
 
-    def __init__(self, redis_instance, key=None, hash_keys=False):
-        # Checks that a redis object has been passed
+    def __init__(
+        self,
+        backend: Union[CacheBackend, redis.Redis],
+        key=None,
+        hash_keys=False,
+        compression="zstd",
+        local_max_bytes=512 * 1024 * 1024,
+        ttl=None,
+        lease=600,
+    ):
+        # Checks that a redis object or a backend has been passed
         # https://stackoverflow.com/questions/57949871/how-to-set-get-pandas-dataframes-into-redis-using-pyarrow/57986261#57986261
-        if isinstance(redis_instance, redis.client.Redis) != True:
+        if isinstance(backend, redis.client.Redis):
+            backend = RedisBackend(backend)
+        if not isinstance(backend, CacheBackend):
             raise AttributeError(
-                "Did not recieve an Redis Object, instead recieved {}".format(
-                    type(redis_instance)
+                "Did not recieve an Redis Object or a CacheBackend, instead recieved {}".format(
+                    type(backend)
                 )
             )
 
-        # Sets the redis object as an attribute of this class
-        self.cache_container = redis_instance
+        # Where the serialized entries are kept, redis or a local directory
+        self.backend = backend
 
         # leading for reference in db, can be used to identify the caching object in redis
         self.leading_key = "RandasCache"
@@ -37,6 +106,26 @@ class RandasCache(object):
         # storing of keys in the object so as to know how to retrieve the value
         self.keys = {}
 
+        # Codec of the Arrow IPC buffers: "zstd", "lz4" or None
+        assert compression is None or pa.Codec.is_available(
+            compression
+        ), f"[ERROR]: compression {compression} is not available"
+        self.compression = compression
+
+        # Seconds taken by the last load of each key in this process
+        self.load_times = {}
+
+        # Recently used entries are served without a round trip to redis
+        self.local = LRUTier(max_bytes=local_max_bytes)
+
+        # Seconds before entries expire, None to keep them, decorators can
+        # override it
+        self.ttl = ttl
+
+        # Seconds a computation holds the lock on its key, others wait for its
+        # result meanwhile instead of computing the same thing
+        self.lease = lease
+
     # ------------------------------------------------------------------------------------
     # Internal Methods for mananging posting and getting from redis
     # ------------------------------------------------------------------------------------
@@ -111,64 +200,166 @@ class RandasCache(object):
 
         return ":".join(key)
 
-    def _serialize(self, key, value, method="pickle"):
+    @staticmethod
+    def _arrow_tobytes(value, compression: Optional[str] = None) -> pa.Buffer:
+        """DataFrames as an Arrow IPC stream, ndarrays as an Arrow tensor"""
+        sink = pa.BufferOutputStream()
+        if isinstance(value, np.ndarray):
+            pa.ipc.write_tensor(pa.Tensor.from_numpy(value), sink)
+        else:
+            table = pa.Table.from_pandas(value)
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+        return sink.getvalue()
+
+    @staticmethod
+    def _decode(value: bytes, method: str):
         """
-        Method for serializing python object with updated PyArrow serialization
+        Payload kept by the local tier: immutable Arrow objects for tables and
+        tensors, the raw bytes otherwise
         """
+        if method == "tensor":
+            # Wraps the bytes returned by the backend without copying them
+            return pa.ipc.read_tensor(pa.py_buffer(value))
+        if method == "pyarrow":
+            # Also reads entries written with the former pa.serialize_pandas,
+            # which produced the same stream format
+            return pa.ipc.open_stream(pa.py_buffer(value)).read_all()
+        if method in ("pickle", "json"):
+            return bytes(value)
+        raise ValueError(f"Unknown serialization method: {method}")
+
+    @staticmethod
+    def _nbytes(payload, method: str) -> int:
+        """Memory held by a decoded payload, tables are no longer compressed"""
+        if method == "tensor":
+            return payload.size * payload.type.bit_width // 8
+        if method == "pyarrow":
+            return payload.nbytes
+        return len(payload)
+
+    @staticmethod
+    def _materialize(payload, method: str):
+        """Fresh python object from a payload, safe for the caller to modify"""
+        if method == "tensor":
+            return payload.to_numpy().copy()
+        if method == "pyarrow":
+            return payload.to_pandas()
+        if method == "pickle":
+            return pickle.loads(payload)
+        return json.loads(payload)
+
+    def _serialize(self, key, value, method="pickle", ttl=None):
+        """
+        Method for serializing python object with Arrow IPC for tables, written
+        through to the backend and kept in the local tier
+        """
+        start = time.perf_counter()
         if method == "pickle":
             hashed_value = pickle.dumps(value)
         elif method == "pyarrow":
-            serialized = pa.serialize_pandas(value)
-            hashed_value = serialized.to_pybytes()
+            if isinstance(value, np.ndarray):
+                method = "tensor"
+            hashed_value = memoryview(self._arrow_tobytes(value, self.compression))
         elif method == "json":
-            hashed_value = json.dumps(value)
-
-        # Store both the value and the serialization method in Redis
-        self.cache_container.hset(
-            key, mapping={"value": hashed_value, "method": method}
+            hashed_value = json.dumps(value).encode("utf-8")
+        function = self._function(key)
+        registry.observe(
+            "randas_cache_serialize_seconds",
+            time.perf_counter() - start,
+            function=function,
+            method=method,
+        )
+        registry.observe(
+            "randas_cache_bytes",
+            len(hashed_value),
+            buckets=BYTES,
+            function=function,
+            method=method,
         )
+
+        # Store both the value and the serialization method
+        self.backend.set(key, hashed_value, method, ttl=ttl)
         self.keys[key] = method
+        expires = time.time() + ttl if ttl is not None else None
+        payload = self._decode(hashed_value, method)
+        self.local.put(key, payload, method, self._nbytes(payload, method), expires)
 
-    def _deserialize(self, key):
+    def _lookup(self, key):
         """
-        Method for deserializing python object with updated PyArrow serialization
+        (True, value) from the local tier, or else from the backend in a
+        single round trip, (False, None) if the key is in neither
         """
-        # Get both value and method from Redis
-        cached_data = self.cache_container.hgetall(key)
-
-        if not cached_data:
-            raise ValueError(f"No data found for key: {key}")
+        start = time.perf_counter()
+        tier = "local"
+        entry = self.local.get(key)
+        if entry is None:
+            tier = "backend"
+            stored = self.backend.get(key)
+            if stored is None:
+                return False, None
+            value, method, expires = stored
+            entry = self._decode(value, method), method
+            self.local.put(key, *entry, self._nbytes(*entry), expires)
+
+        result = self._materialize(*entry)
+        self.load_times[key] = time.perf_counter() - start
+        function = self._function(key)
+        registry.inc("randas_cache_hits_total", function=function, tier=tier)
+        registry.observe(
+            "randas_cache_load_seconds", self.load_times[key], function=function
+        )
+        return True, result
 
-        value = cached_data[b"value"]
-        method = cached_data[b"method"].decode("utf-8")
+    def _function(self, key: str) -> str:
+        """Decorated function of a key, the metrics are labeled with it"""
+        return key.split(":", 1)[0].removeprefix(f"{self.leading_key}-")
 
-        if method == "pickle":
-            return pickle.loads(value)
-        elif method == "pyarrow":
-            buffer = pa.py_buffer(value)
-            return pa.deserialize_pandas(buffer)
-        elif method == "json":
-            return json.loads(value)
-        else:
-            raise ValueError(f"Unknown serialization method: {method}")
+    def _deserialize(self, key):
+        """
+        Method for deserializing python object, Arrow buffers are read in place
+        """
+        found, result = self._lookup(key)
+        if not found:
+            raise ValueError(f"No data found for key: {key}")
+        return result
+
+    def report(self) -> pd.DataFrame:
+        """Stored size and last load time in this process of every entry"""
+        keys = sorted(self.backend.keys(f"{self.leading_key}*"))
+
+        rows = []
+        for key, (size, method) in zip(keys, self.backend.sizes(keys)):
+            rows.append(
+                {
+                    "key": key,
+                    "method": method,
+                    "bytes": size,
+                    "load_seconds": self.load_times.get(key),
+                }
+            )
+        return pd.DataFrame(
+            rows, columns=["key", "method", "bytes", "load_seconds"]
+        ).set_index("key")
 
     def invalidate_cache(self, key=None):
         """
         Invalidates cache entries. If no key is provided, invalidates all entries
         associated with this RandasCache instance.
         """
+        self.local.evict(key)
         if key is not None:
-            if self.cache_container.exists(key):
-                self.cache_container.delete(key)
+            if self.backend.delete(key):
                 if key in self.keys:
                     del self.keys[key]
                 return 1
             return 0
         else:
             pattern = f"{self.leading_key}*"
-            keys_to_delete = self.cache_container.keys(pattern)
+            keys_to_delete = self.backend.keys(pattern)
             if keys_to_delete:
-                self.cache_container.delete(*keys_to_delete)
+                self.backend.delete(*keys_to_delete)
                 self.keys = {}
                 return len(keys_to_delete)
             return 0
@@ -178,14 +369,15 @@ class RandasCache(object):
     # ------------------------------------------------------------------------------------
     def get(self, key):
         """
-        Returns object from the redis database if key exists
+        Returns object from the cache if key exists
         """
-        if self.cache_container.exists(key) == 1:
-            return self._deserialize(key)
+        found, value = self._lookup(key)
+        if found:
+            return value
         else:
             raise ValueError("No key {} found in object".format(key))
 
-    def post(self, key, values, serialization):
+    def post(self, key, values, serialization, ttl=None):
         """
         Posts key,value to redis where its serilaized by the serialization param
         Parameters:
@@ -193,6 +385,7 @@ class RandasCache(object):
             key=str()
             values=python object
             serialization=str(), of which is 'pickle', 'json', 'pyarrow'
+            ttl=seconds before the entry expires, defaults to the cache's ttl
         Returns:
         --------
             python object
@@ -201,21 +394,45 @@ class RandasCache(object):
         assert isinstance(serialization, str)
         assert serialization in ["pickle", "json", "pyarrow"]
 
-        self._serialize(key, values, serialization)
+        self._serialize(key, values, serialization, ttl=ttl or self.ttl)
 
     # ------------------------------------------------------------------------------------
     # Caching Decorators to be used over functions
     # ------------------------------------------------------------------------------------
 
-    def cache(self, func):
+    def _single_flight(self, key, compute, method, ttl):
         """
-        General Decorater function for caching functions, will attempt to cache with the
-        correct serialization based on type, else use pickle
-        Parameters:
-            func = python function, is the input due to wrapping
-        Returns:
-            Python Object
+        Cached value of key, or else computed once across processes: whoever
+        gets the lock computes and stores it, the others wait for the result
         """
+        found, value = self._lookup(key)
+        while not found:
+            token = self.backend.acquire(key, self.lease)
+            if token is None:
+                # Someone else is computing it, or died doing so and the lease
+                # runs out eventually
+                registry.inc("randas_cache_waits_total", function=self._function(key))
+                time.sleep(0.1)
+                found, value = self._lookup(key)
+                continue
+            try:
+                # It may have been stored between our lookup and the lock
+                found, value = self._lookup(key)
+                if not found:
+                    function = self._function(key)
+                    registry.inc("randas_cache_misses_total", function=function)
+                    with registry.timer(
+                        "randas_cache_compute_seconds", function=function
+                    ):
+                        value = compute()
+                    self._serialize(key, value, method=method(value), ttl=ttl)
+                    found = True
+            finally:
+                self.backend.release(key, token)
+        return value
+
+    def _decorator(self, func, method, ttl):
+        ttl = ttl or self.ttl
 
         @functools.wraps(func)
         def wrapper_df_decorator(*args, **kwargs):
@@ -225,88 +442,66 @@ class RandasCache(object):
             else:
                 key = self.key_generator(func, self.key)
 
-            # check if exists in redis
-            if self.cache_container.exists(key) == 1:
-                # Pulls data from redis, deserialses and returns the dataframe
-                value = self._deserialize(key)
-            else:
-                # Runs the function that was decorated
-                value = func(*args, **kwargs)
-                # if function is dataframe, insert into database
-                if isinstance(value, pd.DataFrame) or isinstance(value, np.array):
-                    self._serialize(key, value, method="pyarrow")
-
-                else:
-                    self._serialize(key, value, method="pickle")
-
-            return value
+            return self._single_flight(key, lambda: func(*args, **kwargs), method, ttl)
 
         return wrapper_df_decorator
 
-    def json_cache(self, func):
+    @staticmethod
+    def _by_type(value):
+        # if function is dataframe, insert into database with arrow
+        if isinstance(value, pd.DataFrame) or (
+            isinstance(value, np.ndarray) and value.dtype != object
+        ):
+            return "pyarrow"
+        return "pickle"
+
+    def cache(self, func=None, *, ttl=None):
+        """
+        General Decorater function for caching functions, will attempt to cache with the
+        correct serialization based on type, else use pickle
+        Parameters:
+            func = python function, is the input due to wrapping
+            ttl = seconds before entries expire, used as @cache.cache(ttl=600)
+        Returns:
+            Python Object
+        """
+        if func is None:
+            return functools.partial(self.cache, ttl=ttl)
+        return self._decorator(func, self._by_type, ttl)
+
+    def json_cache(self, func=None, *, ttl=None):
         """
         Decorater function for caching functions with json serialization
         Recommended to be used with dict style objects
         Refer to the python json api for more info
         Parameters:
             func = python function, is the input due to wrapping
+            ttl = seconds before entries expire, used as @cache.json_cache(ttl=600)
         Returns:
             Python Object
         """
+        if func is None:
+            return functools.partial(self.json_cache, ttl=ttl)
+        return self._decorator(func, lambda value: "json", ttl)
 
-        @functools.wraps(func)
-        def wrapper_df_decorator(*args, **kwargs):
-            # generate key based on called function
-            if self.key == None:
-                key = self.key_generator(func, *args, **kwargs)
-            else:
-                key = self.key_generator(func, self.key)
-
-            # check if exists in redis
-            if self.cache_container.exists(key) == 1:
-                # Pulls data from redis, deserialses and returns the dataframe
-                value = self._deserialize(key)
-            else:
-                # Runs the function that was decorated
-                value = func(*args, **kwargs)
-                self._serialize(key, value, method="json")
-
-            return value
-
-        return wrapper_df_decorator
-
-    def pyarrow_cache(self, func):
+    def pyarrow_cache(self, func=None, *, ttl=None):
         """
         Decorater function for caching functions with pyarrow serialization
         Recommended to be used with pandas, numpy or any table style object
         Refer to pyarrow for more specification
         Parameters:
             func = python function, is the input due to wrapping
+            ttl = seconds before entries expire, used as @cache.pyarrow_cache(ttl=600)
         Returns:
             Python Object
         """
-
-        @functools.wraps(func)
-        def wrapper_df_decorator(*args, **kwargs):
-            # generate key based on called function
-            if self.key == None:
-                key = self.key_generator(func, *args, **kwargs)
-            else:
-                key = self.key_generator(func, self.key)
-
-            # check if exists in redis
-            if self.cache_container.exists(key) == 1:
-                # Pulls data from redis, deserialses and returns the dataframe
-                value = self._deserialize(key)
-            else:
-                # Runs the function that was decorated
-                value = func(*args, **kwargs)
-                self._serialize(key, value, method="pyarrow")
-
-            return value
-
-        return wrapper_df_decorator
+        if func is None:
+            return functools.partial(self.pyarrow_cache, ttl=ttl)
+        return self._decorator(func, lambda value: "pyarrow", ttl)
 
 
 r = redis.Redis(host="localhost", port=6379, db=0, password=getenv("REDIS_PASSWORD"))
-cache = RandasCache(r, hash_keys=False)
+# Falls back to a local directory when redis is not running, e.g. offline analysis
+cache_dir = getenv("RANDAS_CACHE_DIR", f"{getenv('GITROOT', '.')}/storage/randas-cache")
+# Redis is looked for on the first use of the cache, not on import
+cache = RandasCache(LazyBackend(lambda: default_backend(r, cache_dir)), hash_keys=False)
@@ -0,0 +1,142 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from os import getenv
+from typing import Optional
+
+import pandas as pd
+import requests
+
+# Upper bounds of the histogram buckets
+SECONDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+BYTES = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # The last one counts values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    """
+    Counters and histograms of the analysis path in this process, by name and
+    labels, e.g. cache hits per decorated function or Prometheus latencies
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, ((label, value), ...)) -> float or Histogram
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple = SECONDS, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def stats(self) -> pd.DataFrame:
+        """One row per counter or histogram, with its labels as columns"""
+        rows = []
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                rows.append({"name": name, **dict(labels), "count": value})
+            for (name, labels), histogram in self.histograms.items():
+                rows.append(
+                    {
+                        "name": name,
+                        **dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "mean": histogram.sum / histogram.count,
+                        "max": histogram.max,
+                    }
+                )
+        if not rows:
+            return pd.DataFrame(columns=["name", "count"])
+        return pd.DataFrame(rows).sort_values("name", kind="stable")
+
+    @staticmethod
+    def _labels(labels, **extra) -> str:
+        labels = {**dict(labels), **extra}
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+    def exposition(self) -> str:
+        """Prometheus text format, as scraped or imported by VictoriaMetrics"""
+        lines = []
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                lines.append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), histogram in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = self._labels(labels, le=bound)
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                le = self._labels(labels, le="+Inf")
+                lines.append(f"{name}_bucket{le} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def push(self, url: Optional[str] = None, job: str = "greenflow_analysis") -> bool:
+        """
+        Send the current values to EXPERIMENT_PUSHGATEWAY_URL, the
+        VictoriaMetrics import endpoint, False if it is not set
+        """
+        url = url or getenv("EXPERIMENT_PUSHGATEWAY_URL")
+        if not url:
+            return False
+        response = requests.post(
+            url,
+            data=self.exposition(),
+            params={"extra_label": f"job={job}"},
+            timeout=10,
+        )
+        response.raise_for_status()
+        return True
+
+
+registry = Metrics()
+
+
+def stats() -> pd.DataFrame:
+    """Cache and Prometheus counters and histograms of this process"""
+    return registry.stats()
+
+
+def push_stats(url: Optional[str] = None) -> bool:
+    return registry.push(url)
@@ -0,0 +1,435 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from typing import Any, Callable, NamedTuple, Optional
+
+import httpx
+import numpy as np
+import pendulum
+import redis
+import requests
+from prometheus_api_client import PrometheusApiClientException, PrometheusConnect
+
+from .backends import CacheBackend, RedisBackend
+from .cache import cache
+from .metrics import registry
+
+url = getenv("PROMETHEUS_URL")
+# Shared synchronous client, reused by every helper instead of one per call
+prom = PrometheusConnect(url=url)
+
+
+class RangeQuery(NamedTuple):
+    query: str
+    start_time: pendulum.DateTime
+    end_time: pendulum.DateTime
+    # None means raw samples over the range, as in get_metric_range_data
+    step: Optional[str] = None
+
+
+# Step of the RangeQuery describing an instant query evaluated at end_time,
+# only used to key the query cache
+INSTANT = "instant"
+
+# Step picked from the scrape interval and the window length, long windows are
+# fetched in chunks (see split_range)
+AUTO = "auto"
+
+# Seconds between scrapes, a finer step only repeats samples
+SCRAPE_INTERVAL = int(getenv("PROMETHEUS_SCRAPE_INTERVAL", "5"))
+# Prometheus refuses range queries of more than 11000 points per series
+MAX_POINTS = 11000
+# Points per chunk of a range query, fetched concurrently
+CHUNK_POINTS = 720
+
+
+def pick_step(
+    start_time: pendulum.DateTime,
+    end_time: pendulum.DateTime,
+    scrape_interval: int = SCRAPE_INTERVAL,
+    max_points: int = MAX_POINTS,
+) -> int:
+    """Smallest multiple of the scrape interval, in seconds, within max_points"""
+    window = (end_time - start_time).total_seconds()
+    return max(1, math.ceil(window / max_points / scrape_interval)) * scrape_interval
+
+
+def split_range(query: RangeQuery, chunk_points: int = CHUNK_POINTS) -> list:
+    """
+    Sub-windows of an AUTO range query with an explicit step, evaluated at the
+    same timestamps as the whole window would be, without overlap
+    """
+    step = pick_step(query.start_time, query.end_time)
+    chunk = chunk_points * step
+    chunks = []
+    start_time = query.start_time
+    while start_time <= query.end_time:
+        end_time = min(query.end_time, start_time.add(seconds=chunk - step))
+        chunks.append(RangeQuery(query.query, start_time, end_time, step=f"{step}s"))
+        start_time = start_time.add(seconds=chunk)
+    return chunks
+
+
+class Stitcher:
+    """Samples of chunked range queries, joined per series as float arrays"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.parts = defaultdict(list)
+
+    def add(self, result: list):
+        for series in result:
+            key = tuple(sorted(series["metric"].items()))
+            self.metrics[key] = series["metric"]
+            self.parts[key].append(np.asarray(series["values"], dtype=float))
+
+    def result(self) -> list:
+        """Matrix result with (timestamp, value) arrays sorted by timestamp"""
+        result = []
+        for key, parts in self.parts.items():
+            values = np.concatenate(parts)
+            values = values[np.argsort(values[:, 0], kind="stable")]
+            result.append({"metric": self.metrics[key], "values": values})
+        return result
+
+
+class QueryCache:
+    """
+    Cache of query results in the backend of RandasCache, Redis or a local
+    directory, keyed by Prometheus URL, normalized PromQL, time range and step.
+    Windows that ended more than `settle` seconds ago return the same data
+    forever, so they never expire; windows still open get a short TTL, as do
+    empty results, which may only be missing data (e.g. a TSDB restored later).
+    """
+
+    # Entries were plain Redis strings before being backend entries
+    leading_key = "PromQueryCache:v2"
+
+    def __init__(
+        self,
+        backend,
+        *,
+        url: Optional[str] = url,
+        open_ttl: int = 30,
+        settle: int = 300,
+    ):
+        if isinstance(backend, redis.Redis):
+            backend = RedisBackend(backend)
+        self.backend: CacheBackend = backend
+        # Of the queries that do not say otherwise
+        self.url = url
+        self.open_ttl = open_ttl
+        # Margin for late samples (scrape interval, TSDB ingestion, force_flush)
+        self.settle = settle
+        self.enabled = True
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Drop insignificant whitespace, leaving quoted label values untouched"""
+        parts = re.split(r'("(?:[^"\\]|\\.)*")', query)
+        for i in range(0, len(parts), 2):
+            part = re.sub(r"\s+", " ", parts[i])
+            parts[i] = re.sub(r" ?([(){}\[\],=~!+\-*/^<>]) ?", r"\1", part)
+        return "".join(parts).strip()
+
+    def key(self, query: RangeQuery, url: Optional[str] = None) -> str:
+        """Distinct per Prometheus, test and production ones answer differently"""
+        identity = ":".join(
+            [
+                (url or self.url or "").rstrip("/"),
+                self.normalize(query.query),
+                str(round(query.start_time.timestamp())),
+                str(round(query.end_time.timestamp())),
+                query.step or "raw",
+            ]
+        )
+        return f"{self.leading_key}:{hashlib.sha256(identity.encode()).hexdigest()}"
+
+    def ttl(self, query: RangeQuery, result: list) -> Optional[int]:
+        """None for closed windows with a result, which are cached forever"""
+        if len(result) == 0:
+            return self.open_ttl
+        if query.end_time < pendulum.now().subtract(seconds=self.settle):
+            return None
+        return self.open_ttl
+
+    def _unavailable(self, e: Exception):
+        # Never fail a query because of the cache, just stop using it
+        logging.warning({"msg": "Query cache disabled", "error": str(e)})
+        self.enabled = False
+
+    def get_many(self, queries: dict, url: Optional[str] = None) -> dict:
+        """Cached results of the queries that have one, under the same keys"""
+        if not self.enabled or not queries:
+            return {}
+        keys = list(queries)
+        try:
+            entries = self.backend.get_many([self.key(queries[k], url) for k in keys])
+        except (redis.exceptions.RedisError, OSError) as e:
+            self._unavailable(e)
+            return {}
+        hits = {
+            k: json.loads(bytes(entry[0]))
+            for k, entry in zip(keys, entries)
+            if entry is not None
+        }
+        registry.inc("prometheus_query_cache_hits_total", len(hits))
+        registry.inc("prometheus_query_cache_misses_total", len(keys) - len(hits))
+        return hits
+
+    def set_many(self, queries: dict, results: dict, url: Optional[str] = None):
+        """Store the results of the queries, failed queries are not cached"""
+        if not self.enabled:
+            return
+        entries = []
+        for k, result in results.items():
+            if isinstance(result, Exception):
+                continue
+            query = queries[k]
+            ttl = self.ttl(query, result)
+            # Stitched chunks hold numpy arrays
+            result = json.dumps(result, default=np.ndarray.tolist).encode("utf-8")
+            entries.append((self.key(query, url), result, "json", ttl))
+        try:
+            self.backend.set_many(entries)
+        except (redis.exceptions.RedisError, OSError) as e:
+            self._unavailable(e)
+
+    def cached(self, query: RangeQuery, fetch: Callable[[RangeQuery], list]) -> list:
+        hit = self.get_many({query: query})
+        if query in hit:
+            return hit[query]
+        result = fetch(query)
+        self.set_many({query: query}, {query: result})
+        return result
+
+
+query_cache = QueryCache(cache.backend)
+
+
+def error_status(e: Exception):
+    """
+    Status of a failed query for prometheus_queries_total: the HTTP code like
+    for the queries that went through, or "error" when no response came back
+    """
+    if isinstance(e, PrometheusApiClientException):
+        match = re.match(r"HTTP Status Code (\d+)", str(e))
+        if match:
+            return int(match[1])
+    return "error"
+
+
+class AsyncPrometheus:
+    """
+    Minimal asyncio Prometheus client, mirroring the PrometheusConnect methods
+    used by the analysis helpers. All requests go through one pooled keep-alive
+    connection, at most `concurrency` at a time, retried with exponential backoff.
+    """
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        url: str = url,
+        *,
+        concurrency: int = 16,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 60,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        cache: Optional[QueryCache] = query_cache,
+    ):
+        if not url:
+            raise ValueError(
+                "No Prometheus URL: set PROMETHEUS_URL or pass the url explicitly"
+            )
+        self.url = url.rstrip("/")
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.transport = transport
+        self.cache = cache
+        self.client = None
+        self.semaphore = None
+
+    async def __aenter__(self) -> "AsyncPrometheus":
+        self.client = httpx.AsyncClient(
+            base_url=self.url,
+            timeout=self.timeout,
+            transport=self.transport,
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+    async def _get(self, path: str, params: dict[str, Any]) -> list:
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    with registry.timer("prometheus_query_seconds", endpoint=path):
+                        response = await self.client.get(path, params=params)
+                    registry.inc(
+                        "prometheus_queries_total",
+                        endpoint=path,
+                        status=response.status_code,
+                    )
+                    if (
+                        response.status_code not in self.RETRY_STATUS
+                        or attempt == self.retries
+                    ):
+                        response.raise_for_status()
+                        return response.json()["data"]["result"]
+                except httpx.TransportError:
+                    registry.inc(
+                        "prometheus_queries_total", endpoint=path, status="error"
+                    )
+                    if attempt == self.retries:
+                        raise
+                delay = self.backoff * 2**attempt
+                logging.info({"msg": "Retrying Prometheus query", "delay": delay})
+                await asyncio.sleep(delay)
+
+    async def custom_query(self, query: str, params: Optional[dict] = None) -> list:
+        return await self._get("/api/v1/query", {"query": query, **(params or {})})
+
+    async def custom_query_range(
+        self, query: str, start_time, end_time, step: str, params=None
+    ) -> list:
+        return await self._get(
+            "/api/v1/query_range",
+            {
+                "query": query,
+                "start": round(start_time.timestamp()),
+                "end": round(end_time.timestamp()),
+                "step": step,
+                **(params or {}),
+            },
+        )
+
+    async def get_metric_range_data(self, metric_name: str, start_time, end_time):
+        duration = int((end_time - start_time).total_seconds())
+        return await self.custom_query(
+            f"{metric_name}[{duration}s]",
+            params={"time": round(end_time.timestamp())},
+        )
+
+    async def fetch(self, query: RangeQuery) -> list:
+        if query.step == INSTANT:
+            return await self.custom_query(
+                query.query, params={"time": round(query.end_time.timestamp())}
+            )
+        if query.step is None:
+            return await self.get_metric_range_data(
+                query.query, query.start_time, query.end_time
+            )
+        if query.step == AUTO:
+            return await self.fetch_chunked(query)
+        return await self.custom_query_range(
+            query.query, query.start_time, query.end_time, step=query.step
+        )
+
+    async def fetch_chunked(self, query: RangeQuery) -> list:
+        """
+        Range query split in sub-windows fetched concurrently, each one is
+        turned into arrays as soon as it arrives
+        """
+        chunks = split_range(query)
+        if len(chunks) == 1:
+            (chunk,) = chunks
+            return await self.custom_query_range(
+                chunk.query, chunk.start_time, chunk.end_time, step=chunk.step
+            )
+        stitcher = Stitcher()
+        for result in asyncio.as_completed(
+            [
+                self.custom_query_range(
+                    chunk.query, chunk.start_time, chunk.end_time, step=chunk.step
+                )
+                for chunk in chunks
+            ]
+        ):
+            stitcher.add(await result)
+        return stitcher.result()
+
+    async def fetch_all(self, queries: dict) -> dict:
+        """Fetch every query concurrently, exceptions are returned in place of data"""
+        cached = self.cache.get_many(queries, self.url) if self.cache else {}
+        keys = [key for key in queries if key not in cached]
+        results = await asyncio.gather(
+            *(self.fetch(queries[key]) for key in keys), return_exceptions=True
+        )
+        results = dict(zip(keys, results))
+        if self.cache:
+            self.cache.set_many(queries, results, self.url)
+        return {**cached, **results}
+
+
+def watermark_query(
+    exp_name: str, experiment_started_ts: str, topic_name: str = "input"
+) -> str:
+    """High water mark of the experiment's topic, as reported by kminion"""
+    namespace = "redpanda" if "redpanda" in exp_name else "default"
+    return f'kminion_kafka_topic_high_water_mark_sum{{namespace="{namespace}", topic_name="{topic_name}", experiment_started_ts="{experiment_started_ts}"}}'
+
+
+def wait_for_samples(
+    query: str,
+    after: pendulum.DateTime,
+    *,
+    timeout: float = 60,
+    interval: float = 1,
+) -> bool:
+    """
+    Block until the newest sample of query is at or after `after`, i.e. the TSDB
+    has everything up to then, instead of sleeping for a fixed time. Returns
+    False if it is still missing after timeout seconds.
+    """
+    start = time.monotonic()
+    while True:
+        try:
+            # Since we are using VictoriaMetrics, there's an additional flush required
+            requests.get(f"{url}/internal/force_flush", timeout=10)
+        except requests.RequestException:
+            pass
+        result = prom.custom_query(f"max(timestamp({query}))")
+        if result and float(result[0]["value"][1]) >= after.timestamp():
+            registry.observe("prometheus_readiness_seconds", time.monotonic() - start)
+            return True
+        if time.monotonic() - start >= timeout:
+            logging.warning(
+                {"msg": "Samples not visible", "query": query, "after": str(after)}
+            )
+            return False
+        time.sleep(interval)
+
+
+def fetch_all(queries: dict, **kwargs) -> dict:
+    async def _fetch_all():
+        async with AsyncPrometheus(**kwargs) as client:
+            return await client.fetch_all(queries)
+
+    return run(_fetch_all())
+
+
+def run(coro):
+    """asyncio.run that also works from inside a running loop (e.g. Jupyter)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
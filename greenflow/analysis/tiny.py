@@ -1,7 +1,8 @@
 from os import getenv
 from prometheus_api_client import PrometheusConnect, MetricRangeDataFrame
 import logging
-from typing import Any, Callable
+from typing import Any, Callable, Optional, Union
+import numpy as np
 import pandas as pd
 import pendulum
 from tinydb.table import Document
@@ -17,89 +18,105 @@ def get_experiments():
     return experiments
 
 
-def sort_by_time(exp_id, experiments):
-    date_time_str = experiments[exp_id]["started_ts"]
-    return pendulum.parse(date_time_str)
+def epoch_ns(timestamps) -> np.ndarray:
+    """ISO8601 timestamps (any offset) to UTC nanoseconds since epoch"""
+    return (
+        pd.to_datetime(list(timestamps), utc=True, format="ISO8601").as_unit("ns").asi8
+    )
 
 
-def get_observed_throughput_of_last_experiment(
-    minimum_current_ts: pendulum.DateTime,
-) -> float:
+class ExperimentIndex:
+    """
+    Experiments sorted by start time, parsed once when loaded, so that time
+    range lookups are binary searches instead of parsing every timestamp
+    """
+
+    def __init__(self, experiments: dict[int, Document]):
+        docs = list(experiments.values())
+        started_ns = epoch_ns(exp["started_ts"] for exp in docs)
+        order = np.argsort(started_ns, kind="stable")
+        self.started_ns = started_ns[order]
+        self.experiments = [docs[i] for i in order]
+
+    def __len__(self) -> int:
+        return len(self.experiments)
+
+    def between(self, begin: pendulum.DateTime, end: pendulum.DateTime) -> list:
+        """Experiments started in [begin, end], most recent first"""
+        first = np.searchsorted(self.started_ns, pd.Timestamp(begin).value, "left")
+        last = np.searchsorted(self.started_ns, pd.Timestamp(end).value, "right")
+        return self.experiments[first:last][::-1]
+
+    def latest_since(self, begin: pendulum.DateTime) -> Optional[Document]:
+        """Most recent experiment if it started at or after begin"""
+        if not self.experiments:
+            return None
+        if self.started_ns[-1] < pd.Timestamp(begin).value:
+            return None
+        return self.experiments[-1]
+
+
+# Built from the storage it is paired with, until an experiment is stored
+_index: Optional[tuple[Any, ExperimentIndex]] = None
+
+
+def get_experiment_index() -> ExperimentIndex:
+    """Index of the stored experiments, only read again after a write"""
+    global _index
     from ..g import g
-    import logging
 
-    url = getenv("PROMETHEUS_URL")
-    prom = PrometheusConnect(url=url)
+    if _index is None or _index[0] is not g.storage:
+        _index = g.storage, ExperimentIndex(get_experiments())
+    return _index[1]
 
-    # Get the most recent experiment
-    experiments = {exp.doc_id: exp for exp in g.storage.experiments.all()}
 
-    # Since we are using VictoriaMetrics, there's an additional flush required
-    requests.get(f"{url}/internal/force_flush")
+def invalidate_experiment_index():
+    """Called whenever the experiments are written"""
+    global _index
+    _index = None
 
-    # Filter experiments that started after the minimum_current_ts
-    valid_experiments = {
-        exp_id: exp
-        for exp_id, exp in experiments.items()
-        if pendulum.parse(exp["started_ts"]) >= minimum_current_ts
-    }
 
-    if not valid_experiments:
-        breakpoint()
-        print(f"No experiments found after {minimum_current_ts}")
-        return float("NaN")
+def sort_by_time(exp_id, experiments):
+    date_time_str = experiments[exp_id]["started_ts"]
+    return pendulum.parse(date_time_str)
 
-    latest_exp_id = max(
-        valid_experiments.keys(),
-        key=lambda x: pendulum.parse(valid_experiments[x]["started_ts"]),
-    )
-    latest_exp = valid_experiments[latest_exp_id]
 
-    # Extract timestamps
-    started_ts = pendulum.parse(latest_exp["started_ts"])
-    stopped_ts = pendulum.parse(latest_exp["stopped_ts"])
+def last_experiment(minimum_current_ts: pendulum.DateTime) -> Optional[dict]:
+    """See utils.get_last_experiment"""
+    # Get the most recent experiment
+    index = get_experiment_index()
+
+    # Latest experiment, if it started after the minimum_current_ts
+    latest_exp = index.latest_since(minimum_current_ts)
+
+    if latest_exp is None:
+        print(f"No experiments found after {minimum_current_ts}")
+        return None
 
     # Sanity check
-    if started_ts < minimum_current_ts:
+    if pendulum.parse(latest_exp["started_ts"]) < minimum_current_ts:
         print(
-            f"Warning: Latest experiment started at {started_ts}, which is before the minimum timestamp {minimum_current_ts}"
+            f"Warning: Latest experiment started at {latest_exp['started_ts']}, which is before the minimum timestamp {minimum_current_ts}"
         )
-        return float("NaN")
-
-    # Determine the namespace
-    namespace = "redpanda" if "redpanda" in latest_exp["exp_name"] else "default"
-
-    # Construct the query
-    query = f'kminion_kafka_topic_high_water_mark_sum{{namespace="{namespace}", topic_name="input", experiment_started_ts="{latest_exp["started_ts"]}"}}'
-
-    try:
-        # Get the data from Prometheus
-        data = MetricRangeDataFrame(
-            prom.get_metric_range_data(
-                query,
-                start_time=started_ts,
-                end_time=stopped_ts,
-            )
-        )
-
-        # Calculate the observed throughput
-        max_watermark = data["value"].max()
-        duration = (stopped_ts - started_ts).total_seconds()
-        try:
-            duration = latest_exp["experiment_metadata"]["factors"]["exp_params"][
-                "durationSeconds"
-            ]
-        except KeyError:
-            pass
+        return None
+
+    params = latest_exp["experiment_metadata"]["factors"]["exp_params"]
+    return dict(
+        exp_name=latest_exp["exp_name"],
+        started_ts=latest_exp["started_ts"],
+        stopped_ts=latest_exp["stopped_ts"],
+        topic_name=params.get("topic_name", "input"),
+        durationSeconds=params.get("durationSeconds"),
+        watermark_baseline=params.get("watermark_baseline", 0),
+    )
 
-        observed_throughput = max_watermark / duration
 
-        logging.warning({"observed_throughput": observed_throughput})
-        return observed_throughput
+def get_observed_throughput_of_last_experiment(
+    minimum_current_ts: pendulum.DateTime,
+) -> float:
+    from .utils import observed_throughput_of
 
-    except KeyError:
-        print("No data found for the latest experiment")
-        raise
+    return observed_throughput_of(last_experiment(minimum_current_ts))
 
 
 def process_experiment(exp: Document) -> dict[str, Any]:
@@ -126,6 +143,8 @@ def process_experiment(exp: Document) -> dict[str, Any]:
         "bw",
         "broker_replicas",
         "cluster",
+        "topic_name",
+        "watermark_baseline",
     ]
 
     result = {
@@ -152,25 +171,21 @@ def process_experiment(exp: Document) -> dict[str, Any]:
 
 
 def filter_experiments(
-    experiments: dict[int, Document],
+    experiments: Union[ExperimentIndex, dict[int, Document]],
     filter_condition: Callable[[Document], bool],
     *,
     cutoff_begin: str,
     cutoff_end: str,
 ) -> pd.DataFrame:
-    cutoff_begin_date = pendulum.parse(cutoff_begin)
-    cutoff_end_date = pendulum.parse(cutoff_end)
+    if not isinstance(experiments, ExperimentIndex):
+        experiments = ExperimentIndex(experiments)
 
     filtered_experiments = [
         process_experiment(exp)
-        for exp in sorted(
-            experiments.values(),
-            key=lambda x: pendulum.parse(x["started_ts"]),
-            reverse=True,
+        for exp in experiments.between(
+            pendulum.parse(cutoff_begin), pendulum.parse(cutoff_end)
         )
-        if pendulum.parse(exp["started_ts"]) >= cutoff_begin_date
-        and cutoff_end_date >= pendulum.parse(exp["started_ts"])
-        and filter_condition(exp)
+        if filter_condition(exp)
     ]
 
     return pd.DataFrame(filtered_experiments).set_index("exp_id")
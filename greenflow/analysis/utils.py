@@ -1,36 +1,135 @@
 from prometheus_api_client import PrometheusConnect, MetricRangeDataFrame
 from prometheus_api_client.utils import parse_datetime
+import logging
+import numpy as np
 import pandas as pd
 import pendulum
 from tinydb import TinyDB, Query
 from os import getenv
+from collections import defaultdict
+from typing import Callable, NamedTuple, Optional
 
-from .tiny import get_experiments
+from .tiny import get_experiments, get_experiment_index
 from .tiny import filter_experiments
 from .tiny import interest
 from .cache import cache
+from .promclient import url, prom, RangeQuery, fetch_all, query_cache, INSTANT, AUTO
+from .promclient import error_status
+from .metrics import registry, stats, push_stats
+from . import archive as archived
 
 
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-url = getenv("PROMETHEUS_URL")
-prom = PrometheusConnect(url=url)
 
+def fetch(query: RangeQuery) -> list:
+    return query_cache.cached(query, fetch_uncached)
 
-def get_observed_throughput_of_last_experiment(
-    minimum_current_ts: pendulum.DateTime,
-) -> float:
+
+def fetch_uncached(query: RangeQuery) -> list:
+    if query.step == AUTO:
+        # Chunks of long windows are fetched concurrently, and counted there
+        result = fetch_all({query: query}, cache=None)[query]
+        if isinstance(result, Exception):
+            raise result
+        return result
+    if query.step in (None, INSTANT):
+        endpoint = "/api/v1/query"
+    else:
+        endpoint = "/api/v1/query_range"
+    with registry.timer("prometheus_query_seconds", endpoint=endpoint):
+        try:
+            result = fetch_sync(query)
+        except Exception as e:
+            registry.inc(
+                "prometheus_queries_total", endpoint=endpoint, status=error_status(e)
+            )
+            raise
+    # PrometheusConnect only returns results of successful responses
+    registry.inc("prometheus_queries_total", endpoint=endpoint, status=200)
+    return result
+
+
+def fetch_sync(query: RangeQuery) -> list:
+    if query.step == INSTANT:
+        return prom.custom_query(
+            query.query, params={"time": query.end_time.timestamp()}
+        )
+    if query.step is None:
+        return prom.get_metric_range_data(
+            query.query, start_time=query.start_time, end_time=query.end_time
+        )
+    return prom.custom_query_range(
+        query.query,
+        start_time=query.start_time,
+        end_time=query.end_time,
+        step=query.step,
+    )
+
+
+def get_last_experiment(minimum_current_ts: pendulum.DateTime) -> Optional[dict]:
+    """
+    Identifiers of the latest experiment stored since minimum_current_ts, None
+    if there is none. Reads the storage, so call it from the thread writing it
+    """
     import greenflow
 
     if greenflow.g.g.storage_type == "tinydb":
-        from .tiny import get_observed_throughput_of_last_experiment
+        from .tiny import last_experiment
 
-        return get_observed_throughput_of_last_experiment(minimum_current_ts)
+        return last_experiment(minimum_current_ts)
     elif greenflow.g.g.storage_type == "mongo":
-        from .mongo import get_observed_throughput_of_last_experiment
+        from .mongo import last_experiment
+
+        return last_experiment(minimum_current_ts)
+
+
+def observed_throughput_of(experiment: Optional[dict]) -> float:
+    """Observed throughput of an experiment from get_last_experiment"""
+    from .promclient import wait_for_samples, watermark_query
+
+    if experiment is None:
+        return float("NaN")
+    started_ts = pendulum.parse(experiment["started_ts"])
+    stopped_ts = pendulum.parse(experiment["stopped_ts"])
+    query = watermark_query(
+        experiment["exp_name"], experiment["started_ts"], experiment["topic_name"]
+    )
+
+    # Wait until the samples up to the end of the load are queryable
+    duration = experiment["durationSeconds"]
+    load_ended = started_ts.add(seconds=float(duration or 0))
+    wait_for_samples(query, after=min(load_ended, stopped_ts))
+
+    try:
+        data = MetricRangeDataFrame(
+            prom.get_metric_range_data(
+                query,
+                start_time=started_ts,
+                end_time=stopped_ts,
+            )
+        )
+        # Reused topics start from where they were truncated
+        max_watermark = data["value"].max() - experiment["watermark_baseline"]
+        if not duration:
+            duration = (stopped_ts - started_ts).total_seconds()
+
+        observed_throughput = max_watermark / duration
+
+        logging.warning({"observed_throughput": observed_throughput})
+        return observed_throughput
+
+    except KeyError:
+        logging.error("No data found for the latest experiment")
+        logging.error("Query used was %s", query)
+        raise
 
-        return get_observed_throughput_of_last_experiment(minimum_current_ts)
+
+def get_observed_throughput_of_last_experiment(
+    minimum_current_ts: pendulum.DateTime,
+) -> float:
+    return observed_throughput_of(get_last_experiment(minimum_current_ts))
 
 
 def full_analytical_pipeline(
@@ -39,6 +138,9 @@ def full_analytical_pipeline(
     cutoff_end=None,
     cluster=None,
     type=None,
+    batched=True,
+    archive=False,
+    scalar=False,
     **kwargs,
 ):
     import greenflow
@@ -49,18 +151,20 @@ def full_analytical_pipeline(
         cutoff_end = pendulum.now().to_iso8601_string()
 
     if greenflow.g.g.storage_type == "tinydb":
-        experiments = get_experiments()
+        experiments = get_experiment_index()
         redpanda_kafka_data = filter_experiments(
             experiments,
             interest(cluster=cluster, type=type, **kwargs),
             cutoff_begin=cutoff_begin,
             cutoff_end=cutoff_end,
         )
-        redpanda_kafka_data = enrich_dataframe(redpanda_kafka_data)
+        redpanda_kafka_data = enrich_dataframe(
+            redpanda_kafka_data, batched=batched, archive=archive, scalar=scalar
+        )
         return redpanda_kafka_data
     else:
         from ..g import g
-        from ..mongo_storage import ExpStorage, Experiment
+        from ..mongo_storage import ExpStorage
 
         storage: ExpStorage = g.storage
         query = {
@@ -74,78 +178,93 @@ def full_analytical_pipeline(
         for k, v in kwargs.items():
             query[f"experiment_metadata.factors.exp_params.{k}"] = v
 
-        matching_experiments = storage.collection.find(
-            query,
-            sort=[("started_ts", -1)],
-            # limit=1,
-        ).to_list()
-
-        # Get all _ids from matching experiments
-        all_ids = [exp_doc["_id"] for exp_doc in matching_experiments]
-
-        # Perform a batch query to get _ids that already have enriched results
-        existing_results = storage.results_collection.find(
-            {"_id": {"$in": all_ids}}, {"_id": 1}  # Project only the _id field
-        ).to_list(None)
-
-        # Extract the _ids of experiments that already have enriched results
-        enriched_ids = {result["_id"] for result in existing_results}
-
-        # Identify experiments that need to be enriched
-        ids_to_enrich = set(all_ids) - enriched_ids
-
-        # Filter experiments to enrich
-        experiments_to_enrich = [
-            exp_doc
-            for exp_doc in matching_experiments
-            if exp_doc["_id"] in ids_to_enrich
-        ]
+        # Flat rows computed by the server, along with their stored results
+        rows = storage.find_analysis_rows(query)
 
         # List to store all enriched experiments (existing and newly enriched)
         all_enriched_experiments = []
 
-        # Retrieve existing enriched results
-        existing_enriched_results = storage.results_collection.find(
-            {"_id": {"$in": list(enriched_ids)}}
-        ).to_list(None)
-
-        # Add existing enriched results to the list
-        all_enriched_experiments.extend(existing_enriched_results)
-
-        # Enrich and store new results
-        for exp_doc in experiments_to_enrich:
-            exp_id = exp_doc["_id"]
-
-            # Enrich the experiment data
-            experiment = Experiment.from_doc(exp_doc)
-            exp_dict = experiment.to_dict()
-            df = pd.DataFrame([exp_dict])
-            df["_id"] = exp_id  # Include the _id field
+        # Group experiments by the calculations that are missing or outdated in
+        # their stored results, so only those columns get recomputed
+        experiments_to_enrich = defaultdict(list)
+        for row in rows:
+            stored = row.pop("stored")
+            stale = stale_calculations(recorded_versions(stored), stored=stored)
+            # Whether the stored results saved recomputing each calculation
+            for name in ENABLED_CALCULATIONS:
+                registry.inc(
+                    "enriched_results_total",
+                    calculation=name,
+                    state="stale" if name in stale else "fresh",
+                )
+            if stale:
+                experiments_to_enrich[tuple(stale)].append((row, stored))
+            else:
+                all_enriched_experiments.append(stored)
+
+        # Enrich each group together so that the batched queries cover every
+        # one of its experiments in a single round trip per metric
+        enriched_rows = []
+        for stale, group in experiments_to_enrich.items():
+            stale_columns = {
+                column for name in stale for column in CALCULATIONS[name].columns
+            }
+            df = pd.DataFrame(
+                [
+                    {
+                        **{
+                            k: v
+                            for k, v in (stored or {}).items()
+                            if k not in stale_columns
+                        },
+                        **row,
+                        # Stale ones are recorded once they are produced below
+                        "calculation_versions": {
+                            name: version
+                            for name, version in recorded_versions(stored).items()
+                            if name not in stale
+                        },
+                    }
+                    for row, stored in group
+                ]
+            )
             df.set_index("_id", inplace=True)
-            enriched_df = enrich_dataframe(df)
-
-            # Convert the enriched dataframe back to a dictionary
-            enriched_data = enriched_df.reset_index().iloc[0].to_dict()
-
-            # Ensure that the _id field is correctly set
-            enriched_data["_id"] = exp_id
-
-            # Handle non-serializable data (convert ObjectId to string if necessary)
-            enriched_data_serializable = ensure_serializable(enriched_data)
-
-            # Remove _id from the update data since it's immutable
-            if "_id" in enriched_data_serializable:
-                del enriched_data_serializable["_id"]
-
-            # Use update_one with upsert=True instead of insert_one
-            storage.results_collection.update_one(
-                {"_id": exp_id},  # filter
-                {"$set": enriched_data_serializable},  # update (without _id field)
-                upsert=True,  # create if doesn't exist
+            failures = defaultdict(set)
+            enriched_df = enrich_dataframe(
+                df,
+                batched=batched,
+                archive=archive,
+                scalar=scalar,
+                calculations=[CALCULATIONS[name].function for name in stale],
+                failures=failures,
             )
-
-            # Add to the list of all enriched experiments
-            all_enriched_experiments.append(enriched_data)
+            for enriched in enriched_df.reset_index().to_dict("records"):
+                failed = [
+                    name
+                    for name in stale
+                    if enriched["_id"] in failures[CALCULATIONS[name].function]
+                ]
+                enriched["calculation_versions"] = {
+                    **enriched["calculation_versions"],
+                    **produced_versions(stale, failed),
+                }
+                enriched_rows.append(enriched)
+
+        # Store new results in bulk
+        if enriched_rows:
+            timings = storage.upsert_results(
+                # Keep the ObjectId, ensure_serializable turns it into a string
+                [
+                    {**ensure_serializable(row), "_id": row["_id"]}
+                    for row in enriched_rows
+                ]
+            )
+            print(
+                f"Stored {len(enriched_rows)} results in {len(timings)} bulk writes, "
+                f"{sum(t['seconds'] for t in timings):.2f}s "
+                f"(slowest {max(t['seconds'] for t in timings):.2f}s)"
+            )
+        all_enriched_experiments.extend(enriched_rows)
 
         # Convert the list of all enriched experiments to a dataframe
         redpanda_kafka_data = pd.DataFrame(all_enriched_experiments)
@@ -162,11 +281,7 @@ def get_time_range(row: pd.Series, buffer_minutes: int = 1):
     return started_ts, stopped_ts
 
 
-def calculate_network_saturation(row: pd.Series):
-    """Calculate the average network saturation during the experiment duration"""
-    started_ts = pendulum.parse(row["started_ts"])
-    stopped_ts = pendulum.parse(row["stopped_ts"])
-
+def network_saturation_query(row: pd.Series) -> RangeQuery:
     query = f"""
     max_over_time(
     max(
@@ -180,14 +295,57 @@ def calculate_network_saturation(row: pd.Series):
     )[1m]
     )
     """
+    return RangeQuery(
+        query,
+        start_time=pendulum.parse(row["started_ts"]),
+        end_time=pendulum.parse(row["stopped_ts"]),
+        step=AUTO,
+    )
 
-    try:
-        data = prom.custom_query_range(
-            query,
-            start_time=started_ts,
-            end_time=stopped_ts,
-            step="5s",
+
+def scalar_window(row: pd.Series, margin_seconds: int = 0) -> str:
+    """Lookbehind covering the experiment, plus margin, for *_over_time queries"""
+    duration = pendulum.parse(row["stopped_ts"]) - pendulum.parse(row["started_ts"])
+    return f"{int(duration.total_seconds()) + margin_seconds}s"
+
+
+def as_matrix(data: list) -> list:
+    """
+    Instant vector as a matrix of one sample per series, so that the reducers of
+    range queries also take scalar query results
+    """
+    return [
+        (
+            {"metric": series["metric"], "values": [series["value"]]}
+            if "value" in series
+            else series
         )
+        for series in data
+    ]
+
+
+def network_saturation_scalar_query(row: pd.Series) -> RangeQuery:
+    """Maximum of the range query above, computed by the TSDB at stopped_ts"""
+    # Every 5s point of the range query looks 1m back
+    query = f"""
+    max_over_time(
+    max(
+        max by (device, node) (
+        (
+            irate(node_network_receive_bytes_total{{device=~"e.*", experiment_started_ts="{row['started_ts']}"}}[15s])
+        )
+        / on(device, node)
+        (node_network_speed_bytes{{device=~"e.*", experiment_started_ts="{row['started_ts']}"}})
+        )
+    )[{scalar_window(row, 60)}:5s]
+    )
+    """
+    stopped_ts = pendulum.parse(row["stopped_ts"])
+    return RangeQuery(query, stopped_ts, stopped_ts, step=INSTANT)
+
+
+def network_saturation_from(row: pd.Series, data: list):
+    try:
         data = MetricRangeDataFrame(data)
     except KeyError:
         row["network_saturation"] = float("NaN")
@@ -203,11 +361,12 @@ def calculate_network_saturation(row: pd.Series):
     return row
 
 
-def calculate_disk_throughput(row: pd.Series):
-    """Calculate the average disk throughput (MBps) during the experiment duration"""
-    started_ts = pendulum.parse(row["started_ts"])
-    stopped_ts = pendulum.parse(row["stopped_ts"])
+def calculate_network_saturation(row: pd.Series):
+    """Calculate the average network saturation during the experiment duration"""
+    return network_saturation_from(row, fetch(network_saturation_query(row)))
 
+
+def disk_throughput_query(row: pd.Series) -> RangeQuery:
     query = f"""
     max_over_time(
     sum(
@@ -216,14 +375,29 @@ def calculate_disk_throughput(row: pd.Series):
     )[1m]
     )
     """
+    return RangeQuery(
+        query,
+        start_time=pendulum.parse(row["started_ts"]),
+        end_time=pendulum.parse(row["stopped_ts"]),
+        step=AUTO,
+    )
+
+
+def disk_throughput_scalar_query(row: pd.Series) -> RangeQuery:
+    query = f"""
+    max_over_time(
+    sum(
+        irate(node_disk_read_bytes_total{{device=~"nvme.*|sd.*", experiment_started_ts="{row['started_ts']}"}}[15s]) +
+        irate(node_disk_written_bytes_total{{device=~"nvme.*|sd.*", experiment_started_ts="{row['started_ts']}"}}[15s])
+    )[{scalar_window(row, 60)}:5s]
+    )
+    """
+    stopped_ts = pendulum.parse(row["stopped_ts"])
+    return RangeQuery(query, stopped_ts, stopped_ts, step=INSTANT)
+
 
+def disk_throughput_from(row: pd.Series, data: list):
     try:
-        data = prom.custom_query_range(
-            query,
-            start_time=started_ts,
-            end_time=stopped_ts,
-            step="5s",
-        )
         data = MetricRangeDataFrame(data)
     except KeyError:
         row["disk_throughput_MBps"] = float("NaN")
@@ -239,24 +413,27 @@ def calculate_disk_throughput(row: pd.Series):
     return row
 
 
-def calculate_disk_utilization(row: pd.Series):
-    """Calculate the disk utilization (percentage of time the device was busy)"""
-    started_ts = pendulum.parse(row["started_ts"])
-    stopped_ts = pendulum.parse(row["stopped_ts"])
+def calculate_disk_throughput(row: pd.Series):
+    """Calculate the average disk throughput (MBps) during the experiment duration"""
+    return disk_throughput_from(row, fetch(disk_throughput_query(row)))
+
 
+def disk_utilization_query(row: pd.Series) -> RangeQuery:
     query = f"""
     max(
         rate(node_disk_written_bytes_total{{device=~"nvme.*|sd.*", experiment_started_ts="{row['started_ts']}"}}[1m])
     )
     """
+    return RangeQuery(
+        query,
+        start_time=pendulum.parse(row["started_ts"]),
+        end_time=pendulum.parse(row["stopped_ts"]),
+        step=AUTO,
+    )
+
 
+def disk_utilization_from(row: pd.Series, data: list):
     try:
-        data = prom.custom_query_range(
-            query,
-            start_time=started_ts,
-            end_time=stopped_ts,
-            step="5s",
-        )
         data = MetricRangeDataFrame(data)
     except KeyError:
         row["disk_utilization"] = float("NaN")
@@ -272,6 +449,11 @@ def calculate_disk_utilization(row: pd.Series):
     return row
 
 
+def calculate_disk_utilization(row: pd.Series):
+    """Calculate the disk utilization (percentage of time the device was busy)"""
+    return disk_utilization_from(row, fetch(disk_utilization_query(row)))
+
+
 # TODO: Add CPU
 # 100 - (avg by (node) (irate(node_cpu_seconds_total{mode="idle"}[1m])) * 100)
 
@@ -283,28 +465,32 @@ def create_qgrid_widget(df: pd.DataFrame):
     return qgrid_widget
 
 
-def calculate_observed_throughput(row: pd.Series):
+def observed_throughput_query(row: pd.Series) -> Optional[RangeQuery]:
+    if row.load == 0:
+        return None
+    query = f'kminion_kafka_topic_high_water_mark_sum{{namespace="{"redpanda" if "redpanda" in row["exp_name"] else "default"}", topic_name="{archived.topic_name(row)}", experiment_started_ts="{row["started_ts"]}"}}'
+    return RangeQuery(
+        query,
+        start_time=pendulum.parse(row["started_ts"]),
+        end_time=pendulum.parse(row["stopped_ts"]),
+    )
+
+
+def observed_throughput_from(row: pd.Series, data: Optional[list]):
     started_ts = pendulum.parse(row["started_ts"])
     stopped_ts = pendulum.parse(row["stopped_ts"])
 
-    query = f'kminion_kafka_topic_high_water_mark_sum{{namespace="{"redpanda" if "redpanda" in row["exp_name"] else "default"}", topic_name="input", experiment_started_ts="{row["started_ts"]}"}}'
     if row.load == 0:
         return row
     try:
-        data = MetricRangeDataFrame(
-            prom.get_metric_range_data(
-                query,
-                start_time=started_ts,
-                end_time=stopped_ts,
-            )
-        )
+        data = MetricRangeDataFrame(data)
     except KeyError:
         # Return the original row if no data is found
         breakpoint()
         return row
 
     # get the highest watermark using max- Represents the number of messages in the partition
-    max_watermark = data["value"].max()
+    max_watermark = data["value"].max() - archived.watermark_baseline(row)
     duration = (stopped_ts - started_ts).total_seconds()
     duration = row["durationSeconds"] if "durationSeconds" in row else duration
 
@@ -315,6 +501,11 @@ def calculate_observed_throughput(row: pd.Series):
     return row
 
 
+def calculate_observed_throughput(row: pd.Series):
+    query = observed_throughput_query(row)
+    return observed_throughput_from(row, fetch(query) if query else None)
+
+
 def calculate_throughput_MBps(row: pd.Series):
     """
     Calculate the throughput in megabytes per second (MBps).
@@ -348,19 +539,24 @@ def calculate_throughput_gap(row: pd.Series):
     return row
 
 
-def calculate_latency(row: pd.Series):
+def latency_query(row: pd.Series) -> RangeQuery:
     started_ts, stopped_ts = get_time_range(row)
 
     query = f'histogram_quantile(0.99, sum(rate(kminion_end_to_end_roundtrip_latency_seconds_bucket{{namespace="{"redpanda" if "redpanda" in row["exp_name"] else "default"}", experiment_started_ts="{row["started_ts"]}"}})) by (le))'
+    return RangeQuery(
+        query,
+        start_time=started_ts.subtract(minutes=5),
+        end_time=stopped_ts.add(minutes=5),
+        step=AUTO,
+    )
+
+
+def latency_from(row: pd.Series, data: list):
     try:
-        data = prom.custom_query_range(
-            query,
-            start_time=started_ts.subtract(minutes=5),
-            end_time=stopped_ts.add(minutes=5),
-            step="5s", 
-        )
         data = MetricRangeDataFrame(data)
     except KeyError:
+        # No samples in the window, as for samples without a value below
+        row["latency_p99"] = 0
         return row
 
     data = data[data["value"].notna()]
@@ -379,6 +575,10 @@ def calculate_latency(row: pd.Series):
     return row
 
 
+def calculate_latency(row: pd.Series):
+    return latency_from(row, fetch(latency_query(row)))
+
+
 def calculate_throughput_per_watt(row: pd.Series):
     """Use the average power consumption to calculate the throughput per watt"""
     throughput_per_watt = row["throughput_MBps"] / row["average_power"]
@@ -387,7 +587,7 @@ def calculate_throughput_per_watt(row: pd.Series):
     return row
 
 
-def calculate_average_power(row: pd.Series):
+def average_power_query(row: pd.Series) -> RangeQuery:
     """
     sum(scaph_host_power_microwatts{experiment_started_ts="$Experiment"}[5s]) / 10^6
     """
@@ -399,17 +599,27 @@ def calculate_average_power(row: pd.Series):
     query = f'sum(scaph_host_power_microwatts{{experiment_started_ts="{row["started_ts"]}"}}) / 10^6'
     # if started_ts < pendulum.now().subtract(hours=4):
     #     print(query, started_ts, stopped_ts)
+    return RangeQuery(
+        query,
+        start_time=started_ts.subtract(minutes=1),
+        end_time=stopped_ts.add(minutes=1),
+        step=AUTO,
+    )
+
+
+def average_power_scalar_query(row: pd.Series) -> RangeQuery:
+    """Mean of the range query above, computed by the TSDB"""
+    query = f'avg_over_time((sum(scaph_host_power_microwatts{{experiment_started_ts="{row["started_ts"]}"}}) / 10^6)[{scalar_window(row, 120)}:5s])'
+    at = pendulum.parse(row["stopped_ts"]).add(minutes=1)
+    return RangeQuery(query, at, at, step=INSTANT)
+
+
+def average_power_from(row: pd.Series, data: list):
     try:
-        data = prom.custom_query_range(
-            query,
-            start_time=started_ts.subtract(minutes=1),
-            end_time=stopped_ts.add(minutes=1),
-            step="5s",
-            # params={"step": "5s"},
-        )
         data = MetricRangeDataFrame(data)
     except KeyError:
-        row["average_power"] = float("NaN")
+        # No samples in the window
+        row["average_power"] = 0
         return row
 
     if not data.empty:
@@ -423,39 +633,67 @@ def calculate_average_power(row: pd.Series):
     return row
 
 
-def calculate_energy_cost(row: pd.Series):
+def calculate_average_power(row: pd.Series):
+    return average_power_from(row, fetch(average_power_query(row)))
+
+
+def load_idle_power_table(version: Optional[int] = None) -> pd.DataFrame:
+    """
+    Idle power baselines from the experiment store, latest version unless pinned.
+    Falls back to the built-in table when no storage is configured.
+    """
+    import greenflow.g
+    from ..idle_power import DEFAULT_IDLE_POWER, idle_power_doc
+
+    try:
+        storage = greenflow.g.g.storage
+    except AttributeError:
+        doc = idle_power_doc(DEFAULT_IDLE_POWER, version=1)
+    else:
+        doc = storage.get_idle_power(version)
+
+    table = pd.DataFrame(doc["entries"], columns=["cluster", "exp_name", "idle_power"])
+    table.attrs["version"] = doc["version"]
+    return table
+
+
+def idle_power_base(df: pd.DataFrame, table: pd.DataFrame) -> np.ndarray:
+    """Per node idle power of each row, NaN for unknown cluster/broker pairs"""
+    keys = df[["cluster", "exp_name"]].reset_index(drop=True)
+    exact = keys.merge(
+        table.dropna(subset=["exp_name"]).drop_duplicates(
+            ["cluster", "exp_name"], keep="last"
+        ),
+        on=["cluster", "exp_name"],
+        how="left",
+    )["idle_power"]
+    any_broker = keys.merge(
+        table[table["exp_name"].isna()]
+        .drop(columns="exp_name")
+        .drop_duplicates("cluster", keep="last"),
+        on="cluster",
+        how="left",
+    )["idle_power"]
+    base = exact.fillna(any_broker)
+    # Clusters without any baseline have nothing to discount
+    return base.where(keys["cluster"].isin(table["cluster"]), 0).to_numpy(dtype=float)
+
+
+def calculate_energy_cost(row: pd.Series, idle_power: Optional[pd.DataFrame] = None):
     """
     Calculate the energy cost in USD
     """
     if row["throughput_MBps"] == 0:
         row["energy_cost"] = 0
         return row
-    # idle_power = 0
-    if row.cluster == "taurus":
-        if row.exp_name == "ingest-redpanda":
-            idle_power_base = 31.63
-        elif row.exp_name == "ingest-kafka":
-            idle_power_base = 32.63
-    elif row.cluster == "grappe":
-        if row.exp_name == "ingest-redpanda":
-            idle_power_base = 115.5 / 3
-        elif row.exp_name == "ingest-kafka":
-            idle_power_base = 123.87 / 3
-    elif row.cluster == "ovhnvme":
-        if row.exp_name == "ingest-redpanda":
-            idle_power_base = 19.9
-        elif row.exp_name == "ingest-kafka":
-            idle_power_base = 20.5
-    elif row.cluster == "ecotype":
-        idle_power_base = 28.3
-    elif row.cluster == "parasilo":
-        idle_power_base = 28.3
-    elif row.cluster == "parasilohdd":
-        idle_power_base = 28.3
-    else:
-        idle_power_base = 0
+    if idle_power is None:
+        idle_power = load_idle_power_table()
 
-    idle_power = idle_power_base * (row.num_broker_nodes - row.broker_replicas)
+    base = idle_power_base(row.to_frame().T, idle_power)[0]
+    if np.isnan(base):
+        raise KeyError(f"No idle power for {row.exp_name} on {row.cluster}")
+
+    idle_power = base * (row.num_broker_nodes - row.broker_replicas)
 
     row["adjusted_power"] = row["average_power"] - idle_power
     if row.average_power < 0:
@@ -478,40 +716,604 @@ def convert_broker_cpu(row: pd.Series):
         return row
 
 
-def enrich_dataframe(df):
-    calculations = [
-        calculate_observed_throughput,
-        calculate_latency,
-        calculate_average_power,
+def numeric_column(df: pd.DataFrame, column: str, default=None):
+    """
+    Column as floats, plus a mask of the rows where it is unusable: present but
+    not a number, or missing altogether when no default is given
+    """
+    if column not in df:
+        return (
+            pd.Series(default, index=df.index, dtype=float),
+            pd.Series(default is None, index=df.index),
+        )
+    values = pd.to_numeric(df[column], errors="coerce").astype(float)
+    return values, values.isna() & df[column].notna()
+
+
+def vectorized_throughput_MBps(df: pd.DataFrame):
+    messageSize_bytes, invalid_size = numeric_column(df, "messageSize", 0)
+    observed_throughput, invalid_throughput = numeric_column(
+        df, "observed_throughput", 0
+    )
+
+    df["throughput_MBps"] = observed_throughput * messageSize_bytes / 1024 / 1024
+    df["adjusted_network_throughput"] = df["throughput_MBps"] * 1.45
+    return df, invalid_size | invalid_throughput
+
+
+def vectorized_throughput_gap(df: pd.DataFrame):
+    expected_throughput, invalid = numeric_column(df, "load")
+    observed_throughput, _ = numeric_column(df, "observed_throughput", float("NaN"))
+
+    throughput_gap = observed_throughput - expected_throughput
+    df["throughput_gap_percentage"] = (
+        throughput_gap / expected_throughput.where(expected_throughput != 0)
+    ) * 100
+    return df, invalid
+
+
+def vectorized_throughput_per_watt(df: pd.DataFrame):
+    throughput_MBps, invalid_throughput = numeric_column(df, "throughput_MBps")
+    average_power, invalid_power = numeric_column(df, "average_power")
+
+    zero_power = average_power == 0
+    df["throughput_per_watt"] = throughput_MBps / average_power.where(~zero_power)
+    return df, invalid_throughput | invalid_power | zero_power
+
+
+def vectorized_energy_cost(df: pd.DataFrame, idle_power: Optional[pd.DataFrame] = None):
+    if idle_power is None:
+        idle_power = load_idle_power_table()
+    df["idle_power_version"] = idle_power.attrs.get("version")
+
+    throughput_MBps, invalid_throughput = numeric_column(df, "throughput_MBps")
+    average_power, invalid_power = numeric_column(df, "average_power")
+    idle_power = idle_power_base(df, idle_power) * (
+        df["num_broker_nodes"] - df["broker_replicas"]
+    )
+
+    no_throughput = throughput_MBps == 0
+    unknown_idle_power = ~no_throughput & np.isnan(idle_power)
+    negative_power = ~no_throughput & (average_power < 0)
+    computed = ~(no_throughput | unknown_idle_power)
+
+    if "adjusted_power" not in df:
+        df["adjusted_power"] = float("NaN")
+    if "energy_cost" not in df:
+        df["energy_cost"] = float("NaN")
+    adjusted_power = average_power - idle_power
+    df["adjusted_power"] = df["adjusted_power"].where(~computed, adjusted_power)
+    df["energy_cost"] = (
+        df["energy_cost"]
+        .where(~computed, adjusted_power / throughput_MBps)
+        .mask(no_throughput | negative_power, 0)
+    )
+    invalid = invalid_throughput | (~no_throughput & invalid_power)
+    return df, invalid | unknown_idle_power | negative_power
+
+
+def vectorized_broker_cpu(df: pd.DataFrame):
+    broker_cpu = pd.to_numeric(df["broker_cpu"], errors="coerce")
+    converted = broker_cpu.notna()
+    if converted.all():
+        df["broker_cpu"] = broker_cpu.astype(int)
+    else:
+        df["broker_cpu"] = df["broker_cpu"].astype(object)
+        df.loc[converted, "broker_cpu"] = broker_cpu[converted].astype(int)
+    return df, ~converted
+
+
+# Pure arithmetic calculations, computed on whole columns at once. Each returns
+# the dataframe and a mask of the rows it could not compute, which is kept in
+# the named error column instead of being printed
+VECTORIZED_CALCULATIONS = {
+    calculate_throughput_MBps: (vectorized_throughput_MBps, "throughput_MBps_error"),
+    calculate_throughput_gap: (vectorized_throughput_gap, "throughput_gap_error"),
+    calculate_throughput_per_watt: (
+        vectorized_throughput_per_watt,
+        "throughput_per_watt_error",
+    ),
+    calculate_energy_cost: (vectorized_energy_cost, "energy_cost_error"),
+    convert_broker_cpu: (vectorized_broker_cpu, "broker_cpu_error"),
+}
+
+
+def get_namespace(exp_name: pd.Series) -> np.ndarray:
+    return np.where(exp_name.str.contains("redpanda"), "redpanda", "default")
+
+
+def get_topic_name(df: pd.DataFrame) -> np.ndarray:
+    """Topic of each experiment, see archive.topic_name"""
+    if "topic_name" not in df:
+        return np.full(len(df), "input", dtype=object)
+    return df["topic_name"].fillna("input").to_numpy(dtype=object)
+
+
+def get_watermark_baseline(df: pd.DataFrame) -> np.ndarray:
+    """See archive.watermark_baseline"""
+    if "watermark_baseline" not in df:
+        return np.zeros(len(df))
+    return pd.to_numeric(df["watermark_baseline"]).fillna(0).to_numpy(dtype=float)
+
+
+def get_batch_window(df: pd.DataFrame, buffer_minutes: int = 5):
+    """
+    Covers every experiment in the dataframe with a single lookbehind window,
+    evaluated at the end of the last experiment
+    """
+    started_ts = pd.to_datetime(df["started_ts"], utc=True, format="ISO8601").min()
+    stopped_ts = pd.to_datetime(df["stopped_ts"], utc=True, format="ISO8601").max()
+    started_ts = pendulum.instance(started_ts.to_pydatetime()).subtract(
+        minutes=buffer_minutes
+    )
+    stopped_ts = pendulum.instance(stopped_ts.to_pydatetime()).add(
+        minutes=buffer_minutes
+    )
+    window = f"{int((stopped_ts - started_ts).total_seconds()) + 1}s"
+    return stopped_ts, window
+
+
+# Longest span a batched query may cover. Subqueries are evaluated every 5s and
+# VictoriaMetrics refuses more than 100k points per series by default, ~5.8 days
+MAX_BATCH_SECONDS = 4 * 24 * 3600
+
+
+def batch_groups(
+    df: pd.DataFrame,
+    buffer_minutes: int = 5,
+    max_seconds: float = MAX_BATCH_SECONDS,
+) -> list[pd.Index]:
+    """
+    Split the rows, in order of start, into clusters of experiments whose batch
+    window stays within max_seconds
+    """
+    started_ts = pd.to_datetime(df["started_ts"], utc=True, format="ISO8601")
+    stopped_ts = pd.to_datetime(df["stopped_ts"], utc=True, format="ISO8601")
+    max_span = pd.Timedelta(seconds=max_seconds - 2 * 60 * buffer_minutes)
+    groups, group, first, last = [], [], None, None
+    for index in started_ts.sort_values(kind="stable").index:
+        if group and max(last, stopped_ts[index]) - first > max_span:
+            groups.append(pd.Index(group))
+            group = []
+        if not group:
+            first, last = started_ts[index], stopped_ts[index]
+        group.append(index)
+        last = max(last, stopped_ts[index])
+    if group:
+        groups.append(pd.Index(group))
+    return groups
+
+
+def batch_query(query: str, at: pendulum.DateTime, by=("experiment_started_ts",)):
+    """Run an instant query and return one row per series, keyed by the `by` labels"""
+    data = query_cache.cached(
+        RangeQuery(query, at, at, step=INSTANT),
+        lambda q: prom.custom_query(q.query, params={"time": at.timestamp()}),
+    )
+    return pd.DataFrame(
+        [
+            {
+                **{label: series["metric"].get(label) for label in by},
+                "value": float(series["value"][1]),
+            }
+            for series in data
+        ],
+        columns=[*by, "value"],
+    )
+
+
+def join_batch(data: pd.DataFrame, keys: list, fill=float("NaN")) -> np.ndarray:
+    """
+    Align the values of a batch query onto the rows of df, fill where missing
+    or without a value
+    """
+    values = data.set_index(list(data.columns[:-1]))["value"]
+    if len(keys) == 1:
+        index = pd.Index(keys[0])
+    else:
+        index = pd.MultiIndex.from_arrays(keys)
+    return values.reindex(index).fillna(fill).to_numpy(dtype=float)
+
+
+def batch_observed_throughput(df: pd.DataFrame, at, window):
+    query = f"max by (experiment_started_ts, namespace, topic_name) (max_over_time(kminion_kafka_topic_high_water_mark_sum[{window}]))"
+    data = batch_query(
+        query, at, by=("experiment_started_ts", "namespace", "topic_name")
+    )
+    max_watermark = join_batch(
+        data,
+        [df["started_ts"], get_namespace(df["exp_name"]), get_topic_name(df)],
+    )
+    max_watermark = max_watermark - get_watermark_baseline(df)
+
+    duration = (
+        pd.to_datetime(df["stopped_ts"], utc=True, format="ISO8601")
+        - pd.to_datetime(df["started_ts"], utc=True, format="ISO8601")
+    ).dt.total_seconds()
+    if "durationSeconds" in df:
+        duration = pd.to_numeric(df["durationSeconds"]).fillna(duration)
+
+    observed_throughput = pd.Series(max_watermark / duration, index=df.index)
+    if "observed_throughput" in df:
+        previous = df["observed_throughput"]
+    else:
+        previous = float("NaN")
+    df["observed_throughput"] = observed_throughput.where(df["load"] != 0, previous)
+    return df
+
+
+def batch_latency(df: pd.DataFrame, at, window):
+    query = f"max by (experiment_started_ts, namespace) (max_over_time(histogram_quantile(0.99, sum(rate(kminion_end_to_end_roundtrip_latency_seconds_bucket)) by (le, experiment_started_ts, namespace))[{window}:5s]))"
+    data = batch_query(query, at, by=("experiment_started_ts", "namespace"))
+    # 0 without samples, as per row
+    df["latency_p99"] = join_batch(
+        data, [df["started_ts"], get_namespace(df["exp_name"])], fill=0
+    )
+    return df
+
+
+def batch_average_power(df: pd.DataFrame, at, window):
+    query = f"sum by (experiment_started_ts) (avg_over_time(scaph_host_power_microwatts[{window}])) / 10^6"
+    data = batch_query(query, at)
+    average_power = join_batch(data, [df["started_ts"]])
+    # 0 without samples, as per row, which leaves the unit power out
+    df["average_unit_power"] = average_power / df["broker_replicas"]
+    df["average_power"] = np.nan_to_num(average_power, nan=0)
+    return df
+
+
+def batch_network_saturation(df: pd.DataFrame, at, window):
+    query = f"""
+    max by (experiment_started_ts) (
+    max_over_time(
+    max by (device, node, experiment_started_ts) (
+        irate(node_network_receive_bytes_total{{device=~"e.*"}}[15s])
+        / on(device, node, experiment_started_ts)
+        node_network_speed_bytes{{device=~"e.*"}}
+    )[{window}:5s]
+    )
+    )
+    """
+    data = batch_query(query, at)
+    df["network_saturation"] = join_batch(data, [df["started_ts"]])
+    return df
+
+
+# Calculations that can be answered for every row at once with a single
+# query per cluster of experiments, grouped by experiment_started_ts
+BATCHED_CALCULATIONS = {
+    calculate_observed_throughput: batch_observed_throughput,
+    calculate_latency: batch_latency,
+    calculate_average_power: batch_average_power,
+    calculate_network_saturation: batch_network_saturation,
+}
+
+# Calculations whose per-row queries can be fetched concurrently up front,
+# mapped to the functions that build the query and reduce its result
+CONCURRENT_CALCULATIONS = {
+    calculate_observed_throughput: (
+        observed_throughput_query,
+        observed_throughput_from,
+    ),
+    calculate_latency: (latency_query, latency_from),
+    calculate_average_power: (average_power_query, average_power_from),
+    calculate_network_saturation: (
+        network_saturation_query,
+        network_saturation_from,
+    ),
+    calculate_disk_throughput: (disk_throughput_query, disk_throughput_from),
+    calculate_disk_utilization: (disk_utilization_query, disk_utilization_from),
+}
+
+# Concurrent calculations whose range query is only reduced to one number,
+# mapped to an instant query computing that number server side
+SCALAR_CALCULATIONS = {
+    calculate_network_saturation: network_saturation_scalar_query,
+    calculate_disk_throughput: disk_throughput_scalar_query,
+    calculate_average_power: average_power_scalar_query,
+}
+
+# Concurrent calculations that can be evaluated from the local archive of raw
+# series (see greenflow.archive), mapped to the archive evaluator of their query
+ARCHIVED_CALCULATIONS = {
+    calculate_observed_throughput: archived.observed_throughput,
+    calculate_latency: archived.latency,
+    calculate_average_power: archived.average_power,
+    calculate_network_saturation: archived.network_saturation,
+    calculate_disk_throughput: archived.disk_throughput,
+    calculate_disk_utilization: archived.disk_utilization,
+}
+
+
+class Calculation(NamedTuple):
+    function: Callable
+    # Bump whenever the output of the calculation changes, stored results
+    # produced by an older version are then recomputed
+    version: int
+    # Columns written by the calculation, the first one marks it as done in
+    # results stored before versions were recorded
+    columns: tuple[str, ...]
+    depends_on: tuple[str, ...] = ()
+
+
+CALCULATIONS = {
+    "observed_throughput": Calculation(
+        calculate_observed_throughput, 1, ("observed_throughput",)
+    ),
+    "latency": Calculation(calculate_latency, 1, ("latency_p99",)),
+    "average_power": Calculation(
+        calculate_average_power, 1, ("average_power", "average_unit_power")
+    ),
+    "throughput_MBps": Calculation(
         calculate_throughput_MBps,
-        # calculate_disk_throughput,
-        # calculate_disk_utilization,
-        # calculate_throughput_per_watt,
+        1,
+        ("throughput_MBps", "adjusted_network_throughput", "throughput_MBps_error"),
+        depends_on=("observed_throughput",),
+    ),
+    "disk_throughput": Calculation(
+        calculate_disk_throughput, 1, ("disk_throughput_MBps",)
+    ),
+    "disk_utilization": Calculation(
+        calculate_disk_utilization, 1, ("disk_utilization",)
+    ),
+    "throughput_per_watt": Calculation(
+        calculate_throughput_per_watt,
+        1,
+        ("throughput_per_watt", "throughput_per_watt_error"),
+        depends_on=("throughput_MBps", "average_power"),
+    ),
+    "energy_cost": Calculation(
         calculate_energy_cost,
-        calculate_network_saturation,
+        1,
+        ("energy_cost", "adjusted_power", "idle_power_version", "energy_cost_error"),
+        depends_on=("throughput_MBps", "average_power"),
+    ),
+    "network_saturation": Calculation(
+        calculate_network_saturation, 1, ("network_saturation",)
+    ),
+    "throughput_gap": Calculation(
         calculate_throughput_gap,
-        # convert_broker_cpu,
+        1,
+        ("throughput_gap_percentage", "throughput_gap_error"),
+        depends_on=("observed_throughput",),
+    ),
+    "broker_cpu": Calculation(
+        convert_broker_cpu, 1, ("broker_cpu", "broker_cpu_error")
+    ),
+}
+
+# Calculations run by enrich_dataframe, in order
+ENABLED_CALCULATIONS = [
+    "observed_throughput",
+    "latency",
+    "average_power",
+    "throughput_MBps",
+    # "disk_throughput",
+    # "disk_utilization",
+    # "throughput_per_watt",
+    "energy_cost",
+    "network_saturation",
+    "throughput_gap",
+    # "broker_cpu",
+]
+
+
+def recorded_versions(stored: Optional[dict]) -> dict[str, int]:
+    """Versions of the calculations that produced a stored result"""
+    if not stored:
+        return {}
+    if "calculation_versions" in stored:
+        return dict(stored["calculation_versions"])
+    # Results stored before versioning were all produced by the first versions
+    return {
+        name: 1
+        for name, calculation in CALCULATIONS.items()
+        if calculation.columns[0] in stored
+    }
+
+
+def is_produced(row: dict, name: str) -> bool:
+    """
+    Whether the row holds the main column of the calculation, even without a
+    value: experiments without data are not recomputed over and over
+    """
+    return CALCULATIONS[name].columns[0] in row
+
+
+def produced_versions(names, failed=()) -> dict[str, int]:
+    """
+    Current versions of the calculations that ran, whatever they found. Failed
+    ones are left out so that they are retried next time
+    """
+    return {name: CALCULATIONS[name].version for name in names if name not in failed}
+
+
+def stale_calculations(
+    versions: dict[str, int], enabled=None, stored: Optional[dict] = None
+) -> list[str]:
+    """
+    Enabled calculations that are missing or outdated in versions, or whose
+    column is missing from the stored result, along with every calculation
+    depending on them, in enrichment order
+    """
+    stale = []
+    for name in enabled or ENABLED_CALCULATIONS:
+        calculation = CALCULATIONS[name]
+        if (
+            versions.get(name) != calculation.version
+            or (stored is not None and not is_produced(stored, name))
+            or any(dependency in stale for dependency in calculation.depends_on)
+        ):
+            stale.append(name)
+    return stale
+
+
+def prefetch(
+    df: pd.DataFrame,
+    calculations,
+    concurrency: int = 16,
+    archive: bool = False,
+    scalar: bool = False,
+) -> dict:
+    """
+    Fetch the queries of every row for every concurrent calculation in parallel,
+    keyed by (calculation, row index). With archive, rows of archived experiments
+    are read from the local archive and only the others hit the TSDB. With
+    scalar, calculations that have one use their instant query instead.
+    """
+    results, queries = {}, {}
+    for calc in calculations:
+        if calc not in CONCURRENT_CALCULATIONS:
+            continue
+        make_query, _ = CONCURRENT_CALCULATIONS[calc]
+        if scalar and calc in SCALAR_CALCULATIONS:
+            make_query = SCALAR_CALCULATIONS[calc]
+        for index, row in df.iterrows():
+            query = make_query(row)
+            if query is None:
+                continue
+            if archive and calc in ARCHIVED_CALCULATIONS:
+                try:
+                    data = ARCHIVED_CALCULATIONS[calc](row)
+                except Exception as e:
+                    data = e
+                if data is not None:
+                    results[(calc, index)] = data
+                    continue
+            queries[(calc, index)] = query
+
+    if queries:
+        for key, data in fetch_all(queries, concurrency=concurrency).items():
+            if queries[key].step == INSTANT and not isinstance(data, Exception):
+                data = as_matrix(data)
+            results[key] = data
+    return results
+
+
+def enrich_dataframe(
+    df,
+    batched=False,
+    concurrency=16,
+    calculations=None,
+    archive=False,
+    scalar=False,
+    failures=None,
+):
+    """
+    With failures, a dict of sets, the index of every row a calculation failed
+    on is added to the set of the calculation
+    """
+    if calculations is None:
+        calculations = [CALCULATIONS[name].function for name in ENABLED_CALCULATIONS]
+
+    if df.empty:
+        return df
+
+    if batched:
+        groups = batch_groups(df)
+
+    def is_batched(calc):
+        # Archived series are cheaper than any query, even a batched one
+        return (
+            batched
+            and calc in BATCHED_CALCULATIONS
+            and not (archive and calc in ARCHIVED_CALCULATIONS)
+        )
+
+    # Per-row queries of everything the batched mode does not cover
+    prefetched = None
+    unbatched = [
+        calc
+        for calc in calculations
+        if calc in CONCURRENT_CALCULATIONS and not is_batched(calc)
     ]
+    if unbatched:
+        try:
+            prefetched = prefetch(
+                df, unbatched, concurrency=concurrency, archive=archive, scalar=scalar
+            )
+        except Exception as e:
+            print(f"Error while prefetching queries: {str(e)}")
+
+    if failures is None:
+        failures = defaultdict(set)
 
     for calc in calculations:
+        failed = failures[calc]
         try:
             # Process one calculation at a time
             # print(f"Running calculation: {calc.__name__}")
-            df = df.apply(lambda row: safe_calculate(row, calc), axis=1)
+            if is_batched(calc):
+                df = pd.concat(
+                    [
+                        batch_calculate(
+                            df.loc[group],
+                            calc,
+                            concurrency=concurrency,
+                            scalar=scalar,
+                            failed=failed,
+                        )
+                        for group in groups
+                    ]
+                ).loc[df.index]
+            elif calc in VECTORIZED_CALCULATIONS:
+                vectorized, error_column = VECTORIZED_CALCULATIONS[calc]
+                df, errors = vectorized(df.copy())
+                df[error_column] = errors.to_numpy(dtype=bool)
+                failed.update(df.index[df[error_column]])
+            elif calc in CONCURRENT_CALCULATIONS and prefetched is not None:
+                _, reduce = CONCURRENT_CALCULATIONS[calc]
+                df = df.apply(
+                    lambda row: safe_calculate(
+                        row, reduce, prefetched.get((calc, row.name)), failed=failed
+                    ),
+                    axis=1,
+                )
+            else:
+                df = df.apply(
+                    lambda row: safe_calculate(row, calc, failed=failed), axis=1
+                )
         except Exception as e:
             print(f"Error in calculation {calc.__name__}: {str(e)}")
+            failed.update(df.index)
 
     return df
 
 
-def safe_calculate(row, calculation):
+def batch_calculate(df: pd.DataFrame, calc, concurrency=16, scalar=False, failed=None):
+    """
+    Batched calculation of a cluster of experiments, falling back to per-row
+    queries if the batched one fails, e.g. over a window too long for the TSDB.
+    Rows failing per row are added to failed
+    """
+    try:
+        return BATCHED_CALCULATIONS[calc](df.copy(), *get_batch_window(df))
+    except Exception as e:
+        print(f"Error in batched {calc.__name__}, querying per row: {str(e)}")
+    prefetched = prefetch(df, [calc], concurrency=concurrency, scalar=scalar)
+    _, reduce = CONCURRENT_CALCULATIONS[calc]
+    return df.apply(
+        lambda row: safe_calculate(
+            row, reduce, prefetched.get((calc, row.name)), failed=failed
+        ),
+        axis=1,
+    )
+
+
+def safe_calculate(row, calculation, *args, failed=None):
     try:
-        return calculation(row)
+        for arg in args:
+            # Failed prefetched queries are surfaced as errors of their row
+            if isinstance(arg, Exception):
+                raise arg
+        return calculation(row, *args)
     except Exception as e:
         print(f"Error in row {row.name} for {calculation.__name__}:")
         print(f"Error message: {str(e)}")
         print("Row data:")
         print(row.to_dict())
+        if failed is not None:
+            failed.add(row.name)
         # Return the original row unchanged
         return row
 
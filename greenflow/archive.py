@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Local columnar archive of the raw Prometheus series of each experiment.
+
+Series are written once the experiment is over, in the background, as zstd
+compressed Parquet, one file per metric, partitioned by deployment and
+experiment:
+
+    storage/archive/deployment_started_ts=<ts>/experiment_started_ts=<ts>/<metric>.parquet
+
+Every file has the label columns of the metric as strings, plus `timestamp`
+(seconds since epoch) and `value`.
+"""
+
+import logging
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from glob import glob
+from os import environ, makedirs, path, rename
+from typing import Optional
+from urllib.parse import quote
+
+import pendulum
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Raw series needed to recompute the analysis without the TSDB
+ARCHIVED_METRICS = [
+    "kminion_kafka_topic_high_water_mark_sum",
+    "kminion_end_to_end_roundtrip_latency_seconds_bucket",
+    "scaph_host_power_microwatts",
+    "node_network_receive_bytes_total",
+    "node_network_transmit_bytes_total",
+    "node_network_speed_bytes",
+    "node_disk_read_bytes_total",
+    "node_disk_written_bytes_total",
+]
+
+# Exports run one at a time, in the background of the experiments
+_exporter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+
+
+def archive_root() -> str:
+    return environ.get(
+        "GREENFLOW_ARCHIVE", path.join(environ.get("GITROOT", "."), "storage/archive")
+    )
+
+
+def experiment_dir(
+    deployment_started_ts: str, experiment_started_ts: str, root: Optional[str] = None
+) -> str:
+    return path.join(
+        root or archive_root(),
+        f"deployment_started_ts={quote(deployment_started_ts, safe='')}",
+        f"experiment_started_ts={quote(experiment_started_ts, safe='')}",
+    )
+
+
+def find_experiment_dir(
+    experiment_started_ts: str, root: Optional[str] = None
+) -> Optional[str]:
+    matches = glob(
+        path.join(
+            root or archive_root(),
+            "*",
+            f"experiment_started_ts={quote(experiment_started_ts, safe='')}",
+        )
+    )
+    return matches[0] if matches else None
+
+
+def series_to_table(series: list) -> pa.Table:
+    """Prometheus matrix result to a flat table, one row per sample"""
+    labels = sorted({label for s in series for label in s["metric"]})
+    columns = {label: [] for label in labels}
+    timestamps, values = [], []
+    for s in series:
+        samples = s["values"]
+        for label in labels:
+            columns[label].extend([s["metric"].get(label)] * len(samples))
+        timestamps.extend(float(t) for t, _ in samples)
+        values.extend(float(v) for _, v in samples)
+
+    return pa.table(
+        {
+            **{
+                label: pa.array(column, pa.string()).dictionary_encode()
+                for label, column in columns.items()
+            },
+            "timestamp": pa.array(timestamps, pa.float64()),
+            "value": pa.array(values, pa.float64()),
+        }
+    )
+
+
+def export_experiment(
+    deployment_started_ts: str,
+    experiment_started_ts: str,
+    stopped_ts: str,
+    *,
+    prom=None,
+    metrics: list[str] = ARCHIVED_METRICS,
+    buffer_minutes: int = 5,
+    root: Optional[str] = None,
+) -> str:
+    """
+    Export the raw series of a finished experiment, returns its directory. The
+    series are written aside and moved in place at once, readers never see a
+    partial archive
+    """
+    if prom is None:
+        from prometheus_api_client import PrometheusConnect
+
+        prom = PrometheusConnect(url=environ["PROMETHEUS_URL"])
+
+    start_time = pendulum.parse(experiment_started_ts).subtract(minutes=buffer_minutes)
+    end_time = pendulum.parse(stopped_ts).add(minutes=buffer_minutes)
+    directory = experiment_dir(deployment_started_ts, experiment_started_ts, root)
+    partial = f"{directory}.partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    makedirs(partial)
+
+    for metric in metrics:
+        series = prom.get_metric_range_data(
+            f'{metric}{{experiment_started_ts="{experiment_started_ts}"}}',
+            start_time=start_time,
+            end_time=end_time,
+        )
+        if not series:
+            continue
+        pq.write_table(
+            series_to_table(series),
+            path.join(partial, f"{metric}.parquet"),
+            compression="zstd",
+        )
+
+    shutil.rmtree(directory, ignore_errors=True)
+    rename(partial, directory)
+    return directory
+
+
+def archive_current_experiment() -> Optional[Future]:
+    """
+    Called at the end of every experiment, never fails the experiment itself.
+    The experiment is read here, on the thread committing it, and its series
+    are exported in the background
+    """
+    from .g import g
+    from .state import get_deployment_state_vars
+
+    if g.deployment_type == "test":
+        return None
+    try:
+        experiment = g.root.current_experiment
+        timestamps = (
+            get_deployment_state_vars()["deployment_started_ts"],
+            experiment.started_ts,
+            experiment.stopped_ts,
+        )
+    except Exception:
+        logging.exception("Failed to archive the series of the experiment")
+        return None
+    return _exporter.submit(_export, *timestamps)
+
+
+def _export(
+    deployment_started_ts: str,
+    started_ts: str,
+    stopped_ts: str,
+    flush_timeout: float = 30,
+):
+    try:
+        import requests
+
+        # Since we are using VictoriaMetrics, there's an additional flush required
+        try:
+            requests.get(
+                f"{environ['PROMETHEUS_URL']}/internal/force_flush",
+                timeout=flush_timeout,
+            )
+        except requests.RequestException as e:
+            # A hung TSDB must not hold the exports queued behind this one,
+            # the series are exported with whatever was flushed
+            logging.warning({"msg": "Failed to flush the TSDB", "error": str(e)})
+        export_experiment(deployment_started_ts, started_ts, stopped_ts)
+    except Exception:
+        logging.exception("Failed to archive the series of the experiment")
+
+
+def read_series(
+    experiment_started_ts: str, metric: str, root: Optional[str] = None
+) -> Optional[pa.Table]:
+    """
+    Memory-mapped read of one archived metric. None if the experiment was not
+    archived, an empty table if it was but the metric had no samples.
+    """
+    directory = find_experiment_dir(experiment_started_ts, root)
+    if directory is None:
+        return None
+    file = path.join(directory, f"{metric}.parquet")
+    if not path.exists(file):
+        return pa.table(
+            {
+                "timestamp": pa.array([], pa.float64()),
+                "value": pa.array([], pa.float64()),
+            }
+        )
+    return pq.read_table(file, memory_map=True)
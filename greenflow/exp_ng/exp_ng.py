@@ -1,4 +1,5 @@
 import logging
+import re
 import threading
 import traceback
 from kr8s.objects import Job
@@ -9,6 +10,7 @@ from shlex import split
 
 from box import Box, BoxList
 
+from .jobs import JobFailed, wait_for_completion
 from .synchronized_perf_script import producer_script
 
 from .prometheus import reinit_prometheus, scale_prometheus
@@ -18,6 +20,23 @@ from ..playbook import _playbook
 from ..state import get_deployment_state_vars, get_experiment_state_vars
 
 
+def job_name(base: str, extra_vars) -> str:
+    """
+    Jobs are named after their topic, so that those of the next experiment can
+    be created while the last ones are still being deleted
+    """
+    topic_name = extra_vars["exp_params"]["topic_name"]
+    return f"{base}-{re.sub('[^a-z0-9-]', '-', topic_name.lower())}"
+
+
+def job_metadata(base: str, extra_vars) -> dict:
+    return {
+        "name": job_name(base, extra_vars),
+        "namespace": "default",
+        "labels": {"app": base},
+    }
+
+
 def create_job(extra_vars) -> Job:
     pushgateway_url = extra_vars["prometheus_pushgateway_url"]
     exp_params = extra_vars["exp_params"]
@@ -28,7 +47,7 @@ def create_job(extra_vars) -> Job:
             "--bootstrap-server",
             exp_params.kafka_bootstrap_servers,
             "--topic",
-            "input",
+            exp_params.topic_name,
             "--describe",
         ]
     )
@@ -38,7 +57,7 @@ def create_job(extra_vars) -> Job:
             "--bootstrap-server",
             exp_params.kafka_bootstrap_servers,
             "--topic",
-            "input",
+            exp_params.topic_name,
             "--partitions",
             f"{exp_params.partitions}",
             "--replication-factor",
@@ -51,7 +70,7 @@ def create_job(extra_vars) -> Job:
         dict(
             apiVersion="batch/v1",
             kind="Job",
-            metadata={"name": "create-kafka-topic", "namespace": "default"},
+            metadata=job_metadata("create-kafka-topic", extra_vars),
             spec={
                 "backoffLimit": 0,
                 "template": {
@@ -71,7 +90,7 @@ def create_job(extra_vars) -> Job:
                                     for i in $(seq 1 $NUM_ATTEMPTS); do
                                         echo "Executing: /opt/kafka/bin/kafka-topics.sh {' '.join(check_topic_args)}"
                                         if /opt/kafka/bin/kafka-topics.sh {' '.join(check_topic_args)} 2>/dev/null; then
-                                            echo "Topic 'input' already exists."
+                                            echo "Topic '{exp_params.topic_name}' already exists."
                                             exit 0
                                         fi
                                         
@@ -117,7 +136,7 @@ def synchronized_exp_job(extra_vars) -> Job:
         dict(
             apiVersion="batch/v1",
             kind="Job",
-            metadata={"name": "kafka-producer-perf-test", "namespace": "default"},
+            metadata=job_metadata("kafka-producer-perf-test", extra_vars),
             spec={
                 "parallelism": exp_params["producer_instances"],
                 "completions": exp_params["producer_instances"],
@@ -143,7 +162,7 @@ cat << 'EOF' > /tmp/synchronized_kafka_perf_test.sh
 EOF
 chmod +x /tmp/synchronized_kafka_perf_test.sh
 /tmp/synchronized_kafka_perf_test.sh \
-    --topic input \
+    --topic {exp_params['topic_name']} \
     --num-records {int(total_messages)} \
     --record-size {exp_params['messageSize']} \
     --throughput {int(exp_params['load'] // exp_params['producer_instances'])} \
@@ -167,7 +186,7 @@ def delete_job(extra_vars) -> Job:
         dict(
             apiVersion="batch/v1",
             kind="Job",
-            metadata={"name": "delete-kafka-topic", "namespace": "default"},
+            metadata=job_metadata("delete-kafka-topic", extra_vars),
             spec={
                 # "ttlSecondsAfterFinished": 5,
                 "backoffLimit": 0,
@@ -182,7 +201,7 @@ def delete_job(extra_vars) -> Job:
                                 "args": [
                                     "topic",
                                     "delete",
-                                    "input",
+                                    exp_params.topic_name,
                                     "-X",
                                     f"brokers={exp_params.kafka_bootstrap_servers}",
                                 ],
@@ -196,6 +215,20 @@ def delete_job(extra_vars) -> Job:
 
 
 def create_kafka_topic(extra_vars):
+    from .kafka_admin import admin_client, create_topic
+
+    exp_params = extra_vars["exp_params"]
+    client = admin_client(exp_params)
+    if client is not None:
+        create_topic(
+            client,
+            exp_params["topic_name"],
+            exp_params["partitions"],
+            exp_params["replicationFactor"],
+        )
+        return
+
+    # Brokers unreachable from here, from within the cluster then
     job = create_job(extra_vars)
     job.create()
     job.wait(["condition=Complete", "condition=Failed"])
@@ -206,7 +239,43 @@ def create_kafka_topic(extra_vars):
         raise RuntimeError("Failed to create kafka topic")
 
 
-def deploy_experiment(extra_vars) -> Job:
+def prepare_kafka_topic(extra_vars) -> int:
+    """
+    Create the topic, or with reuse_topic truncate the one left by the last
+    experiment if it has the same spec. The high water mark it starts from is
+    bound as watermark_baseline, call it before g.init_exp so that the
+    experiment records it
+    """
+    from entrypoint import rebind_parameters
+    from .kafka_admin import admin_client, truncate_or_create_topic
+
+    exp_params = extra_vars["exp_params"]
+    client = admin_client(exp_params)
+    if exp_params.get("reuse_topic") and client is not None:
+        baseline = truncate_or_create_topic(
+            client,
+            exp_params["topic_name"],
+            exp_params["partitions"],
+            exp_params["replicationFactor"],
+        )
+    else:
+        create_kafka_topic(extra_vars)
+        baseline = 0
+    rebind_parameters(watermark_baseline=baseline)
+    return baseline
+
+
+def release_kafka_topic(extra_vars):
+    """Delete the topic, unless the next experiment may reuse it"""
+    from .kafka_admin import admin_client
+
+    exp_params = extra_vars["exp_params"]
+    if exp_params.get("reuse_topic") and admin_client(exp_params) is not None:
+        return
+    delete_kafka_topic(extra_vars)
+
+
+def deploy_experiment(extra_vars) -> dict:
     job = synchronized_exp_job(extra_vars)
     # job = exp_job_custom(extra_vars)
     job.create()
@@ -216,20 +285,23 @@ def deploy_experiment(extra_vars) -> Job:
     totalDuration = extra_vars["exp_params"]["durationSeconds"] + gracePeriod
 
     try:
-        job.wait(["condition=Complete", "condition=Failed"], timeout=totalDuration * 10)
-        if job.status.conditions[0].type == "Complete":
-            job.delete(propagation_policy="Foreground")
-            return
-        else:
-            breakpoint()
-            raise RuntimeError("Failed to run experiment")
+        return wait_for_completion([job], timeout=totalDuration * 10)
+    except JobFailed as e:
+        raise RuntimeError("Failed to run experiment") from e
     except TimeoutError:
-        breakpoint()
-        # job.delete(propagation_policy="Foreground")
-        return
+        logging.warning({"msg": "Experiment timed out", "timeout": totalDuration * 10})
+    finally:
+        job.delete(propagation_policy="Foreground")
 
 
 def delete_kafka_topic(extra_vars):
+    from .kafka_admin import admin_client, delete_topic
+
+    client = admin_client(extra_vars["exp_params"])
+    if client is not None:
+        delete_topic(client, extra_vars["exp_params"]["topic_name"])
+        return
+
     job = delete_job(extra_vars)
     job.create()
     job.wait(["condition=Complete", "condition=Failed"])
@@ -240,10 +312,28 @@ def delete_kafka_topic(extra_vars):
         raise RuntimeError("Failed to delete kafka topic")
 
 
+def wait_for_scrape(extra_vars, timeout: float = 60) -> bool:
+    """
+    Wait until the topic watermark has been scraped since now, that is after
+    the load ended, and is visible in the TSDB
+    """
+    from ..analysis.promclient import wait_for_samples, watermark_query
+
+    query = watermark_query(
+        extra_vars["exp_name"],
+        extra_vars["experiment_started_ts"],
+        extra_vars["exp_params"]["topic_name"],
+    )
+    return wait_for_samples(query, after=pendulum.now(), timeout=timeout)
+
+
 def exp(experiment_description) -> float:
     exp_name = factors()["exp_name"]
     from ..g import g
 
+    prepare_kafka_topic(
+        Box(get_deployment_state_vars() | get_experiment_state_vars() | factors())
+    )
     g.init_exp(experiment_description)
     extra_vars = get_deployment_state_vars() | get_experiment_state_vars() | factors()
     extra_vars = Box(extra_vars)
@@ -257,12 +347,11 @@ def exp(experiment_description) -> float:
     reinit_prometheus(
         extra_vars["deployment_started_ts"], extra_vars["experiment_started_ts"]
     )
-    create_kafka_topic(extra_vars)
     deploy_experiment(extra_vars)
 
     # Let the metrics get scraped before deleting the kafka topic
-    time.sleep(10)
-    delete_kafka_topic(extra_vars)
+    wait_for_scrape(extra_vars)
+    release_kafka_topic(extra_vars)
     scale_prometheus(0)
 
     g.end_exp()
@@ -290,6 +379,11 @@ def killexp():
             job = Job(Box(metadata=Box(name=job_name, namespace="default")))
             job.delete(propagation_policy="Foreground")
             kubectl(split(f"delete job {job_name} -n default"))
+        except:
+            ...
+        try:
+            # Those named after their topic
+            kubectl(split(f"delete job -l app={job_name} -n default"))
         except:
             ...
             # traceback.print_exc()
@@ -1,4 +1,6 @@
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from box import Box
 from kr8s.objects import Job
 import pendulum
@@ -6,23 +8,37 @@ import time
 import numpy as np
 
 from entrypoint import rebind_parameters
-from .exp_ng import create_kafka_topic, delete_kafka_topic
+from .jobs import JobFailed, wait_for_completion
+from .exp_ng import (
+    job_metadata,
+    prepare_kafka_topic,
+    release_kafka_topic,
+    wait_for_scrape,
+)
 from .prometheus import reinit_prometheus, scale_prometheus
 
 from ..state import get_deployment_state_vars, get_experiment_state_vars
 from ..factors import factors
-from .synchronized_perf_script import producer_script, consumer_script
+from .synchronized_perf_script import (
+    START_DELAY,
+    consumer_args,
+    consumer_script,
+    load_timeout,
+    producer_args,
+    producer_script,
+)
 
 
-def exp_consumer_job(extra_vars) -> Job:
+def exp_consumer_job(extra_vars, start_timestamp: int = None) -> Job:
     exp_params = extra_vars["exp_params"]
-    start_timestamp = int(time.time()) + 20  # 20 seconds in the future
+    if start_timestamp is None:
+        start_timestamp = int(time.time()) + START_DELAY
 
     return Job(
         dict(
             apiVersion="batch/v1",
             kind="Job",
-            metadata={"name": "kafka-consumer-perf-test", "namespace": "default"},
+            metadata=job_metadata("kafka-consumer-perf-test", extra_vars),
             spec={
                 "parallelism": exp_params["consumer_instances"],
                 "completions": exp_params["consumer_instances"],
@@ -46,11 +62,7 @@ cat << 'EOF' > /tmp/synchronized_kafka_consumer_test.sh
 {consumer_script}
 EOF
 chmod +x /tmp/synchronized_kafka_consumer_test.sh
-/tmp/synchronized_kafka_consumer_test.sh \
-    --topic input \
-    --bootstrap-server {exp_params['kafka_bootstrap_servers']} \
-    --durationSeconds {exp_params['durationSeconds']} \
-    --start-timestamp {start_timestamp}
+/tmp/synchronized_kafka_consumer_test.sh {consumer_args(extra_vars, start_timestamp)}
                                     """,
                                 ],
                             }
@@ -62,61 +74,60 @@ chmod +x /tmp/synchronized_kafka_consumer_test.sh
     )
 
 
-def deploy_hammer_with_consumer(extra_vars) -> tuple[Job, Job]:
+def deploy_hammer_with_consumer(extra_vars):
+    # Both jobs start loading together, START_DELAY seconds in the future
+    start_timestamp = int(time.time()) + START_DELAY
+    jobs = start_hammer_with_consumer(extra_vars, start_timestamp)
+    wait_for_jobs(extra_vars, jobs, start_timestamp)
+
+
+def start_hammer_with_consumer(extra_vars, start_timestamp: int) -> tuple[Job, Job]:
     # producer_job = exp_hammer_job(extra_vars)
-    producer_job = exp_perf_test_job(extra_vars) # Switching back to the original producer job
-    consumer_job = exp_consumer_job(extra_vars)
+    # Switching back to the original producer job
+    producer_job = exp_perf_test_job(extra_vars, start_timestamp)
+    consumer_job = exp_consumer_job(extra_vars, start_timestamp)
 
     producer_job.create()
     consumer_job.create()
+    return producer_job, consumer_job
 
-    # Assume that it can take up to 20 seconds to start the jobs
-    gracePeriod = 20
-    totalDuration = extra_vars["exp_params"]["durationSeconds"] + gracePeriod
 
-    try:
-        # Wait for both jobs to complete or fail
-        producer_job.wait(
-            ["condition=Complete", "condition=Failed"], timeout=totalDuration
-        )
-        consumer_job.wait(
-            ["condition=Complete", "condition=Failed"], timeout=totalDuration
-        )
+def wait_for_jobs(extra_vars, jobs: tuple[Job, Job], start_timestamp: int) -> dict:
+    """
+    Start and finish time of each pod, once all of them are done or as soon as
+    one fails. The jobs are deleted either way
+    """
+    producer_job, consumer_job = jobs
+
+    # The scripts load from start_timestamp on, for their duration and until
+    # their time bomb goes off
+    timeout = load_timeout(start_timestamp, extra_vars["exp_params"]["durationSeconds"])
 
-        cleanup_jobs = True
-        if (
-            producer_job.status.conditions[0].type == "Complete"
-            and consumer_job.status.conditions[0].type == "Complete"
-        ):
-            cleanup_jobs = True
-    except TimeoutError:
-        cleanup_jobs = True
-    except KeyboardInterrupt:
-        cleanup_jobs = True
+    times = {}
+    try:
+        times = wait_for_completion(jobs, timeout=timeout)
+    except (JobFailed, TimeoutError, asyncio.TimeoutError) as e:
+        # The experiment is still read out, with whatever made it through
+        logging.warning({"msg": "Load did not complete", "error": repr(e)})
     finally:
-        if cleanup_jobs:
-            producer_job.delete(propagation_policy="Foreground")
-            consumer_job.delete(propagation_policy="Foreground")
+        producer_job.delete(propagation_policy="Foreground")
+        consumer_job.delete(propagation_policy="Foreground")
+    return times
+
 
-def exp_perf_test_job(extra_vars) -> Job:
+def exp_perf_test_job(extra_vars, start_timestamp: int = None) -> Job:
     # TODO: Merge this with normal job
     extra_vars = Box(extra_vars)
     exp_params = extra_vars.exp_params
-    load = exp_params.load / exp_params.producer_instances
-    total_messages = load * exp_params.durationSeconds
     producer_instances = exp_params.producer_instances
-    topic_name = exp_params.topic_name
-    start_timestamp = int(time.time()) + 20  # 20 seconds in the future
-    if load == 1 * 10**9:
-        throughput = -1
-    else:
-        throughput = int(load)
+    if start_timestamp is None:
+        start_timestamp = int(time.time()) + START_DELAY
 
     return Job(
         dict(
             apiVersion="batch/v1",
             kind="Job",
-            metadata={"name": "kafka-producer-perf-test", "namespace": "default"},
+            metadata=job_metadata("kafka-producer-perf-test", extra_vars),
             spec={
                 "parallelism": producer_instances,
                 "completions": producer_instances,
@@ -141,7 +152,7 @@ def exp_perf_test_job(extra_vars) -> Job:
                                     "limits": {
                                         # "cpu": "1000m",
                                         "memory": "128M"
-                                    }
+                                    },
                                 },
                                 "command": [
                                     "/bin/sh",
@@ -151,15 +162,7 @@ cat << 'EOF' > /tmp/synchronized_kafka_perf_test.sh
 {producer_script}
 EOF
 chmod +x /tmp/synchronized_kafka_perf_test.sh
-/tmp/synchronized_kafka_perf_test.sh \
-    --topic {topic_name} \
-    --num-records {int(total_messages)} \
-    --record-size {exp_params.messageSize} \
-    --throughput {throughput} \
-    --bootstrap-servers {exp_params.kafka_bootstrap_servers} \
-    --producer-props "batch.size=32768" \
-    --durationSeconds {exp_params.durationSeconds} \
-    --start-timestamp {start_timestamp}
+/tmp/synchronized_kafka_perf_test.sh {producer_args(extra_vars, start_timestamp)}
                                     """,
                                 ],
                             }
@@ -171,7 +174,6 @@ chmod +x /tmp/synchronized_kafka_perf_test.sh
     )
 
 
-
 def exp_hammer_job(extra_vars) -> Job:
     exp_params = extra_vars["exp_params"]
     total_messages = int(
@@ -185,7 +187,7 @@ def exp_hammer_job(extra_vars) -> Job:
         dict(
             apiVersion="batch/v1",
             kind="Job",
-            metadata={"name": "kafka-producer-perf-test", "namespace": "default"},
+            metadata=job_metadata("kafka-producer-perf-test", extra_vars),
             spec={
                 "parallelism": exp_params.producer_instances,
                 "completions": exp_params.producer_instances,
@@ -197,7 +199,6 @@ def exp_hammer_job(extra_vars) -> Job:
                         "restartPolicy": "Never",
                         "terminationGracePeriodSeconds": 0,
                         "nodeSelector": {"node.kubernetes.io/worker": "true"},
-
                         # "affinity": {
                         #     "podAntiAffinity": {
                         #         "requiredDuringSchedulingIgnoredDuringExecution": [
@@ -274,9 +275,13 @@ def hammer(experiment_description="Hammer") -> float:
     from ..analysis import get_observed_throughput_of_last_experiment
     from entrypoint import rebind_parameters
 
+    rebind_parameters(load=1 * 10**9)
+    prepare_kafka_topic(
+        Box(get_deployment_state_vars() | get_experiment_state_vars() | factors())
+    )
+
     now = pendulum.now()
     g.init_exp(experiment_description)
-    rebind_parameters(load=1 * 10**9)
     extra_vars = get_deployment_state_vars() | get_experiment_state_vars() | factors()
     extra_vars = Box(extra_vars)
     logging.warning(
@@ -290,15 +295,14 @@ def hammer(experiment_description="Hammer") -> float:
     reinit_prometheus(
         extra_vars["deployment_started_ts"], extra_vars["experiment_started_ts"]
     )
-    create_kafka_topic(extra_vars)
     deploy_hammer_with_consumer(extra_vars)
     # deploy_hammer(extra_vars)
 
     # Let the metrics get scraped before deleting the kafka topic
-    time.sleep(15)
+    wait_for_scrape(extra_vars)
     scale_prometheus(0)
 
-    delete_kafka_topic(extra_vars)
+    release_kafka_topic(extra_vars)
     g.end_exp()
 
     last_throughput = get_observed_throughput_of_last_experiment(minimum_current_ts=now)
@@ -319,6 +323,10 @@ def stress_test(target_load: float, exp_description="Stress Test") -> float:
         )  # Ensure it's a float even if passed as int/string
 
     rebind_parameters(load=target_load)
+    if target_load != 0:
+        prepare_kafka_topic(
+            Box(get_deployment_state_vars() | get_experiment_state_vars() | factors())
+        )
 
     now = pendulum.now()
     g.init_exp(exp_description)
@@ -337,18 +345,14 @@ def stress_test(target_load: float, exp_description="Stress Test") -> float:
         extra_vars["deployment_started_ts"], extra_vars["experiment_started_ts"]
     )
     if target_load != 0:
-        create_kafka_topic(extra_vars)
-
         deploy_hammer_with_consumer(extra_vars)
 
         # Let the metrics get scraped before deleting the kafka topic
-        time.sleep(15)
+        wait_for_scrape(extra_vars)
         scale_prometheus(0)
 
-        delete_kafka_topic(extra_vars)
-        time.sleep(15)
+        release_kafka_topic(extra_vars)
         g.end_exp()
-        time.sleep(15)
 
         last_throughput = get_observed_throughput_of_last_experiment(
             minimum_current_ts=now
@@ -358,3 +362,123 @@ def stress_test(target_load: float, exp_description="Stress Test") -> float:
         time.sleep(extra_vars.exp_params.durationSeconds)
         scale_prometheus(0)
         g.end_exp()
+
+
+class StressTestPipeline:
+    """
+    Runs stress tests back to back, overlapping the teardown of one experiment
+    with the next one. Each experiment writes to its own topic, alternating
+    between two names derived from the configured one, so that the last topic
+    can be deleted and its throughput read out while the next topic and jobs
+    are being created. Prometheus itself is still reconfigured per experiment,
+    so the loads never overlap.
+
+    with StressTestPipeline("Safety curve") as pipeline:
+        for load in loads:
+            pipeline.run(load)
+    throughputs = pipeline.results
+
+    With a LoadPool, the load runs on its warm pods instead of new jobs.
+    """
+
+    def __init__(self, exp_description="Stress Test", pool=None):
+        self.exp_description = exp_description
+        self.pool = pool
+        self.executor = None
+        self.pending = None
+        self.results = []
+        self.runs = 0
+
+    def __enter__(self) -> "StressTestPipeline":
+        self.topic_name = factors()["exp_params"]["topic_name"]
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.drain()
+        finally:
+            self.executor.shutdown()
+            rebind_parameters(topic_name=self.topic_name)
+
+    def drain(self):
+        """Wait for the teardown of the last experiment"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            self.results.append(pending.result())
+
+    @staticmethod
+    def _teardown(extra_vars, experiment) -> float:
+        """
+        Runs on the executor thread, with plain values only: the storage is
+        not safe to use from it while the next experiment is committed
+        """
+        from ..analysis import observed_throughput_of
+
+        release_kafka_topic(extra_vars)
+        return observed_throughput_of(experiment)
+
+    def run(self, target_load: float):
+        from ..analysis import get_last_experiment
+        from ..g import g
+
+        target_load = float(target_load)
+        rebind_parameters(
+            load=target_load, topic_name=f"{self.topic_name}-{self.runs % 2}"
+        )
+        self.runs += 1
+        if target_load != 0:
+            prepare_kafka_topic(
+                Box(
+                    get_deployment_state_vars()
+                    | get_experiment_state_vars()
+                    | factors()
+                )
+            )
+
+        now = pendulum.now()
+        g.init_exp(self.exp_description)
+        extra_vars = (
+            get_deployment_state_vars() | get_experiment_state_vars() | factors()
+        )
+        extra_vars = Box(extra_vars)
+
+        logging.warning(
+            dict(
+                msg="Stress testing",
+                messageSize=extra_vars.exp_params.messageSize,
+                target_throughput=target_load,
+                topic_name=extra_vars.exp_params.topic_name,
+            )
+        )
+
+        reinit_prometheus(
+            extra_vars["deployment_started_ts"], extra_vars["experiment_started_ts"]
+        )
+        if target_load == 0:
+            time.sleep(extra_vars.exp_params.durationSeconds)
+            scale_prometheus(0)
+            self.drain()
+            g.end_exp()
+            self.results.append(None)
+            return
+
+        if self.pool is None:
+            deploy_hammer_with_consumer(extra_vars)
+        else:
+            try:
+                self.pool.run(extra_vars)
+            except (JobFailed, TimeoutError, asyncio.TimeoutError) as e:
+                logging.warning({"msg": "Load did not complete", "error": repr(e)})
+
+        # Let the metrics get scraped before deleting the kafka topic
+        wait_for_scrape(extra_vars)
+        scale_prometheus(0)
+
+        # The last readout looks for the latest experiment, this one must not be
+        # stored before it
+        self.drain()
+        g.end_exp()
+        self.pending = self.executor.submit(
+            self._teardown, extra_vars, get_last_experiment(now)
+        )
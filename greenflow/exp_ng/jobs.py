@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from typing import NamedTuple, Optional
+
+import kr8s.asyncio
+import pendulum
+
+# Waiting reasons a pod does not recover from with restartPolicy Never
+FATAL_REASONS = {
+    "ErrImagePull",
+    "ImagePullBackOff",
+    "InvalidImageName",
+    "CreateContainerConfigError",
+    "CreateContainerError",
+}
+
+
+class JobFailed(RuntimeError):
+    pass
+
+
+class PodTimes(NamedTuple):
+    job: str
+    phase: str
+    started: Optional[pendulum.DateTime]
+    finished: Optional[pendulum.DateTime]
+
+
+def _parse(ts: Optional[str]) -> Optional[pendulum.DateTime]:
+    return pendulum.parse(ts) if ts else None
+
+
+def pod_times(pod: dict) -> PodTimes:
+    """When the containers of the pod started and finished, None until they do"""
+    status = pod.get("status", {})
+    started = finished = None
+    for container in status.get("containerStatuses") or []:
+        state = container.get("state", {})
+        running = state.get("running") or state.get("terminated") or {}
+        started = _parse(running.get("startedAt")) or started
+        finished = _parse(state.get("terminated", {}).get("finishedAt")) or finished
+    labels = pod["metadata"].get("labels", {})
+    return PodTimes(
+        job=labels.get("job-name", ""),
+        phase=status.get("phase", "Pending"),
+        started=started,
+        finished=finished,
+    )
+
+
+def pod_error(pod: dict) -> Optional[str]:
+    """Why the pod failed, None if it has not"""
+    status = pod.get("status", {})
+    if status.get("phase") == "Failed":
+        return status.get("reason") or status.get("message") or "Failed"
+    for container in status.get("containerStatuses") or []:
+        state = container.get("state", {})
+        waiting = state.get("waiting") or {}
+        if waiting.get("reason") in FATAL_REASONS:
+            return waiting["reason"]
+        terminated = state.get("terminated") or {}
+        if terminated.get("exitCode", 0) != 0:
+            return f"{terminated.get('reason', 'Error')}, exit code {terminated['exitCode']}"
+    return None
+
+
+async def watch_jobs(
+    completions: dict[str, int],
+    namespace: str = "default",
+    times: Optional[dict] = None,
+    api=None,
+) -> dict[str, PodTimes]:
+    """
+    Follow the pods of the jobs, by job name and expected completions, until
+    they all succeeded. Raises JobFailed on the first pod that fails. times is
+    filled in as the pods progress, by pod name
+    """
+    api = api or await kr8s.asyncio.api()
+    times = {} if times is None else times
+    selector = f"job-name in ({','.join(completions)})"
+    async for event, pod in api.watch(
+        "pods", namespace=namespace, label_selector=selector
+    ):
+        if event == "DELETED":
+            continue
+        times[pod.name] = pod_times(pod.raw)
+        error = pod_error(pod.raw)
+        if error is not None:
+            raise JobFailed(f"Pod {pod.name} of job {times[pod.name].job}: {error}")
+        succeeded = [t.job for t in times.values() if t.phase == "Succeeded"]
+        if all(succeeded.count(job) >= n for job, n in completions.items()):
+            return times
+    raise JobFailed("Watch ended before the jobs completed")
+
+
+def wait_for_completion(
+    jobs, timeout: float, namespace: str = "default"
+) -> dict[str, PodTimes]:
+    """
+    Block until every pod of the jobs succeeded, instead of waiting on each job
+    in turn. Raises JobFailed as soon as one fails, TimeoutError after timeout
+    seconds
+    """
+    completions = {job.name: job.raw["spec"].get("completions", 1) for job in jobs}
+    # Jobs without pods, e.g. no consumers, complete by themselves
+    completions = {name: n for name, n in completions.items() if n > 0}
+    times = {}
+    if not completions:
+        return times
+
+    async def watch():
+        return await asyncio.wait_for(
+            watch_jobs(completions, namespace, times), timeout
+        )
+
+    try:
+        return asyncio.run(watch())
+    finally:
+        log_times(times)
+
+
+def log_times(times: dict[str, PodTimes]):
+    started = [t.started for t in times.values() if t.started]
+    finished = [t.finished for t in times.values() if t.finished]
+    logging.warning(
+        dict(
+            msg="Pods",
+            pods=len(times),
+            started=len(started),
+            finished=len(finished),
+            start_skew=(
+                (max(started) - min(started)).total_seconds() if started else None
+            ),
+            last_finished=max(finished).to_iso8601_string() if finished else None,
+        )
+    )
@@ -0,0 +1,186 @@
+import logging
+import time
+from os import getenv
+from typing import Optional
+
+try:
+    from confluent_kafka import OFFSET_END, KafkaError, KafkaException, TopicPartition
+    from confluent_kafka.admin import AdminClient, NewTopic
+except ImportError:
+    AdminClient = None
+
+# bootstrap servers -> AdminClient
+_clients = {}
+# bootstrap servers -> (failed probes, monotonic time of the next one)
+_unreachable = {}
+RETRY_SECONDS = 30
+MAX_RETRY_SECONDS = 600
+
+# In-cluster bootstrap servers -> NodePort of the external listener of the
+# brokers, see the kafka and redpanda roles
+EXTERNAL_NODE_PORTS = {
+    "theodolite-kafka-kafka-bootstrap:9092": 32092,
+    "redpanda.redpanda.svc.cluster.local:9092": 31092,
+}
+BROKER_NODES = {"node.kubernetes.io/broker": "true"}
+# In-cluster bootstrap servers -> external ones, once found
+_external = {}
+
+
+def external_bootstrap_servers(servers: str) -> Optional[str]:
+    """
+    The external listener of the brokers, on the addresses of the nodes running
+    them. None if the brokers have none or the nodes cannot be listed
+    """
+    node_port = EXTERNAL_NODE_PORTS.get(servers)
+    if node_port is None:
+        return None
+    try:
+        from kr8s.objects import Node
+
+        nodes = Node.list(label_selector=BROKER_NODES)
+    except Exception as e:
+        logging.warning({"msg": "Could not list the broker nodes", "error": str(e)})
+        return None
+    addresses = sorted(
+        address["address"]
+        for node in nodes
+        for address in node.raw["status"].get("addresses", [])
+        if address["type"] == "InternalIP"
+    )
+    return ",".join(f"{address}:{node_port}" for address in addresses) or None
+
+
+def bootstrap_servers(exp_params) -> str:
+    """
+    The brokers as seen from here: KAFKA_ADMIN_BOOTSTRAP_SERVERS if set, else
+    their external listener, else the in-cluster names, which only resolve
+    where the cluster DNS does
+    """
+    servers = getenv("KAFKA_ADMIN_BOOTSTRAP_SERVERS")
+    if servers:
+        return servers
+    servers = exp_params["kafka_bootstrap_servers"]
+    if servers not in _external:
+        external = external_bootstrap_servers(servers)
+        if external is None:
+            return servers
+        _external[servers] = external
+    return _external[servers]
+
+
+def admin_client(exp_params, timeout: float = 5) -> Optional["AdminClient"]:
+    """
+    A client connected to the brokers, or None if they cannot be reached from
+    here and topics have to be managed from within the cluster. Unreachable
+    brokers are probed again after a backoff
+    """
+    if AdminClient is None:
+        logging.warning({"msg": "confluent-kafka is not installed"})
+        return None
+    servers = bootstrap_servers(exp_params)
+    if servers in _clients:
+        return _clients[servers]
+    failures, retry_at = _unreachable.get(servers, (0, 0))
+    if time.monotonic() < retry_at:
+        return None
+    client = AdminClient({"bootstrap.servers": servers})
+    try:
+        client.list_topics(timeout=timeout)
+    except KafkaException as e:
+        backoff = min(RETRY_SECONDS * 2**failures, MAX_RETRY_SECONDS)
+        logging.warning(
+            {
+                "msg": "Brokers unreachable",
+                "servers": servers,
+                "error": str(e),
+                "retry_in": backoff,
+            }
+        )
+        _unreachable[servers] = (failures + 1, time.monotonic() + backoff)
+        return None
+    _unreachable.pop(servers, None)
+    _clients[servers] = client
+    return client
+
+
+def wait_for_deletion(client, topic_name: str, timeout: float = 120, interval=0.2):
+    """Poll the metadata until the topic is gone"""
+    deadline = time.monotonic() + timeout
+    while topic_name in client.list_topics(timeout=10).topics:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Topic {topic_name} still exists after {timeout}s")
+        time.sleep(interval)
+
+
+def create_topic(
+    client, topic_name: str, partitions: int, replication_factor: int, timeout=120
+) -> bool:
+    """
+    Create the topic, waiting for a previous one of the same name to be
+    deleted first. False if it already exists
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        topic = NewTopic(topic_name, int(partitions), int(replication_factor))
+        future = client.create_topics([topic], operation_timeout=30)[topic_name]
+        try:
+            future.result()
+            return True
+        except KafkaException as e:
+            error = e.args[0]
+            if error.code() != KafkaError.TOPIC_ALREADY_EXISTS:
+                raise
+            if "marked for deletion" not in error.str():
+                return False
+        wait_for_deletion(client, topic_name, max(deadline - time.monotonic(), 0))
+
+
+def topic_spec(client, topic_name: str) -> Optional[tuple[int, int]]:
+    """(partitions, replication factor) of the topic, None if it does not exist"""
+    topic = client.list_topics(timeout=10).topics.get(topic_name)
+    if topic is None or topic.error is not None:
+        return None
+    replicas = len(next(iter(topic.partitions.values())).replicas)
+    return len(topic.partitions), replicas
+
+
+def truncate_topic(client, topic_name: str) -> int:
+    """
+    Delete every record of the topic, up to the high water mark of each
+    partition, and return the sum of those marks. The offsets keep growing
+    from there, unlike with a new topic
+    """
+    topic = client.list_topics(timeout=10).topics[topic_name]
+    partitions = [TopicPartition(topic_name, p, OFFSET_END) for p in topic.partitions]
+    futures = client.delete_records(partitions, operation_timeout=30)
+    return sum(future.result().low_watermark for future in futures.values())
+
+
+def truncate_or_create_topic(
+    client, topic_name: str, partitions: int, replication_factor: int
+) -> int:
+    """
+    Reuse the topic if it exists with the same partitions and replication
+    factor, recreate it otherwise. Returns the high water mark it starts from
+    """
+    spec = topic_spec(client, topic_name)
+    if spec == (int(partitions), int(replication_factor)):
+        return truncate_topic(client, topic_name)
+    if spec is not None:
+        delete_topic(client, topic_name)
+    create_topic(client, topic_name, partitions, replication_factor)
+    return 0
+
+
+def delete_topic(client, topic_name: str, timeout=120) -> bool:
+    """Delete the topic and wait until it is gone, False if it did not exist"""
+    future = client.delete_topics([topic_name], operation_timeout=30)[topic_name]
+    try:
+        future.result()
+    except KafkaException as e:
+        if e.args[0].code() != KafkaError.UNKNOWN_TOPIC_OR_PART:
+            raise
+        return False
+    wait_for_deletion(client, topic_name, timeout)
+    return True
@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import shlex
+import time
+import uuid
+
+import kr8s
+from kr8s.asyncio.objects import Pod
+from kr8s.objects import Deployment
+from kr8s.objects import Pod as SyncPod
+
+from .jobs import JobFailed
+from .synchronized_perf_script import (
+    consumer_args,
+    consumer_script,
+    load_timeout,
+    producer_args,
+    producer_script,
+)
+
+IMAGE = "registry.gitlab.inria.fr/gkovilkk/greenflow/cp-kafka:7.7.0"
+
+# role -> script installed in the pods, arguments, instances in exp_params
+ROLES = {
+    "producer": (producer_script, producer_args, "producer_instances"),
+    "consumer": (consumer_script, consumer_args, "consumer_instances"),
+}
+
+
+def pool_name(role: str) -> str:
+    return f"kafka-load-pool-{role}"
+
+
+def pool_deployment(role: str, replicas: int, namespace: str = "default"):
+    """
+    Pods that install the perf script of their role and then wait, runs are
+    started in them with exec
+    """
+    script = ROLES[role][0]
+    name = pool_name(role)
+    resources = {}
+    if role == "producer":
+        # As for the producer job
+        resources = {"requests": {"memory": "128M"}, "limits": {"memory": "128M"}}
+    return Deployment(
+        dict(
+            apiVersion="apps/v1",
+            kind="Deployment",
+            metadata={"name": name, "namespace": namespace, "labels": {"app": name}},
+            spec={
+                "replicas": replicas,
+                "selector": {"matchLabels": {"app": name}},
+                "template": {
+                    "metadata": {"labels": {"app": name}},
+                    "spec": {
+                        "terminationGracePeriodSeconds": 0,
+                        "nodeSelector": {"node.kubernetes.io/worker": "true"},
+                        "containers": [
+                            {
+                                "name": name,
+                                "image": IMAGE,
+                                "imagePullPolicy": "IfNotPresent",
+                                "resources": resources,
+                                "command": [
+                                    "/bin/sh",
+                                    "-c",
+                                    f"""
+mkdir -p /tmp/runs
+cat << 'EOF' > /tmp/{role}.sh
+{script}
+EOF
+chmod +x /tmp/{role}.sh
+exec sleep infinity
+                                    """,
+                                ],
+                            }
+                        ],
+                    },
+                },
+            },
+        )
+    )
+
+
+class LoadPool:
+    """
+    Long lived producer and consumer pods, scaled to the instances of each
+    experiment and reused across experiments. A run is dispatched by exec'ing
+    the perf script in the background of every pod, and followed by polling
+    the exit code it leaves behind, instead of creating a Job and waiting for
+    its pods to be scheduled and started.
+
+    This only saves the Job and pod start up: the JVM is not kept warm, every
+    run starts the perf tool in a new JVM, with its class loading and JIT warm
+    up. Runs start lead_seconds after being dispatched.
+
+    with LoadPool() as pool:
+        pool.run(extra_vars)
+    """
+
+    def __init__(self, namespace: str = "default", lead_seconds: float = 3):
+        self.namespace = namespace
+        # Between dispatching a run and its synchronized start
+        self.lead_seconds = lead_seconds
+
+    def __enter__(self) -> "LoadPool":
+        return self
+
+    def __exit__(self, *exc):
+        self.delete()
+
+    def scale(self, extra_vars, timeout: float = 300) -> dict[str, list[str]]:
+        """Pod names of each role, once as many as the experiment needs are ready"""
+        pods = {}
+        for role, (_, _, instances) in ROLES.items():
+            replicas = extra_vars["exp_params"][instances]
+            try:
+                deployment = Deployment.get(pool_name(role), namespace=self.namespace)
+                if deployment.replicas != replicas:
+                    deployment.scale(replicas)
+            except kr8s.NotFoundError:
+                pool_deployment(role, replicas, self.namespace).create()
+            pods[role] = self._ready_pods(role, replicas, timeout)
+        return pods
+
+    def _ready_pods(self, role: str, replicas: int, timeout: float) -> list[str]:
+        deadline = time.monotonic() + timeout
+        while True:
+            pods = [
+                pod.name
+                for pod in SyncPod.list(
+                    namespace=self.namespace,
+                    label_selector={"app": pool_name(role)},
+                )
+                if "deletionTimestamp" not in pod.metadata and pod.ready()
+            ]
+            if len(pods) == replicas:
+                return sorted(pods)
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{len(pods)}/{replicas} {role} pods ready")
+            time.sleep(1)
+
+    @staticmethod
+    async def _exec(pod: Pod, command: str) -> str:
+        result = await pod.exec(["/bin/sh", "-c", command])
+        return result.stdout.decode("utf-8")
+
+    async def _dispatch(self, pod: Pod, role: str, args: str, run_id: str):
+        log, status = f"/tmp/runs/{run_id}.log", f"/tmp/runs/{run_id}.exit"
+        pid = f"/tmp/runs/{run_id}.pid"
+        run = f"echo $$ > {pid}; /tmp/{role}.sh {args} > {log} 2>&1; echo $? > {status}"
+        # Detached in its own process group, the exec returns at once
+        await self._exec(
+            pod, f"nohup setsid /bin/sh -c {shlex.quote(run)} > /dev/null 2>&1 &"
+        )
+
+    async def _stop(self, pod: Pod, run_id: str):
+        """Terminate the run in the pod, with the perf tool it started"""
+        pid = f"/tmp/runs/{run_id}.pid"
+        await self._exec(
+            pod, f"kill -TERM -- -$(cat {pid} 2>/dev/null) 2>/dev/null || true"
+        )
+
+    async def _wait(self, pod: Pod, run_id: str, interval: float) -> str:
+        status = f"/tmp/runs/{run_id}.exit"
+        while True:
+            exit_code = (
+                await self._exec(pod, f"cat {status} 2>/dev/null || true")
+            ).strip()
+            if exit_code == "0":
+                return pod.name
+            if exit_code:
+                log = await self._exec(pod, f"tail -n 20 /tmp/runs/{run_id}.log")
+                raise JobFailed(f"Pod {pod.name}: exit code {exit_code}\n{log}")
+            await asyncio.sleep(interval)
+
+    async def _run(
+        self,
+        pods: dict,
+        extra_vars,
+        interval: float,
+        finished: dict,
+        start_timestamp: int,
+    ):
+        pods = {
+            role: [await Pod.get(name, namespace=self.namespace) for name in names]
+            for role, names in pods.items()
+        }
+        run_id = uuid.uuid4().hex[:8]
+        waits = []
+        try:
+            await asyncio.gather(
+                *(
+                    self._dispatch(
+                        pod, role, ROLES[role][1](extra_vars, start_timestamp), run_id
+                    )
+                    for role, role_pods in pods.items()
+                    for pod in role_pods
+                )
+            )
+            waits = [
+                asyncio.ensure_future(self._wait(pod, run_id, interval))
+                for role_pods in pods.values()
+                for pod in role_pods
+            ]
+            # Fails with the first pod that does
+            for wait in asyncio.as_completed(waits):
+                finished[await wait] = time.time()
+        except BaseException:
+            # Failed or timed out, the runs left would go on loading the
+            # cluster during the next experiment
+            for wait in waits:
+                wait.cancel()
+            await asyncio.gather(
+                *(
+                    self._stop(pod, run_id)
+                    for role_pods in pods.values()
+                    for pod in role_pods
+                ),
+                return_exceptions=True,
+            )
+            raise
+
+    def run(self, extra_vars, interval: float = 1) -> dict[str, float]:
+        """
+        Run the load of the experiment on the pool, returns when each pod
+        finished as a unix timestamp. Raises JobFailed as soon as one fails,
+        asyncio.TimeoutError if the run outlasts its duration, and stops the
+        run in every pod in both cases
+        """
+        pods = self.scale(extra_vars)
+        start_timestamp = int(time.time() + self.lead_seconds)
+        # Counted from the synchronized start, as for the jobs
+        timeout = load_timeout(
+            start_timestamp, extra_vars["exp_params"]["durationSeconds"]
+        )
+        finished = {}
+
+        async def run():
+            await asyncio.wait_for(
+                self._run(pods, extra_vars, interval, finished, start_timestamp),
+                timeout,
+            )
+
+        try:
+            asyncio.run(run())
+        finally:
+            logging.warning(
+                dict(
+                    msg="Pool run",
+                    pods=sum(len(names) for names in pods.values()),
+                    finished=len(finished),
+                    last_finished=max(finished.values(), default=None),
+                )
+            )
+        return finished
+
+    def delete(self):
+        for role in ROLES:
+            deployment = pool_deployment(role, 0, self.namespace)
+            if deployment.exists():
+                deployment.delete()
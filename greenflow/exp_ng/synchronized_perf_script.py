@@ -1,3 +1,14 @@
+import time
+
+from box import Box
+
+# Seconds between creating the load and its synchronized start, for the pods
+# to be scheduled
+START_DELAY = 20
+# Seconds the scripts run past durationSeconds: their own extension of the
+# duration, then the grace period of the time bomb before it kills
+STOP_SECONDS = 5 + 5
+
 producer_script = """
 #!/bin/bash
 
@@ -201,12 +212,15 @@ kafka-consumer-perf-test \
     --timeout 100000000 &
 
 CONSUMER_PID=$!
+# Left by the time bomb once it stops the test
+TIMEBOMB_FIRED=$(mktemp -u)
 
 # Set up the time bomb
 (
     echo "Will stop the consumer test in $DURATION_SECONDS seconds at $(date -d @$((ACTUAL_START_TIME + DURATION_SECONDS)))"
     sleep "$DURATION_SECONDS"
     echo "Time's up! Stopping the consumer test."
+    touch "$TIMEBOMB_FIRED"
     kill -TERM $CONSUMER_PID
     sleep 5
     if kill -0 $CONSUMER_PID 2>/dev/null; then
@@ -231,7 +245,52 @@ echo "Consumer test ended at: $(date -d @$END_TIME)"
 ACTUAL_DURATION=$((END_TIME - ACTUAL_START_TIME))
 echo "Total consumer test duration: $ACTUAL_DURATION seconds"
 
+# Stopped by the signals of the time bomb, 143 after SIGTERM or 137 if it had
+# to be killed, as every run that lasts its duration is: that is a success
+if [ -e "$TIMEBOMB_FIRED" ]; then
+    rm -f "$TIMEBOMB_FIRED"
+    if [ "$TEST_EXIT_STATUS" -eq 143 ] || [ "$TEST_EXIT_STATUS" -eq 137 ]; then
+        exit 0
+    fi
+fi
+
 # Exit with the status of the consumer test
 exit $TEST_EXIT_STATUS
 
 """
+
+
+def load_timeout(start_timestamp: int, duration: float, margin: float = 20) -> float:
+    """
+    Seconds from now until the scripts started at start_timestamp must have
+    exited, with a margin for the pods that start late
+    """
+    return start_timestamp - time.time() + duration + STOP_SECONDS + margin
+
+
+def consumer_args(extra_vars, start_timestamp: int) -> str:
+    exp_params = extra_vars["exp_params"]
+    return f"""\
+    --topic {exp_params['topic_name']} \\
+    --bootstrap-server {exp_params['kafka_bootstrap_servers']} \\
+    --durationSeconds {exp_params['durationSeconds']} \\
+    --start-timestamp {start_timestamp}"""
+
+
+def producer_args(extra_vars, start_timestamp: int) -> str:
+    exp_params = Box(extra_vars).exp_params
+    load = exp_params.load / exp_params.producer_instances
+    total_messages = load * exp_params.durationSeconds
+    if load == 1 * 10**9:
+        throughput = -1
+    else:
+        throughput = int(load)
+    return f"""\
+    --topic {exp_params.topic_name} \\
+    --num-records {int(total_messages)} \\
+    --record-size {exp_params.messageSize} \\
+    --throughput {throughput} \\
+    --bootstrap-servers {exp_params.kafka_bootstrap_servers} \\
+    --producer-props "batch.size=32768" \\
+    --durationSeconds {exp_params.durationSeconds} \\
+    --start-timestamp {start_timestamp}"""
@@ -34,6 +34,8 @@ def exp_params(
     redpanda_write_caching: bool = True,
     replicationFactor: int = gin.REQUIRED,
     topic_name: str = gin.REQUIRED,
+    reuse_topic: bool = False,
+    watermark_baseline: int = 0,
     warmupSeconds: int = gin.REQUIRED,
     num_broker: int = gin.REQUIRED,
     num_worker: int = gin.REQUIRED,
@@ -56,6 +58,8 @@ def exp_params(
         "redpanda_write_caching": redpanda_write_caching,
         "replicationFactor": replicationFactor,
         "topic_name": topic_name,
+        "reuse_topic": reuse_topic,
+        "watermark_baseline": watermark_baseline,
         "warmupSeconds": warmupSeconds,
         "num_broker": num_broker,
         "num_worker": num_worker,
@@ -48,7 +48,7 @@ class _g:
                 return ExpStorage()
             elif self.deployment_type == "test":
                 return ExpStorage(
-                    path=f"{self.gitroot}/storage/test_experiment-history.yaml"
+                    path=f"{self.gitroot}/storage/test_experiment-history.jsonl"
                 )
 
     @cached_property
@@ -98,6 +98,10 @@ class _g:
         #     return
         self.storage.commit_experiment()
 
+        from .archive import archive_current_experiment
+
+        archive_current_experiment()
+
     @staticmethod
     def get_g() -> "_g":
         return _g()
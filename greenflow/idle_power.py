@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+from typing import Any, Optional
+
+# Idle power (W) of one broker node, measured per cluster and broker.
+# An exp_name of None applies to every broker on that cluster.
+# This is the first version of the table, new measurements are added to the
+# experiment store through save_idle_power() rather than edited here.
+DEFAULT_IDLE_POWER: list[dict[str, Any]] = [
+    {"cluster": "taurus", "exp_name": "ingest-redpanda", "idle_power": 31.63},
+    {"cluster": "taurus", "exp_name": "ingest-kafka", "idle_power": 32.63},
+    {"cluster": "grappe", "exp_name": "ingest-redpanda", "idle_power": 115.5 / 3},
+    {"cluster": "grappe", "exp_name": "ingest-kafka", "idle_power": 123.87 / 3},
+    {"cluster": "ovhnvme", "exp_name": "ingest-redpanda", "idle_power": 19.9},
+    {"cluster": "ovhnvme", "exp_name": "ingest-kafka", "idle_power": 20.5},
+    {"cluster": "ecotype", "exp_name": None, "idle_power": 28.3},
+    {"cluster": "parasilo", "exp_name": None, "idle_power": 28.3},
+    {"cluster": "parasilohdd", "exp_name": None, "idle_power": 28.3},
+]
+
+
+def idle_power_doc(
+    entries: list[dict[str, Any]], version: int, created_ts: Optional[str] = None
+) -> dict[str, Any]:
+    import pendulum
+
+    return {
+        "version": version,
+        "created_ts": created_ts or pendulum.now().to_iso8601_string(),
+        "entries": [
+            {
+                "cluster": entry["cluster"],
+                "exp_name": entry.get("exp_name"),
+                "idle_power": float(entry["idle_power"]),
+            }
+            for entry in entries
+        ],
+    }
@@ -4,7 +4,7 @@ from typing_extensions import TypedDict, NotRequired, Dict, Any, Optional, List
 from datetime import datetime
 from copy import deepcopy
 import pendulum
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from pymongo.collection import Collection
 from bson import ObjectId
 from os import getenv
@@ -27,6 +27,27 @@ class ExperimentDoc(TypedDict):
     experiment_metadata: ExperimentMetadata
 
 
+# Experiment parameters flattened into analysis rows, taken from the factors
+# first, then from the experiment description
+RELEVANT_PARAMS = [
+    "load",
+    "durationSeconds",
+    "messageSize",
+    "broker_cpu",
+    "broker_mem",
+    "cluster",
+    # "bw",
+    "broker_replicas",
+    "partitions",
+    "replicationFactor",
+    "producer_instances",
+    "consumer_instances",
+    "type",
+    "topic_name",
+    "watermark_baseline",
+]
+
+
 class Experiment(Persistent):
     def __init__(
         self,
@@ -160,8 +181,6 @@ class Experiment(Persistent):
 
     def calculate_results(self):
         self.results = {}
-        started_ts = pendulum.parse(self.started_ts)
-        stopped_ts = pendulum.parse(self.stopped_ts)
 
         # url = getenv("PROMETHEUS_URL")
 
@@ -177,10 +196,7 @@ class Experiment(Persistent):
         # grouped_min = data.groupby("instance")["value"].min()
         # joules = sum(grouped_max - grouped_min) / 10**6
 
-        duration = (
-            stopped_ts.diff(started_ts).seconds
-            + stopped_ts.diff(started_ts).microseconds / 10**6
-        )
+        duration = experiment_duration(self.started_ts, self.stopped_ts)
         self.results["duration"] = duration
         # self.results["total_host_energy"] = joules
         # self.results["avg_host_power"] = joules / duration
@@ -188,69 +204,220 @@ class Experiment(Persistent):
 
     def to_dict(self) -> dict:
         self.calculate_results()
-        metadata = self.experiment_metadata
-        params = metadata["factors"]["exp_params"]
-
-        # Parse experiment description parameters first
-        desc_params = {}
-
-        desc_parts = self.experiment_description.split()
-        for part in desc_parts:
-            if "=" in part:
-                key, value = part.split("=", 1)
-                desc_params[key] = value  # Store without prefix initially
-
-        # Define relevant parameters
-        relevant_params = [
-            "load",
-            "durationSeconds",
-            "messageSize",
-            "broker_cpu",
-            "broker_mem",
-            "cluster",
-            # "bw",
-            "broker_replicas",
-            "partitions",
-            "replicationFactor",
-            "producer_instances",
-            "consumer_instances",
-            "type",
+        return analysis_row(
+            self._id,
+            self.exp_name,
+            self.experiment_description,
+            self.started_ts,
+            self.stopped_ts,
+            self.experiment_metadata,
+        )
+
+
+def experiment_duration(started_ts: str, stopped_ts: str) -> float:
+    started_ts = pendulum.parse(started_ts)
+    stopped_ts = pendulum.parse(stopped_ts)
+    return (
+        stopped_ts.diff(started_ts).seconds
+        + stopped_ts.diff(started_ts).microseconds / 10**6
+    )
+
+
+def analysis_row(
+    _id: ObjectId,
+    exp_name: str,
+    experiment_description: str,
+    started_ts: str,
+    stopped_ts: str,
+    metadata: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Flat row of an experiment, as used by the analysis"""
+    params = metadata["factors"]["exp_params"]
+
+    # Parse experiment description parameters first
+    desc_params = {}
+
+    desc_parts = experiment_description.split()
+    for part in desc_parts:
+        if "=" in part:
+            key, value = part.split("=", 1)
+            desc_params[key] = value  # Store without prefix initially
+
+    result = {
+        "exp_id": str(_id),
+        "exp_name": exp_name,
+        "started_ts": started_ts,
+        "stopped_ts": stopped_ts,
+        **metadata.get("results", {}),
+    }
+
+    # Filter and add parameters from both sources
+    # Priority: metadata params first, then description params if not already present
+    filtered_params = {}
+    for param in RELEVANT_PARAMS:
+        if param in params:
+            filtered_params[param] = params[param]
+        elif param in desc_params:
+            filtered_params[f"{param}"] = desc_params[param]
+
+    # Ensure type is captured from description if present
+    if "type" in desc_params and "type" not in filtered_params:
+        filtered_params["type"] = desc_params["type"]
+
+    if filtered_params["cluster"] == "ovhnvme":
+        filtered_params["num_broker_nodes"] = 3
+        filtered_params["num_worker_nodes"] = 1
+    else:
+        children = metadata["deployment_metadata"]["ansible_inventory"]["all"][
+            "children"
         ]
+        broker_hosts = (children.get("broker") or {}).get("hosts") or {}
+        worker_hosts = (children.get("worker") or {}).get("hosts") or {}
+        filtered_params["num_broker_nodes"] = len(broker_hosts)
+        filtered_params["broker_nodes_list"] = ",".join(broker_hosts)
+        filtered_params["num_worker_nodes"] = len(worker_hosts)
+
+    return {**result, **filtered_params}
+
+
+class ExperimentRecord:
+    """
+    Read-only view of a stored experiment, built straight from its document.
+    Unlike Experiment it neither reads gin factors nor copies the metadata, so
+    it is cheap enough for listing and analysing many experiments.
+    """
+
+    __slots__ = (
+        "_id",
+        "exp_name",
+        "experiment_description",
+        "started_ts",
+        "stopped_ts",
+        "experiment_metadata",
+    )
+
+    def __init__(self, doc: ExperimentDoc):
+        init = object.__setattr__
+        init(self, "_id", doc.get("_id"))
+        init(self, "exp_name", doc.get("exp_name"))
+        init(self, "experiment_description", doc.get("experiment_description") or "")
+        init(self, "started_ts", doc.get("started_ts"))
+        init(self, "stopped_ts", doc.get("stopped_ts"))
+        init(self, "experiment_metadata", doc.get("experiment_metadata") or {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}({self.exp_name!r}, started_ts={self.started_ts!r})"
+        )
 
-        result = {
-            "exp_id": str(self._id),
-            "exp_name": self.exp_name,
-            "started_ts": self.started_ts,
-            "stopped_ts": self.stopped_ts,
-            **metadata.get("results", {}),
-        }
+    @property
+    def factors(self) -> Dict[str, Any]:
+        return self.experiment_metadata.get("factors", {})
 
-        # Filter and add parameters from both sources
-        # Priority: metadata params first, then description params if not already present
-        filtered_params = {}
-        for param in relevant_params:
-            if param in params:
-                filtered_params[param] = params[param]
-            elif param in desc_params:
-                filtered_params[f"{param}"] = desc_params[param]
-
-        # Ensure type is captured from description if present
-        if "type" in desc_params and "type" not in filtered_params:
-            filtered_params["type"] = desc_params["type"]
-
-        if filtered_params["cluster"] == "ovhnvme":
-            filtered_params["num_broker_nodes"] = 3
-            filtered_params["num_worker_nodes"] = 1
-        else:
-            filtered_params["num_broker_nodes"] = len(
-                self.experiment_metadata.deployment_metadata.ansible_inventory.all.children.broker.hosts
-            )
-            filtered_params["broker_nodes_list"] = ",".join([k[0] for k in self.experiment_metadata.deployment_metadata.ansible_inventory.all.children.broker.hosts.items()])
-            filtered_params["num_worker_nodes"] = len(
-                self.experiment_metadata.deployment_metadata.ansible_inventory.all.children.worker.hosts
-            )
+    @property
+    def results(self) -> Dict[str, Any]:
+        return self.experiment_metadata.get("results", {})
+
+    @property
+    def deployment_metadata(self) -> Dict[str, Any]:
+        return self.experiment_metadata.get("deployment_metadata", {})
+
+    def to_dict(self) -> dict:
+        return analysis_row(
+            self._id,
+            self.exp_name,
+            self.experiment_description,
+            self.started_ts,
+            self.stopped_ts,
+            {
+                **self.experiment_metadata,
+                "results": {
+                    "duration": experiment_duration(self.started_ts, self.stopped_ts)
+                },
+            },
+        )
+
+    def to_experiment(self) -> Experiment:
+        """Full, mutable Experiment, e.g. to update it"""
+        return Experiment.from_doc(
+            {
+                "_id": self._id,
+                "exp_name": self.exp_name,
+                "experiment_description": self.experiment_description,
+                "started_ts": self.started_ts,
+                "stopped_ts": self.stopped_ts,
+                "experiment_metadata": self.experiment_metadata,
+            }
+        )
 
-        return {**result, **filtered_params}
+
+def analysis_projection() -> Dict[str, Any]:
+    """
+    $project stage computing the row of Experiment.to_dict() on the server,
+    without sending the experiment metadata over the wire
+    """
+    hosts = "$experiment_metadata.deployment_metadata.ansible_inventory.all.children"
+    broker_hosts = {"$objectToArray": {"$ifNull": [f"{hosts}.broker.hosts", {}]}}
+    worker_hosts = {"$objectToArray": {"$ifNull": [f"{hosts}.worker.hosts", {}]}}
+
+    def param(name: str) -> Dict[str, Any]:
+        described = {
+            "$let": {
+                "vars": {
+                    "match": {
+                        "$regexFind": {
+                            "input": "$experiment_description",
+                            "regex": f"(?:^|\\s){name}=(\\S*)",
+                        }
+                    }
+                },
+                "in": {"$arrayElemAt": ["$$match.captures", 0]},
+            }
+        }
+        return {
+            "$ifNull": [
+                f"$experiment_metadata.factors.exp_params.{name}",
+                {"$ifNull": [described, "$$REMOVE"]},
+            ]
+        }
+
+    is_ovh = {"$eq": [param("cluster"), "ovhnvme"]}
+    return {
+        "_id": 1,
+        "exp_id": {"$toString": "$_id"},
+        "exp_name": 1,
+        "started_ts": 1,
+        "stopped_ts": 1,
+        "duration": "$experiment_metadata.results.duration",
+        **{name: param(name) for name in RELEVANT_PARAMS},
+        "num_broker_nodes": {"$cond": [is_ovh, 3, {"$size": broker_hosts}]},
+        "broker_nodes_list": {
+            "$cond": [
+                is_ovh,
+                "$$REMOVE",
+                {
+                    "$reduce": {
+                        "input": broker_hosts,
+                        "initialValue": "",
+                        "in": {
+                            "$concat": [
+                                "$$value",
+                                {"$cond": [{"$eq": ["$$value", ""]}, "", ","]},
+                                "$$this.k",
+                            ]
+                        },
+                    }
+                },
+            ]
+        },
+        "num_worker_nodes": {"$cond": [is_ovh, 1, {"$size": worker_hosts}]},
+    }
 
 
 class ExpStorage:
@@ -264,6 +431,7 @@ class ExpStorage:
         self.db = self.client[db_name]
         self.collection: Collection[ExperimentDoc] = self.db.experiments
         self.results_collection: Collection[ExperimentDoc] = self.db.results
+        self.idle_power_collection: Collection = self.db.idle_power
 
         # Update indexes for common queries
         self.collection.create_index("exp_name")
@@ -272,6 +440,7 @@ class ExpStorage:
         self.collection.create_index(
             "experiment_metadata.factors.exp_params"
         )  # Index for params
+        self.idle_power_collection.create_index("version", unique=True)
 
     def save_experiment(self, experiment: Experiment) -> ObjectId:
         doc = experiment.to_doc()
@@ -286,15 +455,17 @@ class ExpStorage:
         result = self.collection.insert_one(doc)
         return result.inserted_id
 
-    def find_experiments_by_name(self, name: str) -> List[Experiment]:
+    def find_experiments_by_name(self, name: str) -> List[ExperimentRecord]:
         docs = self.collection.find({"exp_name": name})
-        return [Experiment.from_doc(doc) for doc in docs]
+        return [ExperimentRecord(doc) for doc in docs]
 
-    def find_experiments_by_name(self, name: str) -> List[Experiment]:
+    def find_experiments_by_name(self, name: str) -> List[ExperimentRecord]:
         docs = self.collection.find({"exp_name": name})
-        return [Experiment.from_doc(doc) for doc in docs]
+        return [ExperimentRecord(doc) for doc in docs]
 
-    def find_experiments_by_params(self, params: Dict[str, Any]) -> List[Experiment]:
+    def find_experiments_by_params(
+        self, params: Dict[str, Any]
+    ) -> List[ExperimentRecord]:
         """Find experiments matching specific experiment parameters"""
         query = {
             f"experiment_metadata.factors.exp_params.{k}": deepcopy(v)
@@ -304,16 +475,20 @@ class ExpStorage:
         docs = self.collection.find(query)
         # for doc in docs:
         #     print(f"Found document: {doc}")
-        return [Experiment.from_doc(doc) for doc in docs]
+        return [ExperimentRecord(doc) for doc in docs]
 
-    def find_experiments_by_deployment_ts(self, deployment_ts: str) -> List[Experiment]:
+    def find_experiments_by_deployment_ts(
+        self, deployment_ts: str
+    ) -> List[ExperimentRecord]:
         docs = self.collection.find(
             {"experiment_metadata.deployment_metadata.job_started_ts": deployment_ts},
             sort=[("started_ts", -1)],  # 1 for ascending, -1 for descending
         )
-        return [Experiment.from_doc(doc) for doc in docs]
+        return [ExperimentRecord(doc) for doc in docs]
 
-    def find_experiments_by_timerange(self, start: str, end: str) -> List[Experiment]:
+    def find_experiments_by_timerange(
+        self, start: str, end: str
+    ) -> List[ExperimentRecord]:
         docs = self.collection.find(
             {
                 "started_ts": {
@@ -322,13 +497,70 @@ class ExpStorage:
                 }
             }
         )
-        return [Experiment.from_doc(doc) for doc in docs]
+        return [ExperimentRecord(doc) for doc in docs]
+
+    def find_analysis_rows(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Flat Experiment.to_dict() rows of the experiments matching query, most
+        recent first, each with its stored enriched result under "stored"
+        (None if it was never enriched)
+        """
+        return self.collection.aggregate(
+            [
+                {"$match": query},
+                {"$sort": {"started_ts": -1}},
+                {"$project": analysis_projection()},
+                {
+                    "$lookup": {
+                        "from": self.results_collection.name,
+                        "localField": "_id",
+                        "foreignField": "_id",
+                        "as": "stored",
+                    }
+                },
+                {
+                    "$set": {
+                        "stored": {"$ifNull": [{"$arrayElemAt": ["$stored", 0]}, None]}
+                    }
+                },
+            ]
+        ).to_list()
+
+    def upsert_results(
+        self, results: List[Dict[str, Any]], chunk_size: int = 1000
+    ) -> List[Dict[str, Any]]:
+        """
+        Upsert enriched results by _id with unordered bulk writes, chunk_size
+        operations at a time. Returns the count and duration of every chunk.
+        """
+        import time
+
+        timings = []
+        for i in range(0, len(results), chunk_size):
+            chunk = results[i : i + chunk_size]
+            operations = [
+                UpdateOne(
+                    {"_id": result["_id"]},
+                    # _id is immutable, only set the other fields
+                    {"$set": {k: v for k, v in result.items() if k != "_id"}},
+                    upsert=True,
+                )
+                for result in chunk
+            ]
+            start = time.perf_counter()
+            self.results_collection.bulk_write(operations, ordered=False)
+            timings.append(
+                {"count": len(chunk), "seconds": time.perf_counter() - start}
+            )
+        return timings
 
-    def get_all_experiments(self) -> List[Experiment]:
+    def get_all_experiments(self) -> List[ExperimentRecord]:
         docs = self.collection.find({})
-        return [Experiment.from_doc(doc) for doc in docs]
+        return [ExperimentRecord(doc) for doc in docs]
 
     def update_experiment(self, experiment: Experiment) -> None:
+        if isinstance(experiment, ExperimentRecord):
+            experiment = experiment.to_experiment()
         if not experiment._id:
             raise ValueError("Cannot update experiment without _id")
         self.collection.update_one(
@@ -337,3 +569,30 @@ class ExpStorage:
 
     def delete_experiment(self, experiment_id: ObjectId) -> None:
         self.collection.delete_one({"_id": experiment_id})
+
+    def get_idle_power(self, version: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Idle power table at the given version, latest if None. The table is
+        seeded with DEFAULT_IDLE_POWER as version 1 on first use.
+        """
+        from .idle_power import DEFAULT_IDLE_POWER, idle_power_doc
+
+        if self.idle_power_collection.count_documents({}, limit=1) == 0:
+            self.idle_power_collection.insert_one(
+                idle_power_doc(DEFAULT_IDLE_POWER, version=1)
+            )
+        query = {} if version is None else {"version": version}
+        doc = self.idle_power_collection.find_one(
+            query, {"_id": 0}, sort=[("version", -1)]
+        )
+        if doc is None:
+            raise ValueError(f"No idle power table with version {version}")
+        return doc
+
+    def save_idle_power(self, entries: List[Dict[str, Any]]) -> int:
+        """Store entries as a new version of the idle power table"""
+        from .idle_power import idle_power_doc
+
+        version = self.get_idle_power()["version"] + 1
+        self.idle_power_collection.insert_one(idle_power_doc(entries, version))
+        return version
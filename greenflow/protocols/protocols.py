@@ -1,8 +1,9 @@
 from pdb import post_mortem
 import time
 from box import Box
-from greenflow.exp_ng.hammer import hammer, stress_test
+from greenflow.exp_ng.hammer import StressTestPipeline, hammer, stress_test
 from greenflow.exp_ng.exp_ng import killexp
+from greenflow.exp_ng.pool import LoadPool
 from entrypoint import (
     rebind_parameters,
     load_gin,
@@ -293,14 +294,15 @@ def safety_curve(exp_description) -> None:
         )
 
         # Message sizes up to 1MB (with
-        with ctx_manager():
+        with (
+            ctx_manager(),
+            LoadPool() as pool,
+            StressTestPipeline(exp_description, pool=pool) as pipeline,
+        ):
             for _ in range(rep):
                 for messageSize in messageSizes:
                     rebind_parameters(messageSize=messageSize)
-                    stress_test(
-                        target_load=1 * 10**9,
-                        exp_description=exp_description,
-                    )
+                    pipeline.run(target_load=1 * 10**9)
 
     send_notification("Experiment complete. On to the next.")
 
@@ -331,14 +333,21 @@ def partitioning(exp_description) -> None:
             producerInstances=workers * 8,
             messageSize=4096,
         )
-        with ctx_manager():
-            for partition in partitions:
-                rebind_parameters(partitions=partition)
-                for _ in range(3):
-                    stress_test(
-                        target_load=1 * 10**9,
-                        exp_description=exp_description,
-                    )
+        # Repetitions truncate the topic instead of recreating every partition,
+        # only within this protocol
+        reuse_topic = factors()["exp_params"]["reuse_topic"]
+        rebind_parameters(reuse_topic=True)
+        try:
+            with ctx_manager():
+                for partition in partitions:
+                    rebind_parameters(partitions=partition)
+                    for _ in range(3):
+                        stress_test(
+                            target_load=1 * 10**9,
+                            exp_description=exp_description,
+                        )
+        finally:
+            rebind_parameters(reuse_topic=reuse_topic)
 
     send_notification("Experiment complete. On to the next.")
 
@@ -1,20 +1,50 @@
+import sys
+
 class ExpStorage:
     from .g import g
 
-    def __init__(self, path=f"{g.gitroot}/storage/experiment-history.yaml") -> None:
-        from tinydb import TinyDB
-        from tinydb_serialization import SerializationMiddleware
-
-        from .utils import DateTimeSerializer, YAMLStorage
+    def __init__(self, path=f"{g.gitroot}/storage/experiment-history.jsonl") -> None:
+        from .utils import AppendOnlyTinyDB, JSONLinesStorage
 
-        serialization = SerializationMiddleware(YAMLStorage)
-        serialization.register_serializer(DateTimeSerializer(), "Pendulum")
-        self.experiments = TinyDB(
+        self.experiments = AppendOnlyTinyDB(
             path,
-            storage=serialization,
+            storage=JSONLinesStorage,
+            # History written before the append-only log, imported on first use
+            migrate_from=path.replace(".jsonl", ".yaml"),
         )
 
     def commit_experiment(self) -> None:
         from .g import g
 
         self.experiments.insert(g.root.current_experiment.to_dict())
+        # Only analysis caches an index of the experiments, if it is loaded
+        tiny = sys.modules.get("greenflow.analysis.tiny")
+        if tiny is not None:
+            tiny.invalidate_experiment_index()
+
+    def get_idle_power(self, version=None) -> dict:
+        """
+        Idle power table at the given version, latest if None. The table is
+        seeded with DEFAULT_IDLE_POWER as version 1 on first use.
+        """
+        from tinydb import Query
+
+        from .idle_power import DEFAULT_IDLE_POWER, idle_power_doc
+
+        table = self.experiments.table("idle_power")
+        if not len(table):
+            table.insert(idle_power_doc(DEFAULT_IDLE_POWER, version=1))
+        if version is None:
+            return max(table.all(), key=lambda doc: doc["version"])
+        docs = table.search(Query().version == version)
+        if not docs:
+            raise ValueError(f"No idle power table with version {version}")
+        return docs[0]
+
+    def save_idle_power(self, entries) -> int:
+        """Store entries as a new version of the idle power table"""
+        from .idle_power import idle_power_doc
+
+        version = self.get_idle_power()["version"] + 1
+        self.experiments.table("idle_power").insert(idle_power_doc(entries, version))
+        return version
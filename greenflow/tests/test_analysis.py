@@ -0,0 +1,1117 @@
+import os
+
+os.environ.setdefault("PROMETHEUS_URL", "http://localhost:9090")
+
+from collections import defaultdict
+
+import httpx
+import numpy as np
+import pandas as pd
+import pendulum
+import pytest
+
+from greenflow.analysis import utils
+from greenflow.analysis.promclient import query_cache
+
+
+@pytest.fixture(autouse=True)
+def no_query_cache(monkeypatch):
+    # Results cached by a local Redis must not leak into the tests
+    monkeypatch.setattr(query_cache, "enabled", False)
+
+
+class FakePrometheus:
+    """Answers instant queries from a dict of metric name -> list of series"""
+
+    def __init__(self, series):
+        self.series = series
+        self.queries = []
+
+    def custom_query(self, query, params=None):
+        self.queries.append(query)
+        for metric, result in self.series.items():
+            if metric in query:
+                return result
+        return []
+
+
+def series(value, **labels):
+    return {"metric": labels, "value": [0, str(value)]}
+
+
+@pytest.fixture
+def experiments() -> pd.DataFrame:
+    return pd.DataFrame(
+        [
+            {
+                "exp_id": "a",
+                "exp_name": "ingest-kafka",
+                "started_ts": "2025-01-10T12:00:00+01:00",
+                "stopped_ts": "2025-01-10T12:02:00+01:00",
+                "load": 1000,
+                "durationSeconds": 100,
+                "messageSize": 1024,
+                "broker_replicas": 2,
+                "num_broker_nodes": 2,
+                "cluster": "taurus",
+            },
+            {
+                "exp_id": "b",
+                "exp_name": "ingest-redpanda",
+                "started_ts": "2025-01-10T13:00:00+00:00",
+                "stopped_ts": "2025-01-10T13:02:00+00:00",
+                "load": 2000,
+                "durationSeconds": 100,
+                "messageSize": 1024,
+                "broker_replicas": 2,
+                "num_broker_nodes": 3,
+                "cluster": "taurus",
+            },
+        ]
+    ).set_index("exp_id")
+
+
+@pytest.fixture
+def prom(monkeypatch):
+    fake = FakePrometheus(
+        {
+            "kminion_kafka_topic_high_water_mark_sum": [
+                series(
+                    100000,
+                    experiment_started_ts="2025-01-10T12:00:00+01:00",
+                    namespace="default",
+                    topic_name="input",
+                ),
+                series(
+                    150000,
+                    experiment_started_ts="2025-01-10T13:00:00+00:00",
+                    namespace="redpanda",
+                    topic_name="input",
+                ),
+                # Same experiment, wrong namespace: must not be picked up
+                series(
+                    1,
+                    experiment_started_ts="2025-01-10T13:00:00+00:00",
+                    namespace="default",
+                    topic_name="input",
+                ),
+                # Topic of the previous experiment, still being deleted
+                series(
+                    2,
+                    experiment_started_ts="2025-01-10T13:00:00+00:00",
+                    namespace="redpanda",
+                    topic_name="input-1",
+                ),
+            ],
+            "kminion_end_to_end_roundtrip_latency_seconds_bucket": [
+                series(
+                    0.25,
+                    experiment_started_ts="2025-01-10T12:00:00+01:00",
+                    namespace="default",
+                ),
+            ],
+            "scaph_host_power_microwatts": [
+                series(100, experiment_started_ts="2025-01-10T12:00:00+01:00"),
+                series(80, experiment_started_ts="2025-01-10T13:00:00+00:00"),
+            ],
+            "node_network_receive_bytes_total": [
+                series(0.5, experiment_started_ts="2025-01-10T12:00:00+01:00"),
+            ],
+        }
+    )
+    monkeypatch.setattr(utils, "prom", fake)
+    return fake
+
+
+class TestBatchedEnrichment:
+    def test_batch_window_covers_all_experiments(self, experiments):
+        at, window = utils.get_batch_window(experiments, buffer_minutes=5)
+
+        # 11:00Z - 5m to 13:02Z + 5m
+        assert at == pendulum.parse("2025-01-10T13:07:00Z")
+        assert window == f"{2 * 3600 + 12 * 60 + 1}s"
+
+    def test_one_query_per_metric(self, experiments, prom):
+        utils.enrich_dataframe(experiments, batched=True)
+
+        assert len(prom.queries) == len(utils.BATCHED_CALCULATIONS)
+
+    def test_rows_use_their_topic(self, experiments, prom):
+        experiments["topic_name"] = [None, "input-1"]
+        df = utils.enrich_dataframe(
+            experiments,
+            batched=True,
+            calculations=[utils.calculate_observed_throughput],
+        )
+
+        assert df.loc["a", "observed_throughput"] == 1000
+        assert df.loc["b", "observed_throughput"] == 2 / 100
+
+    def test_reused_topics_subtract_their_baseline(self, experiments, prom):
+        experiments["watermark_baseline"] = [40000, None]
+        df = utils.enrich_dataframe(
+            experiments,
+            batched=True,
+            calculations=[utils.calculate_observed_throughput],
+        )
+
+        assert df.loc["a", "observed_throughput"] == 600
+        assert df.loc["b", "observed_throughput"] == 1500
+
+        # The same from a single row and its samples
+        row = utils.observed_throughput_from(
+            experiments.loc["a"].copy(),
+            [{"metric": {}, "values": [[0, "0"], [100, "100000"]]}],
+        )
+        assert row["observed_throughput"] == 600
+
+    def test_long_spans_are_split(self, experiments, prom):
+        later = experiments.loc[["a"]].rename(index={"a": "c"})
+        later["started_ts"] = "2025-01-20T12:00:00+00:00"
+        later["stopped_ts"] = "2025-01-20T12:02:00+00:00"
+        experiments = pd.concat([later, experiments])
+
+        groups = utils.batch_groups(experiments)
+        assert [list(group) for group in groups] == [["a", "b"], ["c"]]
+
+        df = utils.enrich_dataframe(experiments, batched=True)
+        assert len(prom.queries) == 2 * len(utils.BATCHED_CALCULATIONS)
+        assert list(df.index) == ["c", "a", "b"]
+        assert df.loc["a", "observed_throughput"] == 1000
+
+    def test_failed_batch_falls_back_per_row(self, experiments, prom, monkeypatch):
+        def fail(df, at, window):
+            raise RuntimeError("too many points")
+
+        def prefetch(df, calculations, **kwargs):
+            samples = [{"metric": {}, "values": [[0, "0"], [100, "50000"]]}]
+            return {
+                (calc, index): samples for calc in calculations for index in df.index
+            }
+
+        monkeypatch.setitem(
+            utils.BATCHED_CALCULATIONS, utils.calculate_observed_throughput, fail
+        )
+        monkeypatch.setattr(utils, "prefetch", prefetch)
+        df = utils.enrich_dataframe(
+            experiments,
+            batched=True,
+            calculations=[utils.calculate_observed_throughput],
+        )
+
+        assert list(df["observed_throughput"]) == [500, 500]
+
+    def test_results_are_joined_onto_rows(self, experiments, prom):
+        df = utils.enrich_dataframe(experiments, batched=True)
+
+        assert df.loc["a", "observed_throughput"] == 1000
+        assert df.loc["b", "observed_throughput"] == 1500
+        assert df.loc["a", "latency_p99"] == 0.25
+        assert df.loc["b", "latency_p99"] == 0
+        assert df.loc["a", "average_power"] == 100
+        assert df.loc["b", "average_unit_power"] == 40
+        assert df.loc["a", "network_saturation"] == 0.5
+        assert pd.isna(df.loc["b", "network_saturation"])
+        assert df.loc["b", "throughput_gap_percentage"] == -25
+
+    def test_empty_window_matches_row_wise(self, experiments, monkeypatch):
+        calculations = [utils.calculate_latency, utils.calculate_average_power]
+        monkeypatch.setattr(utils, "prom", FakePrometheus({}))
+        batched = utils.enrich_dataframe(
+            experiments.copy(), batched=True, calculations=calculations
+        )
+
+        monkeypatch.setattr(
+            utils, "fetch_all", lambda queries, **kwargs: dict.fromkeys(queries, [])
+        )
+        row_wise = utils.enrich_dataframe(experiments.copy(), calculations=calculations)
+
+        columns = ["latency_p99", "average_power"]
+        pd.testing.assert_frame_equal(
+            batched[columns], row_wise[columns], check_dtype=False
+        )
+        assert list(batched["latency_p99"]) == [0, 0]
+        assert list(batched["average_power"]) == [0, 0]
+        # Not computed per row either
+        assert batched["average_unit_power"].isna().all()
+        assert "average_unit_power" not in row_wise
+
+
+def prometheus_transport(responses, requests):
+    """MockTransport replying with the given status codes in order, then data"""
+
+    def handler(request):
+        requests.append(request)
+        status = responses.pop(0) if responses else 200
+        if status != 200:
+            return httpx.Response(status)
+        query = request.url.params["query"]
+        return httpx.Response(
+            200,
+            json={
+                "status": "success",
+                "data": {
+                    "resultType": "matrix",
+                    "result": [
+                        {
+                            "metric": {"query": query},
+                            "values": [[0, "1"], [5, "3"]],
+                        }
+                    ],
+                },
+            },
+        )
+
+    return httpx.MockTransport(handler)
+
+
+class TestAsyncPrometheus:
+    def test_retries_with_backoff(self):
+        from greenflow.analysis.promclient import AsyncPrometheus, RangeQuery, run
+
+        requests = []
+        transport = prometheus_transport([503, 502], requests)
+
+        async def go():
+            async with AsyncPrometheus(
+                "http://prometheus", backoff=0, transport=transport
+            ) as client:
+                return await client.fetch(
+                    RangeQuery(
+                        "up",
+                        pendulum.parse("2025-01-10T12:00:00Z"),
+                        pendulum.parse("2025-01-10T12:01:00Z"),
+                        step="5s",
+                    )
+                )
+
+        result = run(go())
+
+        assert len(requests) == 3
+        assert requests[-1].url.path == "/api/v1/query_range"
+        assert result[0]["values"][-1] == [5, "3"]
+
+    def test_gives_up_after_retries(self):
+        from greenflow.analysis.promclient import AsyncPrometheus, run
+
+        requests = []
+        transport = prometheus_transport([503] * 10, requests)
+
+        async def go():
+            async with AsyncPrometheus(
+                "http://prometheus", retries=2, backoff=0, transport=transport
+            ) as client:
+                return await client.custom_query("up")
+
+        with pytest.raises(httpx.HTTPStatusError):
+            run(go())
+        assert len(requests) == 3
+
+    def test_step_follows_scrape_interval_and_window(self):
+        from greenflow.analysis.promclient import pick_step
+
+        start = pendulum.parse("2025-01-10T12:00:00Z")
+        assert pick_step(start, start.add(minutes=10)) == 5
+        # 11000 points of 5s are a bit over 15 hours
+        assert pick_step(start, start.add(hours=16)) == 10
+        assert pick_step(start, start.add(days=30), scrape_interval=15) == 240
+
+    def test_long_windows_are_chunked_and_stitched(self):
+        from greenflow.analysis.promclient import (
+            AUTO,
+            AsyncPrometheus,
+            RangeQuery,
+            run,
+            split_range,
+        )
+
+        start = pendulum.parse("2025-01-10T12:00:00Z")
+        query = RangeQuery("up", start, start.add(hours=2, seconds=5), step=AUTO)
+        chunks = split_range(query)
+
+        assert [c.start_time for c in chunks] == [
+            start,
+            start.add(hours=1),
+            start.add(hours=2),
+        ]
+        assert chunks[0].end_time == start.add(minutes=59, seconds=55)
+        assert chunks[-1].end_time == query.end_time
+        assert {c.step for c in chunks} == {"5s"}
+
+        def handler(request):
+            begin = int(request.url.params["start"])
+            end = int(request.url.params["end"])
+            values = [[t, str(t - begin)] for t in range(begin, end + 1, 5)]
+            return httpx.Response(
+                200,
+                json={
+                    "status": "success",
+                    "data": {
+                        "resultType": "matrix",
+                        "result": [{"metric": {"job": "x"}, "values": values}],
+                    },
+                },
+            )
+
+        async def go():
+            async with AsyncPrometheus(
+                "http://prometheus", transport=httpx.MockTransport(handler), cache=None
+            ) as client:
+                return await client.fetch(query)
+
+        (result,) = run(go())
+        timestamps = result["values"][:, 0]
+
+        assert result["metric"] == {"job": "x"}
+        assert len(timestamps) == 2 * 720 + 2
+        assert (np.diff(timestamps) == 5).all()
+
+    def test_enrich_fetches_rows_concurrently(self, experiments, monkeypatch):
+        fetched = {}
+
+        def fake_fetch_all(queries, **kwargs):
+            fetched.update(queries)
+            return {
+                key: [
+                    {
+                        "metric": {"experiment_started_ts": "x"},
+                        "values": [[0, "100000"], [5, "200000"]],
+                    }
+                ]
+                for key in queries
+            }
+
+        monkeypatch.setattr(utils, "fetch_all", fake_fetch_all)
+        monkeypatch.setattr(utils, "prom", None)  # No serial queries allowed
+
+        df = utils.enrich_dataframe(experiments)
+
+        # 4 PromQL calculations for each of the 2 rows
+        assert len(fetched) == 8
+        assert df.loc["a", "observed_throughput"] == 2000
+        assert df.loc["b", "latency_p99"] == 200000
+
+    def test_scalar_mode_reduces_server_side(self, experiments, monkeypatch):
+        fetched = {}
+
+        def fake_fetch_all(queries, **kwargs):
+            fetched.update(queries)
+            return {
+                key: (
+                    [{"metric": {}, "value": [0, "3"]}]
+                    if query.step == utils.INSTANT
+                    else [{"metric": {}, "values": [[0, "1"], [5, "3"]]}]
+                )
+                for key, query in queries.items()
+            }
+
+        monkeypatch.setattr(utils, "fetch_all", fake_fetch_all)
+        monkeypatch.setattr(utils, "prom", None)
+
+        df = utils.enrich_dataframe(
+            experiments,
+            scalar=True,
+            calculations=[
+                utils.calculate_average_power,
+                utils.calculate_network_saturation,
+                utils.calculate_latency,
+            ],
+        )
+
+        power = fetched[(utils.calculate_average_power, "a")]
+        assert power.step == utils.INSTANT
+        # 2 minutes of experiment plus a minute on both sides, as the range query
+        assert "[240s:5s]" in power.query
+        assert power.end_time == pendulum.parse("2025-01-10T12:03:00+01:00")
+        assert fetched[(utils.calculate_latency, "a")].step == utils.AUTO
+        assert df.loc["a", "average_power"] == 3
+        assert df.loc["a", "average_unit_power"] == 1.5
+        assert df.loc["b", "network_saturation"] == 3
+        assert df.loc["b", "latency_p99"] == 3
+
+
+@pytest.fixture
+def enriched() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "exp_name": ["ingest-kafka", "ingest-redpanda", "ingest-kafka", "x"],
+            "cluster": ["taurus", "grappe", "ovhnvme", "chiclet"],
+            "load": [1000, 2000, 0, 500],
+            "observed_throughput": [900.0, 2000.0, float("NaN"), 400.0],
+            "messageSize": [1024, 2048, 1024, 512],
+            "average_power": [120.0, 300.0, 0.0, 50.0],
+            "broker_replicas": [2, 3, 1, 1],
+            "num_broker_nodes": [3, 3, 3, 2],
+            "broker_cpu": ["4", "8", "2", "16"],
+        },
+        index=["a", "b", "c", "d"],
+    )
+
+
+class TestVectorizedCalculations:
+    @pytest.mark.parametrize(
+        "calc",
+        [
+            utils.calculate_throughput_MBps,
+            utils.calculate_throughput_gap,
+            utils.calculate_throughput_per_watt,
+            utils.calculate_energy_cost,
+            utils.convert_broker_cpu,
+        ],
+    )
+    def test_matches_row_wise(self, enriched, calc):
+        enriched = utils.vectorized_throughput_MBps(enriched)[0]
+        vectorized, _ = utils.VECTORIZED_CALCULATIONS[calc]
+
+        expected = enriched.apply(lambda row: utils.safe_calculate(row, calc), axis=1)
+        result, _ = vectorized(enriched.copy())
+
+        pd.testing.assert_frame_equal(
+            result[expected.columns], expected, check_dtype=False
+        )
+
+    def test_errors_are_kept_as_mask(self, enriched):
+        enriched.loc["b", "cluster"] = "taurus"
+        enriched.loc["b", "exp_name"] = "theodolite"
+        enriched.loc["c", "observed_throughput"] = 0
+        enriched.loc["d", "broker_cpu"] = "lots"
+
+        df = utils.vectorized_throughput_MBps(enriched)[0]
+        df, energy_cost_errors = utils.vectorized_energy_cost(df)
+        df, gap_errors = utils.vectorized_throughput_gap(df)
+        df, broker_cpu_errors = utils.vectorized_broker_cpu(df)
+
+        # Unknown idle power for taurus without a known broker
+        assert energy_cost_errors.tolist() == [False, True, False, False]
+        assert pd.isna(df.loc["b", "energy_cost"])
+        assert df.loc["c", "energy_cost"] == 0
+        assert not gap_errors.any()
+        assert pd.isna(df.loc["c", "throughput_gap_percentage"])
+        assert broker_cpu_errors.tolist() == [False, False, False, True]
+        assert df.loc["a", "broker_cpu"] == 4
+        assert df.loc["d", "broker_cpu"] == "lots"
+
+
+class TestIdlePower:
+    def test_new_cluster_without_code_change(self, enriched):
+        table = utils.load_idle_power_table()
+        table = pd.concat(
+            [
+                table,
+                pd.DataFrame(
+                    [{"cluster": "chiclet", "exp_name": None, "idle_power": 40.0}]
+                ),
+            ],
+            ignore_index=True,
+        )
+        table.attrs["version"] = 2
+
+        df = utils.vectorized_throughput_MBps(enriched)[0]
+        df, errors = utils.vectorized_energy_cost(df, table)
+
+        # chiclet: 50W - 40W * (2 - 1) idle broker node
+        assert df.loc["d", "adjusted_power"] == 10
+        assert (df["idle_power_version"] == 2).all()
+        assert not errors.any()
+
+    def test_exact_broker_match_wins(self):
+        table = pd.DataFrame(
+            [
+                {"cluster": "taurus", "exp_name": None, "idle_power": 1.0},
+                {"cluster": "taurus", "exp_name": "ingest-kafka", "idle_power": 2.0},
+            ]
+        )
+        df = pd.DataFrame(
+            {
+                "cluster": ["taurus", "taurus", "unknown"],
+                "exp_name": ["ingest-kafka", "ingest-redpanda", "ingest-kafka"],
+            }
+        )
+
+        assert utils.idle_power_base(df, table).tolist() == [2.0, 1.0, 0.0]
+
+
+class TestCalculationVersions:
+    def test_new_experiment_needs_everything(self):
+        assert utils.stale_calculations({}) == utils.ENABLED_CALCULATIONS
+
+    def test_up_to_date_result_needs_nothing(self):
+        versions = {
+            name: calculation.version
+            for name, calculation in utils.CALCULATIONS.items()
+        }
+        assert utils.stale_calculations(versions) == []
+
+    def test_outdated_calculation_and_dependents(self):
+        versions = {
+            name: calculation.version
+            for name, calculation in utils.CALCULATIONS.items()
+        }
+        versions["observed_throughput"] -= 1
+
+        assert utils.stale_calculations(versions) == [
+            "observed_throughput",
+            "throughput_MBps",
+            "energy_cost",
+            "throughput_gap",
+        ]
+
+    def test_newly_enabled_calculation(self):
+        versions = {name: 1 for name in utils.ENABLED_CALCULATIONS}
+        enabled = [*utils.ENABLED_CALCULATIONS, "disk_throughput"]
+
+        assert utils.stale_calculations(versions, enabled) == ["disk_throughput"]
+
+    def test_missing_column_is_stale(self):
+        versions = {
+            name: calculation.version
+            for name, calculation in utils.CALCULATIONS.items()
+        }
+        stored = {
+            column: 1.0
+            for name in utils.ENABLED_CALCULATIONS
+            for column in utils.CALCULATIONS[name].columns
+        }
+        del stored["latency_p99"]
+
+        assert utils.stale_calculations(versions, stored=stored) == ["latency"]
+
+    def test_results_without_data_are_fresh(self):
+        versions = {
+            name: calculation.version
+            for name, calculation in utils.CALCULATIONS.items()
+        }
+        stored = {
+            column: 1.0
+            for name in utils.ENABLED_CALCULATIONS
+            for column in utils.CALCULATIONS[name].columns
+        }
+        stored["latency_p99"] = None
+
+        assert utils.stale_calculations(versions, stored=stored) == []
+
+    def test_failed_calculations_are_not_recorded(self):
+        assert utils.produced_versions(
+            ["observed_throughput", "latency"], failed=["observed_throughput"]
+        ) == {"latency": utils.CALCULATIONS["latency"].version}
+
+    def test_failures_are_collected_per_row(self):
+        def calculate_half(row):
+            if row.name == "b":
+                raise ValueError("no data")
+            row["half"] = row["value"] / 2
+            return row
+
+        df = pd.DataFrame({"value": [2.0, 4.0]}, index=["a", "b"])
+        failures = defaultdict(set)
+
+        utils.enrich_dataframe(df, calculations=[calculate_half], failures=failures)
+
+        assert failures[calculate_half] == {"b"}
+
+    def test_legacy_results_are_first_versions(self):
+        stored = {"_id": "a", "observed_throughput": 10, "latency_p99": None}
+
+        assert utils.recorded_versions(stored) == {
+            "observed_throughput": 1,
+            "latency": 1,
+        }
+        assert utils.recorded_versions(
+            {**stored, "calculation_versions": {"latency": 2}}
+        ) == {"latency": 2}
+
+
+class RangePrometheus:
+    """Answers range data queries from a dict of metric name -> matrix"""
+
+    def __init__(self, series):
+        self.series = series
+
+    def get_metric_range_data(self, query, start_time, end_time):
+        return self.series.get(query.split("{")[0], [])
+
+
+def counter(start, step, rate, count, **labels):
+    return {
+        "metric": labels,
+        "values": [[start + i * step, str(i * step * rate)] for i in range(count)],
+    }
+
+
+class TestArchive:
+    started_ts = "2025-01-10T12:00:00+00:00"
+    stopped_ts = "2025-01-10T12:02:00+00:00"
+
+    @pytest.fixture
+    def root(self, tmp_path, monkeypatch):
+        from greenflow import archive
+
+        start = pendulum.parse(self.started_ts).timestamp() - 300
+        prom = RangePrometheus(
+            {
+                "kminion_kafka_topic_high_water_mark_sum": [
+                    counter(
+                        start, 5, 1000, 180, namespace="default", topic_name="input"
+                    ),
+                    counter(
+                        start, 5, 10, 180, namespace="default", topic_name="output"
+                    ),
+                ],
+                "scaph_host_power_microwatts": [
+                    {
+                        "metric": {"node": node},
+                        "values": [[start + i * 5, "50000000"] for i in range(180)],
+                    }
+                    for node in ("n1", "n2")
+                ],
+                "node_network_receive_bytes_total": [
+                    counter(start, 5, 100, 180, device="eth0", node="n1")
+                ],
+                "node_network_speed_bytes": [
+                    {
+                        "metric": {"device": "eth0", "node": "n1"},
+                        "values": [[start + i * 5, "1000"] for i in range(180)],
+                    }
+                ],
+            }
+        )
+        archive.export_experiment(
+            "deployment", self.started_ts, self.stopped_ts, prom=prom, root=tmp_path
+        )
+        monkeypatch.setenv("GREENFLOW_ARCHIVE", str(tmp_path))
+        return tmp_path
+
+    @pytest.fixture
+    def row(self):
+        return pd.Series(
+            {
+                "exp_name": "ingest-kafka",
+                "started_ts": self.started_ts,
+                "stopped_ts": self.stopped_ts,
+                "load": 1000,
+                "durationSeconds": 120,
+                "broker_replicas": 2,
+            },
+            name="a",
+        )
+
+    def test_round_trip(self, root):
+        from greenflow.archive import read_series
+
+        table = read_series(self.started_ts, "kminion_kafka_topic_high_water_mark_sum")
+
+        assert table.num_rows == 360
+        assert set(table.column_names) == {
+            "namespace",
+            "topic_name",
+            "timestamp",
+            "value",
+        }
+        assert read_series(self.started_ts, "node_disk_read_bytes_total").num_rows == 0
+        assert read_series("2000-01-01T00:00:00+00:00", "up") is None
+        assert [entry.name for entry in root.iterdir()] == [
+            "deployment_started_ts=deployment"
+        ]
+
+    def test_exported_in_the_background(self, monkeypatch):
+        import importlib
+        import threading
+        from types import SimpleNamespace
+
+        from greenflow import archive, state
+
+        experiment = SimpleNamespace(
+            started_ts=self.started_ts, stopped_ts=self.stopped_ts
+        )
+        monkeypatch.setattr(
+            importlib.import_module("greenflow.g"),
+            "g",
+            SimpleNamespace(
+                deployment_type="production",
+                root=SimpleNamespace(current_experiment=experiment),
+            ),
+            raising=False,
+        )
+        monkeypatch.setattr(
+            state,
+            "get_deployment_state_vars",
+            lambda: {"deployment_started_ts": "deployment"},
+        )
+        exported, release = [], threading.Event()
+
+        def export(*timestamps):
+            release.wait(5)
+            exported.append(timestamps)
+
+        monkeypatch.setattr(archive, "_export", export)
+        future = archive.archive_current_experiment()
+
+        # end_exp does not wait for the export
+        assert not future.done()
+        release.set()
+        future.result(timeout=5)
+        assert exported == [("deployment", self.started_ts, self.stopped_ts)]
+
+    def test_hung_flush_times_out(self, monkeypatch):
+        import requests
+
+        from greenflow import archive
+
+        flushes, exported = [], []
+
+        def hung(url, timeout=None):
+            flushes.append(timeout)
+            raise requests.Timeout(url)
+
+        monkeypatch.setattr(requests, "get", hung)
+        monkeypatch.setattr(
+            archive, "export_experiment", lambda *timestamps: exported.append(1)
+        )
+        archive._export("deployment", self.started_ts, self.stopped_ts)
+
+        assert flushes == [30]
+        assert exported == [1]
+
+    def test_enrich_from_archive(self, root, row, monkeypatch):
+        monkeypatch.setattr(utils, "fetch_all", None)  # No TSDB queries allowed
+
+        df = utils.enrich_dataframe(
+            row.to_frame().T,
+            calculations=[
+                utils.calculate_observed_throughput,
+                utils.calculate_average_power,
+                utils.calculate_network_saturation,
+            ],
+            archive=True,
+        )
+
+        # High water mark at the end of the run: 420s of 1000 msg/s
+        assert df.loc["a", "observed_throughput"] == 420 * 1000 / 120
+        assert df.loc["a", "average_power"] == 100
+        assert df.loc["a", "network_saturation"] == pytest.approx(0.1)
+
+    def test_falls_back_to_tsdb(self, root, row, monkeypatch):
+        fetched = {}
+
+        def fake_fetch_all(queries, **kwargs):
+            fetched.update(queries)
+            return {key: [] for key in queries}
+
+        monkeypatch.setattr(utils, "fetch_all", fake_fetch_all)
+        other = row.copy()
+        other.name = "b"
+        other["started_ts"] = "2025-01-11T12:00:00+00:00"
+        other["stopped_ts"] = "2025-01-11T12:02:00+00:00"
+
+        utils.enrich_dataframe(
+            pd.DataFrame([row, other]),
+            calculations=[utils.calculate_average_power],
+            archive=True,
+        )
+
+        assert list(fetched) == [(utils.calculate_average_power, "b")]
+
+    def test_histogram_quantile(self):
+        import numpy as np
+        from greenflow.analysis.archive import histogram_quantile
+
+        le = np.array([0.1, 0.5, np.inf])
+        buckets = np.array([[50.0, 0.0], [100.0, 0.0], [100.0, 0.0]])
+
+        result = histogram_quantile(0.99, le, buckets)
+
+        assert result[0] == pytest.approx(0.1 + 0.4 * 49 / 50)
+        assert np.isnan(result[1])
+
+
+class TestQueryCache:
+    @pytest.fixture
+    def cache(self, tmp_path):
+        from greenflow.analysis.backends import DiskBackend
+        from greenflow.analysis.promclient import QueryCache
+
+        return QueryCache(DiskBackend(str(tmp_path)), open_ttl=30, settle=300)
+
+    def test_normalized_query_is_the_same_key(self, cache):
+        start = pendulum.parse("2025-01-10T12:00:00Z")
+        end = start.add(minutes=2)
+
+        assert cache.key(
+            utils.RangeQuery('sum by (le) (\n  rate(x{a="b"}[1m])\n)', start, end, "5s")
+        ) == cache.key(
+            utils.RangeQuery('sum by(le)(rate(x{a="b"}[1m]))', start, end, "5s")
+        )
+        assert cache.key(utils.RangeQuery('x{a="b c"}', start, end, "5s")) != cache.key(
+            utils.RangeQuery('x{a="b  c"}', start, end, "5s")
+        )
+        assert cache.key(utils.RangeQuery("x", start, end, "5s")) != cache.key(
+            utils.RangeQuery("x", start, end, "10s")
+        )
+
+    def test_prometheus_url_is_part_of_the_key(self, cache):
+        start = pendulum.parse("2025-01-10T12:00:00Z")
+        query = utils.RangeQuery("x", start, start.add(minutes=2), "5s")
+
+        assert cache.key(query, "http://test:9090") != cache.key(
+            query, "http://production:9090"
+        )
+        assert cache.key(query, "http://test:9090/") == cache.key(
+            query, "http://test:9090"
+        )
+        cache.set_many({"a": query}, {"a": []}, "http://test:9090")
+        assert cache.get_many({"a": query}, "http://production:9090") == {}
+        assert cache.get_many({"a": query}, "http://test:9090") == {"a": []}
+
+    def test_closed_windows_never_expire(self, cache):
+        now = pendulum.now()
+        closed = utils.RangeQuery("x", now.subtract(hours=1), now.subtract(minutes=10))
+        open = utils.RangeQuery("x", now.subtract(minutes=2), now)
+
+        assert cache.ttl(closed, [series(1)]) is None
+        assert cache.ttl(open, [series(1)]) == 30
+
+    def test_empty_results_expire(self, cache):
+        now = pendulum.now()
+        closed = utils.RangeQuery("x", now.subtract(hours=1), now.subtract(minutes=10))
+
+        assert cache.ttl(closed, []) == 30
+
+    def test_repeated_pass_does_no_io(self, cache):
+        from greenflow.analysis.promclient import AsyncPrometheus, run
+
+        requests = []
+        transport = prometheus_transport([], requests)
+        start = pendulum.parse("2025-01-10T12:00:00Z")
+        queries = {
+            i: utils.RangeQuery(f"up{{i='{i}'}}", start, start.add(minutes=2), "5s")
+            for i in range(3)
+        }
+
+        async def go():
+            async with AsyncPrometheus(
+                "http://prometheus", cache=cache, transport=transport
+            ) as client:
+                return await client.fetch_all(queries)
+
+        first = run(go())
+        second = run(go())
+
+        assert len(requests) == 3
+        assert second == first
+
+    def test_failed_queries_are_not_cached(self, cache):
+        query = utils.RangeQuery(
+            "up",
+            pendulum.parse("2025-01-10T12:00:00Z"),
+            pendulum.parse("2025-01-10T12:02:00Z"),
+        )
+        cache.set_many({"a": query}, {"a": RuntimeError("boom")})
+
+        assert cache.get_many({"a": query}) == {}
+
+
+class TestExperimentIndex:
+    @pytest.fixture
+    def index(self):
+        from tinydb.table import Document
+
+        from greenflow.analysis.tiny import ExperimentIndex
+
+        started = [
+            "2025-01-10T12:00:00+01:00",
+            "2025-01-10T09:00:00+00:00",
+            "2025-01-10T12:30:00+00:00",
+            "2025-01-10T11:30:00+00:00",
+        ]
+        return ExperimentIndex(
+            {
+                i: Document({"exp_name": str(i), "started_ts": ts}, doc_id=i)
+                for i, ts in enumerate(started, start=1)
+            }
+        )
+
+    def test_sorted_by_start_across_offsets(self, index):
+        assert [exp.doc_id for exp in index.experiments] == [2, 1, 4, 3]
+
+    def test_between_is_inclusive_and_most_recent_first(self, index):
+        experiments = index.between(
+            pendulum.parse("2025-01-10T11:00:00Z"),
+            pendulum.parse("2025-01-10T11:30:00Z"),
+        )
+
+        assert [exp.doc_id for exp in experiments] == [4, 1]
+
+    def test_latest_since(self, index):
+        assert index.latest_since(pendulum.parse("2025-01-10T12:30:00Z")).doc_id == 3
+        assert index.latest_since(pendulum.parse("2025-01-10T12:31:00Z")) is None
+
+    def test_read_again_only_after_a_write(self, monkeypatch):
+        import importlib
+        from types import SimpleNamespace
+
+        from tinydb.table import Document
+
+        from greenflow.analysis import tiny
+
+        reads = []
+
+        def read_all():
+            reads.append(1)
+            return [
+                Document({"started_ts": "2025-01-10T12:00:00+00:00"}, doc_id=i)
+                for i in range(1, len(reads) + 1)
+            ]
+
+        storage = SimpleNamespace(experiments=SimpleNamespace(all=read_all))
+        monkeypatch.setattr(
+            importlib.import_module("greenflow.g"),
+            "g",
+            SimpleNamespace(storage=storage),
+            raising=False,
+        )
+        monkeypatch.setattr(tiny, "_index", None)
+
+        assert len(tiny.get_experiment_index()) == 1
+        assert len(tiny.get_experiment_index()) == 1
+        tiny.invalidate_experiment_index()
+        assert len(tiny.get_experiment_index()) == 2
+        assert len(reads) == 2
+
+    def test_filter_experiments_accepts_a_dict(self):
+        from tinydb.table import Document
+
+        from greenflow.analysis.tiny import filter_experiments
+
+        exp = {
+            "exp_name": "ingest-kafka",
+            "started_ts": "2025-01-10T12:00:00+00:00",
+            "stopped_ts": "2025-01-10T12:02:00+00:00",
+            "experiment_metadata": {"factors": {"exp_params": {"load": 10}}},
+        }
+        df = filter_experiments(
+            {1: Document(exp, doc_id=1)},
+            lambda exp: True,
+            cutoff_begin="2025-01-10",
+            cutoff_end="2025-01-11",
+        )
+
+        assert df.loc[1, "load"] == 10
+
+
+class TestMetrics:
+    @pytest.fixture
+    def registry(self):
+        from greenflow.analysis.metrics import registry
+
+        registry.reset()
+        yield registry
+        registry.reset()
+
+    def test_prometheus_queries_are_counted(self, registry):
+        from greenflow.analysis.promclient import AsyncPrometheus, run
+
+        transport = prometheus_transport([503], [])
+
+        async def go():
+            async with AsyncPrometheus(
+                "http://prometheus", backoff=0, transport=transport
+            ) as client:
+                return await client.custom_query("up")
+
+        run(go())
+        stats = utils.stats().set_index(["name", "status"], drop=False)
+
+        assert stats.loc[("prometheus_queries_total", 503), "count"] == 1
+        assert stats.loc[("prometheus_queries_total", 200), "count"] == 1
+        (latency,) = stats[stats["name"] == "prometheus_query_seconds"].itertuples()
+        assert latency.count == 2
+        assert latency.endpoint == "/api/v1/query"
+
+    def test_sync_queries_are_counted_by_status(self, registry, monkeypatch):
+        from prometheus_api_client import PrometheusApiClientException
+
+        class Unavailable(FakePrometheus):
+            def custom_query(self, query, params=None):
+                if query == "down":
+                    raise PrometheusApiClientException("HTTP Status Code 503 (b'')")
+                return super().custom_query(query, params)
+
+        monkeypatch.setattr(utils, "prom", Unavailable({}))
+        now = pendulum.now()
+        query = utils.RangeQuery("up", now, now, step=utils.INSTANT)
+        utils.fetch_uncached(query)
+        with pytest.raises(PrometheusApiClientException):
+            utils.fetch_uncached(query._replace(query="down"))
+        stats = utils.stats().set_index(["name", "status"], drop=False)
+
+        assert stats.loc[("prometheus_queries_total", 503), "count"] == 1
+        assert stats.loc[("prometheus_queries_total", 200), "count"] == 1
+
+    def test_prometheus_url_is_required(self):
+        from greenflow.analysis.promclient import AsyncPrometheus
+
+        with pytest.raises(ValueError, match="PROMETHEUS_URL"):
+            AsyncPrometheus(None)
+
+    def test_exposition_and_push(self, registry, monkeypatch):
+        registry.inc("randas_cache_hits_total", function="load", tier="local")
+        registry.observe("randas_cache_bytes", 5000, buckets=(1e3, 1e4))
+        pushed = []
+        monkeypatch.setattr(
+            "requests.post",
+            lambda url, **kwargs: pushed.append((url, kwargs))
+            or httpx.Response(204, request=httpx.Request("POST", url)),
+        )
+        monkeypatch.delenv("EXPERIMENT_PUSHGATEWAY_URL", raising=False)
+
+        assert not utils.push_stats()
+        assert utils.push_stats("http://vm/api/v1/import/prometheus")
+
+        lines = pushed[0][1]["data"].splitlines()
+        assert 'randas_cache_hits_total{function="load",tier="local"} 1' in lines
+        assert 'randas_cache_bytes_bucket{le="1000.0"} 0' in lines
+        assert 'randas_cache_bytes_bucket{le="10000.0"} 1' in lines
+        assert 'randas_cache_bytes_bucket{le="+Inf"} 1' in lines
+        assert pushed[0][1]["params"] == {"extra_label": "job=greenflow_analysis"}
+
+
+class TestReadiness:
+    @pytest.fixture
+    def tsdb(self, monkeypatch):
+        from greenflow.analysis import promclient
+
+        class Scraping:
+            """Newest sample moves forward by 5s on every query"""
+
+            def __init__(self):
+                self.newest = pendulum.parse("2025-01-10T12:00:00Z")
+                self.queries = []
+
+            def custom_query(self, query, params=None):
+                self.queries.append(query)
+                self.newest = self.newest.add(seconds=5)
+                return [{"metric": {}, "value": [0, str(self.newest.timestamp())]}]
+
+        fake = Scraping()
+        monkeypatch.setattr(promclient, "prom", fake)
+        monkeypatch.setattr(promclient.requests, "get", lambda *a, **kw: None)
+        return fake
+
+    def test_returns_once_the_sample_is_visible(self, tsdb):
+        from greenflow.analysis.promclient import wait_for_samples, watermark_query
+
+        query = watermark_query("ingest-redpanda", "2025-01-10T12:00:00Z")
+        ready = wait_for_samples(
+            query, after=pendulum.parse("2025-01-10T12:00:20Z"), interval=0
+        )
+
+        assert ready
+        assert len(tsdb.queries) == 4
+        assert tsdb.queries[0] == f"max(timestamp({query}))"
+        assert 'namespace="redpanda"' in query
+
+    def test_gives_up_after_timeout(self, tsdb):
+        from greenflow.analysis.promclient import wait_for_samples
+
+        after = pendulum.parse("2030-01-01T00:00:00Z")
+        assert not wait_for_samples("up", after=after, timeout=0.05, interval=0.01)
@@ -0,0 +1,353 @@
+import os
+
+os.environ.setdefault("PROMETHEUS_URL", "http://localhost:9090")
+
+import importlib
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+# The package re-exports the `cache` instance under the module's name
+cache_module = importlib.import_module("greenflow.analysis.cache")
+RandasCache = cache_module.RandasCache
+
+
+@pytest.fixture
+def redis_instance():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def df() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "exp_name": ["ingest-kafka", "ingest-redpanda"] * 5000,
+            "load": np.arange(10000),
+            "average_power": np.linspace(0, 100, 10000),
+        }
+    )
+
+
+class TestArrowSerialization:
+    @pytest.mark.parametrize("compression", [None, "zstd", "lz4"])
+    def test_dataframe_round_trip(self, redis_instance, df, compression):
+        cache = RandasCache(redis_instance, compression=compression)
+        calls = []
+
+        @cache.cache
+        def load(n):
+            calls.append(n)
+            return df.head(n)
+
+        assert load(5000).equals(df.head(5000))
+        assert load(5000).equals(df.head(5000))
+        assert calls == [5000]
+
+    def test_compression_shrinks_entries(self, redis_instance, df):
+        plain = RandasCache(redis_instance, compression=None)
+        plain.leading_key = "Plain"
+        compressed = RandasCache(redis_instance, compression="zstd")
+        plain.post("Plain-df", df, "pyarrow")
+        compressed.post("RandasCache-df", df, "pyarrow")
+
+        assert (
+            redis_instance.hstrlen("RandasCache-df", "value")
+            < redis_instance.hstrlen("Plain-df", "value") / 2
+        )
+
+    def test_ndarray_and_other_values(self, redis_instance):
+        cache = RandasCache(redis_instance)
+
+        @cache.cache
+        def array(n):
+            return np.arange(n, dtype=float)
+
+        @cache.cache
+        def mapping(n):
+            return {"n": n}
+
+        array(10)
+        mapping(10)
+        assert np.array_equal(array(10), np.arange(10, dtype=float))
+        assert mapping(10) == {"n": 10}
+
+    def test_report(self, redis_instance, df):
+        cache = RandasCache(redis_instance)
+        cache.post("RandasCache-df", df, "pyarrow")
+        cache.get("RandasCache-df")
+
+        report = cache.report()
+
+        assert report.loc["RandasCache-df", "method"] == "pyarrow"
+        assert report.loc["RandasCache-df", "bytes"] > 0
+        assert report.loc["RandasCache-df", "load_seconds"] > 0
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    """Counts the commands that reach redis, pipelines count as one"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+
+    def execute_command(self, *args, **kwargs):
+        self.round_trips += 1
+        return super().execute_command(*args, **kwargs)
+
+    def pipeline(self, *args, **kwargs):
+        self.round_trips += 1
+        return super().pipeline(*args, **kwargs)
+
+
+class TestLocalTier:
+    def test_lru_evicts_by_bytes(self):
+        tier = cache_module.LRUTier(max_bytes=10)
+        tier.put("a", "a", "json", 4)
+        tier.put("b", "b", "json", 4)
+        tier.get("a")
+        tier.put("c", "c", "json", 4)
+        tier.put("huge", "huge", "json", 11)
+
+        assert list(tier.entries) == ["a", "c"]
+        assert tier.nbytes == 8
+        assert tier.evict("a") == 1
+        assert tier.evict() == 1
+        assert tier.nbytes == 0
+
+    def test_tables_are_charged_decoded(self, df):
+        cache = RandasCache(CountingRedis())
+        cache.post("RandasCache-df", df, "pyarrow")
+        cache.post("RandasCache-array", np.zeros(1000), "pyarrow")
+
+        table, _, charged, _ = cache.local.entries["RandasCache-df"]
+        assert charged == table.nbytes > len(cache.backend.get("RandasCache-df")[0])
+        assert cache.local.entries["RandasCache-array"][2] == 8000
+
+    def test_hits_are_served_locally(self, df):
+        redis_instance = CountingRedis()
+        cache = RandasCache(redis_instance)
+
+        @cache.cache
+        def load(n):
+            return df.head(n)
+
+        load(100)
+        before = redis_instance.round_trips
+        first = load(100)
+        first["load"] = -1
+
+        assert redis_instance.round_trips == before
+        # Each hit builds a fresh frame
+        assert load(100).equals(df.head(100))
+
+    def test_write_through_and_single_round_trip_miss(self, df):
+        redis_instance = CountingRedis()
+        writer = RandasCache(redis_instance)
+        writer.post("RandasCache-df", df, "pyarrow")
+        assert redis_instance.exists("RandasCache-df")
+
+        reader = RandasCache(redis_instance)
+        before = redis_instance.round_trips
+        assert reader.get("RandasCache-df").equals(df)
+        assert redis_instance.round_trips == before + 1
+
+        reader.invalidate_cache("RandasCache-df")
+        assert not reader.local.entries
+        with pytest.raises(ValueError):
+            reader.get("RandasCache-df")
+
+
+class TestDiskBackend:
+    def test_round_trip_without_redis(self, tmp_path, df):
+        backend = cache_module.DiskBackend(str(tmp_path))
+        cache = RandasCache(backend)
+        calls = []
+
+        @cache.cache
+        def load(n):
+            calls.append(n)
+            return df.head(n)
+
+        @cache.json_cache
+        def mapping(n):
+            return {"n": n}
+
+        load(100)
+        mapping(1)
+        # A new process only sees the files
+        cache = RandasCache(cache_module.DiskBackend(str(tmp_path)))
+        load = cache.cache(load.__wrapped__)
+        mapping = cache.json_cache(mapping.__wrapped__)
+
+        assert load(100).equals(df.head(100))
+        assert mapping(1) == {"n": 1}
+        assert calls == [100]
+        assert set(cache.report()["method"]) == {"pyarrow", "json"}
+        assert cache.invalidate_cache() == 2
+        assert list(tmp_path.iterdir()) == []
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        backend = cache_module.DiskBackend(str(tmp_path), max_bytes=3200)
+        for key in "abc":
+            backend.set(key, b"x" * 1000, "pickle")
+            os.utime(backend._filename(key), (0, ord(key)))
+        backend.get("a")
+        backend.set("d", b"x" * 1000, "pickle")
+
+        assert sorted(backend.keys("*")) == ["a", "c", "d"]
+        assert backend.nbytes <= 3200
+
+    def test_fallback_when_redis_is_down(self, tmp_path):
+        import redis
+
+        unreachable = redis.Redis(port=1, socket_connect_timeout=0.1)
+        path = tmp_path / "randas-cache"
+        backend = cache_module.default_backend(unreachable, str(path))
+
+        assert isinstance(backend, cache_module.DiskBackend)
+        # Created on the first write only
+        assert not path.exists()
+        assert backend.get("a") is None and backend.keys("*") == []
+        backend.set("a", b"1", "json")
+        assert backend.get_many(["a", "b"])[0][:2] == (b"1", "json")
+
+    def test_values_outlive_their_entry(self, tmp_path):
+        backend = cache_module.DiskBackend(str(tmp_path))
+        backend.set("a", b"1" * 1000, "pickle")
+        backend.set("b", b"2", "pickle", ttl=-1)
+
+        value, _, _ = backend.get("a")
+        backend.delete("a")
+        assert value.to_pybytes() == b"1" * 1000
+        # Expired entries are removed
+        assert backend.get("b") is None
+        assert backend.keys("*") == []
+
+    def test_backend_is_chosen_on_first_use(self, tmp_path):
+        made = []
+
+        def factory():
+            made.append(1)
+            return cache_module.DiskBackend(str(tmp_path))
+
+        cache = RandasCache(cache_module.LazyBackend(factory))
+        assert made == []
+        cache.backend.set("a", b"1", "json")
+        assert cache.backend.get("a")[:2] == (b"1", "json")
+        assert made == [1]
+
+
+class TestSingleFlight:
+    @pytest.mark.parametrize("backend", ["redis", "disk"])
+    def test_concurrent_misses_compute_once(self, tmp_path, backend):
+        import threading
+
+        server = fakeredis.FakeServer()
+        calls = []
+
+        def slow(n):
+            calls.append(n)
+            time.sleep(0.3)
+            return {"n": n}
+
+        def worker(results):
+            if backend == "redis":
+                cache = RandasCache(fakeredis.FakeRedis(server=server))
+            else:
+                cache = RandasCache(cache_module.DiskBackend(str(tmp_path)))
+            results.append(cache.json_cache(slow)(1))
+
+        results = []
+        threads = [threading.Thread(target=worker, args=(results,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert calls == [1]
+        assert results == [{"n": 1}] * 4
+
+    def test_expired_lease_is_taken_over(self, tmp_path):
+        backend = cache_module.DiskBackend(str(tmp_path))
+        assert backend.acquire("key", lease=0) is not None
+        # The first attempt clears the stale lock
+        assert backend.acquire("key", lease=60) is None
+        token = backend.acquire("key", lease=60)
+        assert token is not None
+        backend.release("key", "someone else")
+        assert backend.acquire("key", lease=60) is None
+        backend.release("key", token)
+        assert backend.acquire("key", lease=60) is not None
+
+
+class TestTTL:
+    def test_decorator_ttl(self, redis_instance):
+        cache = RandasCache(redis_instance)
+
+        @cache.cache(ttl=60)
+        def expiring(n):
+            return n
+
+        @cache.cache
+        def kept(n):
+            return n
+
+        expiring(1)
+        kept(1)
+
+        assert 0 < redis_instance.ttl("RandasCache-expiring:1") <= 60
+        assert redis_instance.ttl("RandasCache-kept:1") == -1
+
+    def test_expired_entries_are_recomputed(self, tmp_path):
+        cache = RandasCache(cache_module.DiskBackend(str(tmp_path)), ttl=0.2)
+        calls = []
+
+        @cache.json_cache
+        def load(n):
+            calls.append(n)
+            return n
+
+        load(1)
+        load(1)
+        time.sleep(0.3)
+        load(1)
+
+        assert calls == [1, 1]
+
+    def test_invalidation_scans_instead_of_keys(self, redis_instance):
+        cache = RandasCache(redis_instance)
+        for i in range(30):
+            cache.post(f"RandasCache-{i}", {"i": i}, "json")
+        redis_instance.set("other", 1)
+
+        redis_instance.keys = None
+        assert cache.invalidate_cache() == 30
+        assert redis_instance.dbsize() == 1
+
+
+class TestCacheMetrics:
+    def test_hits_misses_and_bytes_per_function(self, redis_instance, df):
+        from greenflow.analysis.metrics import registry
+
+        registry.reset()
+        cache = RandasCache(redis_instance)
+
+        @cache.cache
+        def load(n):
+            return df.head(n)
+
+        load(100)
+        load(100)
+        RandasCache(redis_instance).cache(load.__wrapped__)(100)
+        stats = registry.stats()
+        registry.reset()
+
+        stats = stats[stats["function"] == "load"].set_index("name")
+        assert stats.loc["randas_cache_misses_total", "count"] == 1
+        assert set(stats.loc["randas_cache_hits_total", "tier"]) == {"local", "backend"}
+        assert stats.loc["randas_cache_bytes", "sum"] > 0
+        assert stats.loc["randas_cache_serialize_seconds", "count"] == 1
+        assert stats.loc["randas_cache_compute_seconds", "count"] == 1
@@ -126,6 +126,50 @@ class TestExpStorage:
         results = storage.find_experiments_by_params(params)
         assert len(results) == expected_count
 
+    def test_analysis_rows_match_to_dict(
+        self, storage: ExpStorage, sample_experiment_data
+    ):
+        """The server side projection builds the same rows as Experiment.to_dict"""
+        exp = Experiment.from_dict(sample_experiment_data)
+        exp_id = storage.save_experiment(exp)
+        storage.results_collection.insert_one({"_id": exp_id, "latency_p99": 0.1})
+
+        (row,) = storage.find_analysis_rows({"exp_name": "ingest-kafka"})
+        expected = storage.find_experiments_by_name("ingest-kafka")[0].to_dict()
+
+        assert row.pop("_id") == exp_id
+        assert row.pop("stored") == {"_id": exp_id, "latency_p99": 0.1}
+        assert row == expected
+        assert row["cluster"] == "taurus"
+        assert row["num_broker_nodes"] == 2
+
+    def test_upsert_results_in_chunks(self, storage: ExpStorage):
+        from bson import ObjectId
+
+        results = [{"_id": ObjectId(), "latency_p99": i} for i in range(5)]
+        storage.results_collection.insert_one({**results[0], "latency_p99": -1})
+
+        timings = storage.upsert_results(results, chunk_size=2)
+
+        assert [t["count"] for t in timings] == [2, 2, 1]
+        assert storage.results_collection.count_documents({}) == 5
+        assert storage.results_collection.find_one({"_id": results[0]["_id"]}) == (
+            results[0]
+        )
+
+    def test_idle_power_versions(self, storage: ExpStorage):
+        """The idle power table is seeded once and new entries get a new version"""
+        seeded = storage.get_idle_power()
+        assert seeded["version"] == 1
+
+        entries = seeded["entries"] + [
+            {"cluster": "chiclet", "exp_name": None, "idle_power": 40.0}
+        ]
+        assert storage.save_idle_power(entries) == 2
+
+        assert len(storage.get_idle_power()["entries"]) == len(entries)
+        assert storage.get_idle_power(version=1) == seeded
+
 
 @pytest.fixture
 def sample_experiment_data() -> dict[str, any]:
@@ -198,3 +242,18 @@ class TestExperimentRealistic:
         assert doc["exp_name"] == sample_experiment_data["exp_name"]
         assert doc["experiment_metadata"]["factors"]["exp_params"]["broker_cpu"] == 10
         assert "dashboard_url" in doc["experiment_metadata"]
+
+    def test_record_matches_experiment(self, storage, sample_experiment_data):
+        """Stored experiments are read back as lightweight read-only records"""
+        from greenflow.mongo_storage import ExperimentRecord
+
+        exp = Experiment.from_dict(sample_experiment_data)
+        storage.save_experiment(exp)
+
+        (record,) = storage.find_experiments_by_name("ingest-kafka")
+
+        assert isinstance(record, ExperimentRecord)
+        assert record.to_dict() == {**exp.to_dict(), "exp_id": str(record._id)}
+        assert record.factors["exp_params"]["broker_cpu"] == 10
+        with pytest.raises(AttributeError):
+            record.exp_name = "changed"
@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("kr8s")
+from greenflow.exp_ng import jobs
+
+
+def pod(name, job, phase="Running", terminated=None, waiting=None):
+    state = {"running": {"startedAt": "2025-01-10T12:00:00Z"}}
+    if terminated is not None:
+        state = {
+            "terminated": {
+                "startedAt": "2025-01-10T12:00:00Z",
+                "finishedAt": "2025-01-10T12:01:40Z",
+                **terminated,
+            }
+        }
+    if waiting is not None:
+        state = {"waiting": {"reason": waiting}}
+    raw = {
+        "metadata": {"name": name, "labels": {"job-name": job}},
+        "status": {"phase": phase, "containerStatuses": [{"state": state}]},
+    }
+    return SimpleNamespace(name=name, raw=raw)
+
+
+def succeeded(name, job):
+    return pod(name, job, "Succeeded", terminated={"exitCode": 0})
+
+
+class FakeApi:
+    def __init__(self, events):
+        self.events = events
+        self.selectors = []
+
+    async def watch(self, kind, namespace=None, label_selector=None):
+        self.selectors.append(label_selector)
+        for event in self.events:
+            yield event
+
+
+def watch(events, completions):
+    api = FakeApi(events)
+    return asyncio.run(jobs.watch_jobs(completions, api=api)), api
+
+
+class TestWatchJobs:
+    def test_returns_once_every_pod_succeeded(self):
+        events = [
+            ("ADDED", pod("p-1", "producer")),
+            ("ADDED", pod("c-1", "consumer")),
+            ("MODIFIED", succeeded("p-1", "producer")),
+            ("MODIFIED", succeeded("c-1", "consumer")),
+            # Never reached
+            ("MODIFIED", pod("p-2", "producer", "Failed")),
+        ]
+        times, api = watch(events, {"producer": 1, "consumer": 1})
+
+        assert api.selectors == ["job-name in (producer,consumer)"]
+        assert set(times) == {"p-1", "c-1"}
+        assert times["p-1"].job == "producer"
+        assert (times["p-1"].finished - times["p-1"].started).total_seconds() == 100
+
+    @pytest.mark.parametrize(
+        "failed",
+        [
+            pod("p-2", "producer", "Failed"),
+            pod("p-2", "producer", terminated={"exitCode": 137, "reason": "OOMKilled"}),
+            pod("p-2", "producer", "Pending", waiting="ImagePullBackOff"),
+        ],
+    )
+    def test_fails_on_the_first_pod_error(self, failed):
+        events = [
+            ("ADDED", pod("p-1", "producer")),
+            ("MODIFIED", failed),
+            ("MODIFIED", succeeded("p-1", "producer")),
+        ]
+        with pytest.raises(jobs.JobFailed, match="p-2"):
+            watch(events, {"producer": 2})
+
+    def test_deleted_pods_are_ignored(self):
+        events = [
+            ("DELETED", pod("old", "producer", "Failed")),
+            ("MODIFIED", succeeded("p-1", "producer")),
+        ]
+        times, _ = watch(events, {"producer": 1})
+
+        assert list(times) == ["p-1"]
+
+    def test_jobs_without_pods(self):
+        job = SimpleNamespace(name="consumer", raw={"spec": {"completions": 0}})
+
+        assert jobs.wait_for_completion([job], timeout=1) == {}
@@ -0,0 +1,160 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+confluent_kafka = pytest.importorskip("confluent_kafka")
+from confluent_kafka import KafkaError, KafkaException
+
+from greenflow.exp_ng import kafka_admin
+
+
+def resolved(error=None) -> Future:
+    future = Future()
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(KafkaException(KafkaError(*error)))
+    return future
+
+
+class FakeAdmin:
+    """Topics disappear from the metadata a few polls after their deletion"""
+
+    def __init__(self, topics=(), deleting=()):
+        self.topics = dict.fromkeys(topics, 0)
+        self.topics.update(dict.fromkeys(deleting, 2))
+        self.created = []
+        # name -> high water mark of each partition
+        self.offsets = {name: [100, 200] for name in self.topics}
+
+    def list_topics(self, timeout=None):
+        for name, polls in list(self.topics.items()):
+            if polls == 1:
+                del self.topics[name]
+            elif polls > 1:
+                self.topics[name] = polls - 1
+        topics = {
+            name: SimpleNamespace(
+                error=None,
+                partitions={
+                    p: SimpleNamespace(replicas=[1]) for p in range(len(offsets))
+                },
+            )
+            for name, offsets in self.offsets.items()
+            if name in self.topics
+        }
+        return SimpleNamespace(topics=topics)
+
+    def delete_records(self, partitions, operation_timeout=None):
+        futures = {}
+        for partition in partitions:
+            future = Future()
+            offset = self.offsets[partition.topic][partition.partition]
+            future.set_result(SimpleNamespace(low_watermark=offset))
+            futures[partition] = future
+        return futures
+
+    def create_topics(self, topics, operation_timeout=None):
+        (topic,) = topics
+        if self.topics.get(topic.topic, 0) > 0:
+            error = KafkaError.TOPIC_ALREADY_EXISTS, "Topic is marked for deletion."
+        elif topic.topic in self.topics:
+            error = KafkaError.TOPIC_ALREADY_EXISTS, "Topic already exists."
+        else:
+            error = None
+            self.topics[topic.topic] = 0
+            self.offsets[topic.topic] = [0] * topic.num_partitions
+            self.created.append((topic.topic, topic.num_partitions))
+        return {topic.topic: resolved(error)}
+
+    def delete_topics(self, topics, operation_timeout=None):
+        (topic,) = topics
+        if topic not in self.topics:
+            return {topic: resolved((KafkaError.UNKNOWN_TOPIC_OR_PART,))}
+        self.topics[topic] = 2
+        return {topic: resolved()}
+
+
+class TestTopics:
+    def test_create_waits_for_deletion(self):
+        client = FakeAdmin(deleting=["input"])
+
+        assert kafka_admin.create_topic(client, "input", 6, 1, timeout=5)
+        assert client.created == [("input", 6)]
+        assert not kafka_admin.create_topic(client, "input", 6, 1)
+
+    def test_delete_waits_until_gone(self):
+        client = FakeAdmin(topics=["input"])
+
+        assert kafka_admin.delete_topic(client, "input", timeout=5)
+        assert "input" not in client.topics
+        assert not kafka_admin.delete_topic(client, "input")
+
+    def test_deletion_timeout(self):
+        client = FakeAdmin(deleting=["input"])
+        client.topics["input"] = 10**6
+
+        with pytest.raises(TimeoutError):
+            kafka_admin.wait_for_deletion(client, "input", timeout=0.3, interval=0.1)
+
+    def test_same_spec_is_truncated(self):
+        client = FakeAdmin(topics=["input"])
+
+        assert kafka_admin.topic_spec(client, "input") == (2, 1)
+        assert kafka_admin.truncate_or_create_topic(client, "input", 2, 1) == 300
+        assert client.created == []
+
+    def test_changed_spec_is_recreated(self):
+        client = FakeAdmin(topics=["input"])
+
+        assert kafka_admin.truncate_or_create_topic(client, "input", 6, 1) == 0
+        assert client.created == [("input", 6)]
+        assert kafka_admin.truncate_or_create_topic(client, "other", 6, 1) == 0
+        assert kafka_admin.topic_spec(client, "other") == (6, 1)
+
+    def test_unreachable_brokers_are_retried(self, monkeypatch):
+        monkeypatch.setenv("KAFKA_ADMIN_BOOTSTRAP_SERVERS", "127.0.0.1:1")
+        monkeypatch.setattr(kafka_admin, "_clients", {})
+        monkeypatch.setattr(kafka_admin, "_unreachable", {})
+
+        assert kafka_admin.admin_client({}, timeout=0.5) is None
+        failures, retry_at = kafka_admin._unreachable["127.0.0.1:1"]
+        assert failures == 1
+        # Not probed again before the backoff
+        assert kafka_admin.admin_client({}, timeout=0.5) is None
+        assert kafka_admin._unreachable["127.0.0.1:1"] == (1, retry_at)
+
+        kafka_admin._unreachable["127.0.0.1:1"] = (1, 0)
+        assert kafka_admin.admin_client({}, timeout=0.5) is None
+        failures, next_retry_at = kafka_admin._unreachable["127.0.0.1:1"]
+        assert failures == 2
+        assert next_retry_at - retry_at > kafka_admin.RETRY_SECONDS
+
+    def test_external_listener(self, monkeypatch):
+        def node(*addresses):
+            return SimpleNamespace(raw={"status": {"addresses": list(addresses)}})
+
+        nodes = [
+            node({"type": "InternalIP", "address": "10.0.0.2"}),
+            node(
+                {"type": "Hostname", "address": "broker-1"},
+                {"type": "InternalIP", "address": "10.0.0.1"},
+            ),
+        ]
+        kr8s_objects = pytest.importorskip("kr8s.objects")
+        monkeypatch.delenv("KAFKA_ADMIN_BOOTSTRAP_SERVERS", raising=False)
+        monkeypatch.setattr(kafka_admin, "_external", {})
+        monkeypatch.setattr(
+            kr8s_objects.Node, "list", staticmethod(lambda label_selector: nodes)
+        )
+
+        exp_params = {
+            "kafka_bootstrap_servers": "theodolite-kafka-kafka-bootstrap:9092"
+        }
+        assert (
+            kafka_admin.bootstrap_servers(exp_params) == "10.0.0.1:32092,10.0.0.2:32092"
+        )
+        # Brokers without one are reached by their own names
+        exp_params = {"kafka_bootstrap_servers": "kafka:9092"}
+        assert kafka_admin.bootstrap_servers(exp_params) == "kafka:9092"
@@ -0,0 +1,170 @@
+import os
+
+os.environ.setdefault("PROMETHEUS_URL", "http://localhost:9090")
+
+import asyncio
+import importlib
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from greenflow.exp_ng import hammer
+
+g_module = importlib.import_module("greenflow.g")
+analysis = importlib.import_module("greenflow.analysis")
+
+
+class FakeLab:
+    """Records what the pipeline does to the cluster and the storage"""
+
+    def __init__(self):
+        self.events = []
+        self.exp_params = dict(
+            topic_name="input", load=0.0, durationSeconds=0, messageSize=1024
+        )
+        self.pipeline = None
+        self.started = 0
+        self.failing_releases = 0
+
+    def rebind_parameters(self, **params):
+        self.exp_params.update(params)
+
+    def factors(self):
+        return {"exp_params": dict(self.exp_params)}
+
+    def init_exp(self, description):
+        self.started += 1
+
+    def end_exp(self):
+        self.events.append(
+            ("end_exp", self.pipeline.pending, len(self.pipeline.results))
+        )
+
+    def get_last_experiment(self, now):
+        # The storage is only read from the thread committing to it
+        assert threading.current_thread() is threading.main_thread()
+        return {"started": self.started}
+
+    def observed_throughput_of(self, experiment):
+        return experiment["started"] * 100.0
+
+    def release_kafka_topic(self, extra_vars):
+        if self.failing_releases:
+            self.failing_releases -= 1
+            raise RuntimeError("topic deletion failed")
+        self.events.append(("release", extra_vars.exp_params.topic_name))
+
+    def run(self, extra_vars):
+        self.events.append(("load", extra_vars.exp_params.topic_name))
+
+
+@pytest.fixture
+def lab(monkeypatch):
+    lab = FakeLab()
+    monkeypatch.setattr(hammer, "rebind_parameters", lab.rebind_parameters)
+    monkeypatch.setattr(hammer, "factors", lab.factors)
+    monkeypatch.setattr(
+        hammer,
+        "prepare_kafka_topic",
+        lambda extra_vars: lab.events.append(
+            ("prepare", extra_vars.exp_params.topic_name)
+        ),
+    )
+    monkeypatch.setattr(hammer, "release_kafka_topic", lab.release_kafka_topic)
+    monkeypatch.setattr(
+        hammer, "get_deployment_state_vars", lambda: {"deployment_started_ts": "d"}
+    )
+    monkeypatch.setattr(
+        hammer, "get_experiment_state_vars", lambda: {"experiment_started_ts": "e"}
+    )
+    monkeypatch.setattr(hammer, "reinit_prometheus", lambda *args: None)
+    monkeypatch.setattr(hammer, "scale_prometheus", lambda replicas: None)
+    monkeypatch.setattr(hammer, "wait_for_scrape", lambda extra_vars: None)
+    # Set by glue once the storage is opened
+    monkeypatch.setattr(
+        g_module,
+        "g",
+        SimpleNamespace(init_exp=lab.init_exp, end_exp=lab.end_exp),
+        raising=False,
+    )
+    monkeypatch.setattr(analysis, "get_last_experiment", lab.get_last_experiment)
+    monkeypatch.setattr(analysis, "observed_throughput_of", lab.observed_throughput_of)
+    return lab
+
+
+def pipeline(lab) -> hammer.StressTestPipeline:
+    lab.pipeline = hammer.StressTestPipeline(pool=lab)
+    return lab.pipeline
+
+
+class TestStressTestPipeline:
+    def test_drains_before_storing_the_next_experiment(self, lab):
+        with pipeline(lab) as stress_test:
+            for load in [1000, 2000, 3000]:
+                stress_test.run(load)
+
+        assert stress_test.results == [100, 200, 300]
+        # Nothing is pending and every previous readout is in when storing
+        assert [event[1:] for event in lab.events if event[0] == "end_exp"] == [
+            (None, 0),
+            (None, 1),
+            (None, 2),
+        ]
+        assert lab.exp_params["topic_name"] == "input"
+
+    def test_alternates_topic_names(self, lab):
+        with pipeline(lab) as stress_test:
+            for load in [1000, 2000, 3000]:
+                stress_test.run(load)
+
+        topics = {
+            kind: [event[1] for event in lab.events if event[0] == kind]
+            for kind in ("prepare", "load", "release")
+        }
+        assert topics["prepare"] == ["input-0", "input-1", "input-0"]
+        assert topics["load"] == topics["prepare"]
+        assert topics["release"] == topics["prepare"]
+
+    def test_teardown_failures_surface_on_the_next_drain(self, lab):
+        lab.failing_releases = 1
+        with pipeline(lab) as stress_test:
+            stress_test.run(1000)
+            with pytest.raises(RuntimeError, match="topic deletion failed"):
+                stress_test.run(2000)
+
+        # The failed experiment is not stored as if its readout went through
+        assert [event[0] for event in lab.events].count("end_exp") == 1
+        assert stress_test.results == []
+
+
+class FakeJob:
+    def __init__(self):
+        self.deleted = False
+
+    def delete(self, propagation_policy=None):
+        self.deleted = True
+
+
+class TestWaitForJobs:
+    def test_waits_for_the_scheduled_load(self, monkeypatch):
+        duration = 100
+        start_timestamp = int(hammer.time.time()) + hammer.START_DELAY
+        # The pods finish past durationSeconds + 20: they start with a delay,
+        # then wait for the time bomb to stop them
+        finish = start_timestamp - hammer.time.time() + duration + 5
+
+        def wait_for_completion(jobs, timeout):
+            if timeout < finish:
+                raise asyncio.TimeoutError()
+            return {"producer-0": (0, finish), "consumer-0": (0, finish)}
+
+        monkeypatch.setattr(hammer, "wait_for_completion", wait_for_completion)
+        jobs = FakeJob(), FakeJob()
+        extra_vars = {"exp_params": {"durationSeconds": duration}}
+
+        times = hammer.wait_for_jobs(extra_vars, jobs, start_timestamp)
+
+        assert finish > duration + 20
+        assert set(times) == {"producer-0", "consumer-0"}
+        assert all(job.deleted for job in jobs)
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("kr8s")
+from box import Box
+
+from greenflow.exp_ng import jobs, pool
+
+
+class FakePod:
+    """Exits with exit_code after the given number of status polls"""
+
+    def __init__(self, name, exit_code="0", polls=1):
+        self.name = name
+        self.exit_code = exit_code
+        self.polls = polls
+        self.commands = []
+
+    async def exec(self, command):
+        self.commands.append(command[-1])
+        stdout = ""
+        if command[-1].startswith("cat "):
+            self.polls -= 1
+            stdout = self.exit_code if self.polls < 0 else ""
+        elif command[-1].startswith("tail "):
+            stdout = "OutOfMemoryError"
+        return Box(stdout=stdout.encode("utf-8"))
+
+
+@pytest.fixture
+def extra_vars():
+    return Box(
+        exp_params=dict(
+            topic_name="input-0",
+            kafka_bootstrap_servers="kafka:9092",
+            durationSeconds=100,
+            load=1000,
+            producer_instances=2,
+            consumer_instances=1,
+            messageSize=1024,
+        )
+    )
+
+
+def run(pods, extra_vars, monkeypatch, interval=0, timeout=None):
+    by_name = {pod.name: pod for role_pods in pods.values() for pod in role_pods}
+
+    class Pods:
+        @staticmethod
+        async def get(name, namespace=None):
+            return by_name[name]
+
+    finished = {}
+    load_pool = pool.LoadPool(lead_seconds=0)
+    names = {role: [pod.name for pod in role_pods] for role, role_pods in pods.items()}
+    monkeypatch.setattr(pool, "Pod", Pods)
+
+    async def timed():
+        await asyncio.wait_for(
+            load_pool._run(names, extra_vars, interval, finished, int(time.time())),
+            timeout,
+        )
+
+    asyncio.run(timed())
+    return finished
+
+
+class TestLoadPool:
+    def test_dispatches_to_every_pod(self, extra_vars, monkeypatch):
+        producers = [FakePod("p-1"), FakePod("p-2", polls=3)]
+        consumers = [FakePod("c-1")]
+        finished = run(
+            {"producer": producers, "consumer": consumers}, extra_vars, monkeypatch
+        )
+
+        assert set(finished) == {"p-1", "p-2", "c-1"}
+        # The run id and start are shared, the arguments follow the role
+        dispatch = producers[0].commands[0]
+        assert dispatch.startswith("nohup setsid /bin/sh -c 'echo $$ > /tmp/runs/")
+        assert "/tmp/producer.sh" in dispatch
+        assert "--num-records 50000" in dispatch
+        assert producers[1].commands[0] == dispatch
+        assert "--topic input-0" in consumers[0].commands[0]
+        assert "/tmp/consumer.sh" in consumers[0].commands[0]
+
+    def test_fails_on_the_first_exit_code(self, extra_vars, monkeypatch):
+        pods = {
+            "producer": [FakePod("p-1", polls=10**6), FakePod("p-2", exit_code="137")],
+            "consumer": [],
+        }
+        with pytest.raises(jobs.JobFailed, match="p-2: exit code 137"):
+            run(pods, extra_vars, monkeypatch)
+
+    def test_failures_stop_every_run(self, extra_vars, monkeypatch):
+        pods = {
+            "producer": [FakePod("p-1", polls=10**6), FakePod("p-2", exit_code="1")],
+            "consumer": [FakePod("c-1", polls=10**6)],
+        }
+        with pytest.raises(jobs.JobFailed):
+            run(pods, extra_vars, monkeypatch)
+
+        for pod in [*pods["producer"], *pods["consumer"]]:
+            assert pod.commands[-1].startswith("kill -TERM -- -$(cat /tmp/runs/")
+
+    def test_timeouts_stop_every_run(self, extra_vars, monkeypatch):
+        pods = {"producer": [FakePod("p-1", polls=10**6)], "consumer": []}
+        with pytest.raises(asyncio.TimeoutError):
+            run(pods, extra_vars, monkeypatch, interval=0.01, timeout=0.1)
+
+        assert pods["producer"][0].commands[-1].startswith("kill -TERM")
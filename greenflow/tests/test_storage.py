@@ -0,0 +1,93 @@
+import os
+
+os.environ.setdefault("DASHBOARD_BASE_URL", "http://localhost:3000")
+
+import pendulum
+import pytest
+from tinydb import Query, TinyDB
+from tinydb_serialization import SerializationMiddleware
+
+from greenflow.utils import (
+    AppendOnlyTinyDB,
+    DateTimeSerializer,
+    JSONLinesStorage,
+    YAMLStorage,
+)
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path / "experiment-history.jsonl")
+
+
+def lines(path) -> int:
+    with open(path) as handle:
+        return sum(1 for _ in handle)
+
+
+class TestJSONLinesStorage:
+    def test_round_trip(self, path):
+        db = AppendOnlyTinyDB(path, storage=JSONLinesStorage)
+        started_ts = pendulum.parse("2025-01-10T12:00:00+01:00")
+        db.insert({"exp_name": "ingest-kafka", "started_ts": started_ts})
+        db.table("idle_power").insert({"version": 1})
+        db.close()
+
+        db = AppendOnlyTinyDB(path, storage=JSONLinesStorage)
+        assert db.all() == [{"exp_name": "ingest-kafka", "started_ts": started_ts}]
+        assert isinstance(db.all()[0]["started_ts"], pendulum.DateTime)
+        assert db.table("idle_power").all() == [{"version": 1}]
+
+    def test_writes_only_append_changes(self, path):
+        db = AppendOnlyTinyDB(path, storage=JSONLinesStorage)
+        db.insert_multiple({"i": i} for i in range(10))
+        assert lines(path) == 10
+
+        db.insert({"i": 10})
+        db.update({"i": -1}, Query().i == 3)
+        db.remove(Query().i == 4)
+        assert lines(path) == 13
+
+        db.close()
+        db = AppendOnlyTinyDB(path, storage=JSONLinesStorage)
+        assert sorted(doc["i"] for doc in db.all()) == [-1, 0, 1, 2, 5, 6, 7, 8, 9, 10]
+
+    def test_dropped_tables(self, path):
+        db = AppendOnlyTinyDB(path, storage=JSONLinesStorage)
+        db.table("idle_power").insert({"version": 1})
+        db.drop_table("idle_power")
+        db.close()
+
+        assert AppendOnlyTinyDB(path, storage=JSONLinesStorage).tables() == set()
+
+    def test_compaction(self, path):
+        db = AppendOnlyTinyDB(
+            path, storage=JSONLinesStorage, compact_ratio=2, compact_min=10
+        )
+        for i in range(50):
+            db.upsert({"k": 1, "v": i}, Query().k == 1)
+        db.close()
+
+        assert lines(path) < 50
+        assert AppendOnlyTinyDB(path, storage=JSONLinesStorage).all() == [
+            {"k": 1, "v": 49}
+        ]
+
+    def test_migrates_yaml_history(self, tmp_path, path):
+        serialization = SerializationMiddleware(YAMLStorage)
+        serialization.register_serializer(DateTimeSerializer(), "Pendulum")
+        started_ts = pendulum.parse("2025-01-10T12:00:00+01:00")
+        legacy = TinyDB(
+            str(tmp_path / "experiment-history.yaml"), storage=serialization
+        )
+        legacy.insert({"exp_name": "ingest-kafka", "started_ts": started_ts})
+        legacy.close()
+
+        db = AppendOnlyTinyDB(
+            path,
+            storage=JSONLinesStorage,
+            migrate_from=str(tmp_path / "experiment-history.yaml"),
+        )
+
+        assert db.all() == [{"exp_name": "ingest-kafka", "started_ts": started_ts}]
+        assert db.insert({"exp_name": "ingest-redpanda"}) == 2
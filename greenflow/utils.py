@@ -1,10 +1,14 @@
 import json
+import os
+import threading
 from os import environ
 
+import orjson
 import pendulum
 import yaml
 from pendulum.datetime import DateTime
-from tinydb import Storage
+from tinydb import Storage, TinyDB
+from tinydb.table import Table
 from tinydb_serialization import Serializer
 
 
@@ -73,6 +77,264 @@ class YAMLStorage(Storage):
         pass
 
 
+class TrackedDocument(dict):
+    """Stored document reporting in-place changes back to its storage"""
+
+    __slots__ = ("_key", "_on_change")
+
+    def __init__(self, data, key, on_change):
+        super().__init__(data)
+        self._key = key
+        self._on_change = on_change
+
+    def _changed(self):
+        self._on_change(self._key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._changed()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self._changed()
+        return value
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+
+class JSONLinesStorage(Storage):
+    """
+    Append-only TinyDB storage. Every write appends one JSON line per inserted,
+    changed or removed document instead of rewriting the whole database:
+
+        {"t": table, "id": doc_id, "doc": {...}}   insert or update
+        {"t": table, "id": doc_id}                 removal
+        {"t": table}                               dropped table
+
+    The log is replayed once when opened and then kept in memory. Once it holds
+    `compact_ratio` times more lines than live documents, it is compacted into
+    a snapshot by a background thread.
+
+    Pendulum DateTimes are stored with the tag of DateTimeSerializer, so the
+    SerializationMiddleware (which walks every document on every access) is not
+    needed on top of this storage.
+    """
+
+    TAG = "{Pendulum}:"
+
+    def __init__(
+        self,
+        filename,
+        *,
+        migrate_from=None,
+        compact_ratio: int = 4,
+        compact_min: int = 1000,
+    ):
+        self.filename = filename
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.lock = threading.Lock()
+        self.compaction = None
+        self.dirty = set()
+        self.tables = None
+        self.log_lines = 0
+
+        if migrate_from and not os.path.exists(filename):
+            self._migrate(migrate_from)
+
+    def _track(self, table: str, doc_id: str, doc: dict) -> TrackedDocument:
+        return TrackedDocument(doc, (table, doc_id), self.dirty.add)
+
+    @classmethod
+    def _default(cls, obj):
+        if isinstance(obj, DateTime):
+            return cls.TAG + obj.to_iso8601_string()
+        raise TypeError
+
+    @classmethod
+    def _dumps(cls, record) -> bytes:
+        return orjson.dumps(
+            record, default=cls._default, option=orjson.OPT_PASSTHROUGH_DATETIME
+        )
+
+    @classmethod
+    def _decode(cls, element):
+        for key, value in (
+            element.items() if isinstance(element, dict) else enumerate(element)
+        ):
+            if isinstance(value, str):
+                if value.startswith(cls.TAG):
+                    element[key] = pendulum.parse(value[len(cls.TAG) :], strict=False)
+            elif isinstance(value, (dict, list)):
+                cls._decode(value)
+        return element
+
+    def _load(self):
+        self.tables = {}
+        self.log_lines = 0
+        try:
+            with open(self.filename, "rb") as handle:
+                for line in handle:
+                    if not line.strip():
+                        continue
+                    self.log_lines += 1
+                    record = orjson.loads(line)
+                    name = record["t"]
+                    if "id" not in record:
+                        self.tables.pop(name, None)
+                    elif "doc" in record:
+                        self.tables.setdefault(name, {})[record["id"]] = self._track(
+                            name, record["id"], self._decode(record["doc"])
+                        )
+                    else:
+                        self.tables.get(name, {}).pop(record["id"], None)
+        except FileNotFoundError:
+            pass
+
+    def _migrate(self, filename):
+        """Import a database written by another storage, e.g. YAMLStorage"""
+        data = YAMLStorage(filename).read() if filename.endswith(".yaml") else None
+        if not data:
+            return
+        with open(self.filename, "wb") as handle:
+            for name, table in data.items():
+                for doc_id, doc in table.items():
+                    handle.write(
+                        self._dumps({"t": name, "id": str(doc_id), "doc": doc}) + b"\n"
+                    )
+
+    def read(self):
+        with self.lock:
+            if self.tables is None:
+                self._load()
+            if not self.tables:
+                return None
+            # TinyDB replaces tables in the dict it reads, not in our copy
+            return dict(self.tables)
+
+    def write(self, data):
+        with self.lock:
+            if self.tables is None:
+                self._load()
+            lines = []
+            for name in self.tables.keys() - data.keys():
+                lines.append({"t": name})
+                del self.tables[name]
+            for name, table in data.items():
+                cached = self.tables.get(name, {})
+                if table is cached:
+                    continue
+                for doc_id in cached.keys() - table.keys():
+                    lines.append({"t": name, "id": doc_id})
+                for doc_id in table.keys() - cached.keys():
+                    table[doc_id] = self._track(name, doc_id, table[doc_id])
+                    self.dirty.add((name, doc_id))
+                self.tables[name] = table
+            for name, doc_id in self.dirty:
+                doc = self.tables.get(name, {}).get(doc_id)
+                if doc is not None:
+                    lines.append({"t": name, "id": doc_id, "doc": doc})
+            self.dirty.clear()
+
+            if lines:
+                with open(self.filename, "ab") as handle:
+                    handle.write(b"".join(self._dumps(line) + b"\n" for line in lines))
+                self.log_lines += len(lines)
+        self._maybe_compact()
+
+    def insert(self, name: str, doc_id: str, doc: dict):
+        """Append a single document, without going through the whole table"""
+        with self.lock:
+            if self.tables is None:
+                self._load()
+            table = self.tables.setdefault(name, {})
+            if doc_id in table:
+                raise ValueError(f"Document with ID {doc_id} already exists")
+            table[doc_id] = self._track(name, doc_id, doc)
+            with open(self.filename, "ab") as handle:
+                handle.write(self._dumps({"t": name, "id": doc_id, "doc": doc}) + b"\n")
+            self.log_lines += 1
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        live = sum(len(table) for table in self.tables.values())
+        if self.log_lines < max(self.compact_ratio * live, self.compact_min):
+            return
+        if self.compaction is not None and self.compaction.is_alive():
+            return
+        self.compaction = threading.Thread(target=self.compact, daemon=True)
+        self.compaction.start()
+
+    def compact(self):
+        """Rewrite the log as one line per live document"""
+        with self.lock:
+            snapshot = {name: dict(table) for name, table in self.tables.items()}
+            offset = os.path.getsize(self.filename)
+
+        tmp = f"{self.filename}.compact"
+        with open(tmp, "wb") as handle:
+            for name, table in snapshot.items():
+                for doc_id, doc in table.items():
+                    handle.write(
+                        self._dumps({"t": name, "id": doc_id, "doc": doc}) + b"\n"
+                    )
+            lines = sum(len(table) for table in snapshot.values())
+
+        with self.lock:
+            # Replay what was appended while the snapshot was being written
+            with open(self.filename, "rb") as log, open(tmp, "ab") as handle:
+                log.seek(offset)
+                tail = log.read()
+                handle.write(tail)
+            os.replace(tmp, self.filename)
+            self.log_lines = lines + tail.count(b"\n")
+
+    def close(self):
+        if self.compaction is not None:
+            self.compaction.join()
+
+
+class AppendOnlyTable(Table):
+    """Table inserting straight into a JSONLinesStorage"""
+
+    def insert(self, document) -> int:
+        if not isinstance(self._storage, JSONLinesStorage):
+            return super().insert(document)
+
+        if isinstance(document, self.document_class):
+            doc_id = document.doc_id
+            self._next_id = None
+        else:
+            doc_id = self._get_next_id()
+        self._storage.insert(self.name, str(doc_id), dict(document))
+        self.clear_cache()
+        return doc_id
+
+
+class AppendOnlyTinyDB(TinyDB):
+    table_class = AppendOnlyTable
+
+
 class DateTimeSerializer(Serializer):
     OBJ_CLASS = DateTime
 